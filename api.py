@@ -1,16 +1,27 @@
+import os
 from datetime import datetime
-from flask import Blueprint, request, jsonify, abort
-import json
+from flask import Blueprint, request, jsonify, abort, send_file, stream_with_context
 from flask_login import login_required, current_user
 
 from itsdangerous import URLSafeTimedSerializer
 from flask import current_app
-from sqlalchemy import func
-from models import db, Family, Bill, BillItem, NotificationLog, Invitation, Payment
+from sqlalchemy import select
+from sqlalchemy.orm import load_only, raiseload
+from models import db, Family, Bill, BillItem, Invitation, Payment
 from mailer import send_email
-from events import send_event
+import ledger
+import statements
+from ingest import CSV_TYPES, NDJSON_TYPES, ingest_items, parse_csv, parse_ndjson
+from reconcile import reconcile
+import publishing
+import rollover
+import idempotency
+from replica import read_only
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
+idempotency.init_app(api_bp)
+
+MAX_PAGE_SIZE = 1000
 
 
 def manager_required():
@@ -66,33 +77,37 @@ def publish_bill():
     family_id = data.get('family_id')
     if not family_id:
         return jsonify({'error': 'family_id required'}), 400
-    bill = Bill(
-        family_id=family_id,
-        created_by=current_user.id,
+    family = Family.query.get_or_404(family_id)
+    bill_id = publishing.publish_bill(
+        family,
+        current_user.id,
+        'New bill available',
+        lambda bill_id: f'Bill #{bill_id} has been published.',
         cycle_month=data.get('cycle_month'),
         total_amount=data.get('total_amount'),
         due_date=datetime.strptime(data['due_date'], '%Y-%m-%d').date() if data.get('due_date') else None,
-        published_at=datetime.utcnow(),
     )
-    db.session.add(bill)
-    db.session.commit()
-    # notify family members
-    family = Family.query.get(family_id)
-    subject = 'New bill available'
-    body = f'Bill #{bill.id} has been published.'
-    for member in family.members:
-        if member.email:
-            try:
-                send_email(member.email, subject, body)
-            except Exception:
-                pass
-        log = NotificationLog(user_id=member.id, bill_id=bill.id, message=subject)
-        db.session.add(log)
-    db.session.commit()
+    return jsonify({'id': bill_id}), 201
 
-    send_event(json.dumps({'amount': float(bill.total_amount or 0)}))
 
-    return jsonify({'id': bill.id}), 201
+@api_bp.route('/bills/rollover', methods=['POST'])
+@login_required
+def rollover_bills():
+    manager_required()
+    data = request.get_json() or {}
+    cycle_month = data.get('cycle_month') or datetime.utcnow().month
+    family_id = data.get('family_id')
+    # bool is an int too, but never a month or an id
+    if type(cycle_month) is not int:
+        return jsonify({'error': 'cycle_month must be an integer'}), 400
+    if family_id is not None and type(family_id) is not int:
+        return jsonify({'error': 'family_id must be an integer'}), 400
+    try:
+        due_date = datetime.strptime(data['due_date'], '%Y-%m-%d').date() if data.get('due_date') else None
+        report = rollover.rollover(cycle_month, family_id, due_date, current_user.id)
+    except (TypeError, ValueError) as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify(report)
 
 
 @api_bp.route('/bills/<int:bill_id>/items', methods=['POST'])
@@ -115,34 +130,153 @@ def add_surcharge(bill_id):
     db.session.add(item)
     db.session.commit()
 
-    send_event(json.dumps({'amount': float(bill.total_amount or 0)}))
+    publishing.announce(bill.id, bill.family_id, float(bill.total_amount or 0))
     return jsonify({'id': item.id}), 201
 
 
+@api_bp.route('/bills/<int:bill_id>/items/bulk', methods=['POST'])
+@login_required
+def bulk_add_items(bill_id):
+    manager_required()
+    bill = Bill.query.get_or_404(bill_id)
+    if request.mimetype in NDJSON_TYPES:
+        rows = parse_ndjson(request.stream)
+    elif request.mimetype in CSV_TYPES:
+        rows = parse_csv(request.stream)
+    else:
+        return jsonify({'error': 'Content-Type must be application/x-ndjson or text/csv'}), 415
+    report = ingest_items(bill, rows)
+    db.session.commit()
+
+    if report['inserted']:
+        publishing.announce(bill.id, bill.family_id, float(bill.total_amount or 0))
+    return jsonify(report), 201 if report['inserted'] else 400
+
+
 @api_bp.route('/bills/<int:bill_id>', methods=['GET'])
+@read_only
 @login_required
 def bill_info(bill_id):
-    bill = Bill.query.get_or_404(bill_id)
-    items = [
-        {
-            'id': item.id,
-            'description': item.description,
-            'amount': float(item.amount) if item.amount is not None else None,
-            'user_id': item.user_id,
-        }
-        for item in bill.items
-    ]
-    return jsonify(
-        {
+    bill = Bill.query.options(raiseload('*')).get_or_404(bill_id)
+    limit = request.args.get('limit', type=int)
+    after = request.args.get('after', 0, type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    # the version changes with every item or payment write, so it identifies
+    # this page of the bill without looking at the item rows
+    etag = f'{bill.id}-{bill.version}' + (f'-{after}-{limit or "all"}' if after or limit else '')
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        # HTTP dates have whole seconds, and a second edit within the second
+        # of the client's Last-Modified would still match it, so only a date
+        # strictly after that second proves the copy is current
+        not_modified = bool(
+            request.if_modified_since
+            and bill.updated_at
+            and bill.updated_at.replace(microsecond=0) < request.if_modified_since.replace(tzinfo=None)
+        )
+    if not_modified:
+        response = current_app.response_class(status=304)
+    else:
+        query = (
+            select(BillItem)
+            .options(
+                load_only(BillItem.id, BillItem.description, BillItem.amount, BillItem.user_id),
+                raiseload('*'),
+            )
+            .where(BillItem.bill_id == bill.id, BillItem.id > after)
+            .order_by(BillItem.id)
+        )
+        if limit:
+            query = query.limit(limit + 1)
+        rows = db.session.scalars(query).all()
+        body = {
             'id': bill.id,
             'family_id': bill.family_id,
             'total_amount': float(bill.total_amount) if bill.total_amount is not None else None,
             'due_date': bill.due_date.isoformat() if bill.due_date else None,
-            'items': items,
+            'version': bill.version,
+            'pdf_url': bill.pdf_url,
+            'items': [
+                {
+                    'id': item.id,
+                    'description': item.description,
+                    'amount': float(item.amount) if item.amount is not None else None,
+                    'user_id': item.user_id,
+                }
+                for item in rows[:limit]
+            ],
         }
+        if limit:
+            body['next_after'] = rows[limit - 1].id if len(rows) > limit else None
+        response = jsonify(body)
+    response.set_etag(etag)
+    if bill.updated_at:
+        response.last_modified = bill.updated_at
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@api_bp.route('/bills/<int:bill_id>/statement/<digest>.pdf', methods=['GET'])
+@login_required
+def bill_statement(bill_id, digest):
+    bill = Bill.query.options(raiseload('*')).get_or_404(bill_id)
+    if current_user.role != 'manager' and current_user.family_id != bill.family_id:
+        abort(403)
+    if len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+        abort(404)
+    path = statements.cache_path(digest)
+    if not os.path.exists(path):
+        if not bill.pdf_url or not bill.pdf_url.endswith(f'/{digest}.pdf'):
+            abort(404)
+        # the current statement was evicted from the cache; render it again
+        statements.schedule(bill.id)
+        response = jsonify({'error': 'Statement is being rendered'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    # the digest names the content, so the file behind this URL never changes
+    return send_file(
+        path,
+        mimetype='application/pdf',
+        download_name=f'bill-{bill.id}.pdf',
+        conditional=True,
+        etag=digest,
+        max_age=365 * 24 * 3600,
     )
 
 
+@api_bp.route('/families/<int:family_id>/ledger', methods=['GET'])
+@read_only
+@login_required
+def family_ledger(family_id):
+    manager_required()
+    family = Family.query.get_or_404(family_id)
+    since = request.args.get('since')
+    if since:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            return jsonify({'error': 'since must be an ISO date'}), 400
+    fmt = request.args.get('format')
+    if fmt is None:
+        best = request.accept_mimetypes.best_match(['application/x-ndjson', 'text/csv'])
+        fmt = 'csv' if best == 'text/csv' else 'ndjson'
+    if fmt == 'csv':
+        body, mimetype = ledger.encode_csv(ledger.ledger_rows(family.id, since)), 'text/csv'
+    elif fmt == 'ndjson':
+        body, mimetype = ledger.encode_ndjson(ledger.ledger_rows(family.id, since)), 'application/x-ndjson'
+    else:
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+    response = current_app.response_class(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=family-{family.id}-ledger.{fmt}'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
 @api_bp.route('/items/<int:item_id>/payments', methods=['POST'])
 @login_required
 def record_payment(item_id):
@@ -153,10 +287,29 @@ def record_payment(item_id):
         return jsonify({'error': 'amount required'}), 400
     payment = Payment(bill_item_id=item.id, user_id=current_user.id, amount=amount, paid_at=datetime.utcnow())
     db.session.add(payment)
+    # the flush adds the amount to item.paid_total and sets paid_at in one
+    # atomic UPDATE (balances.apply_payments), so concurrent payments can't race
     db.session.flush()
-    total = db.session.query(func.coalesce(func.sum(Payment.amount), 0)).filter_by(bill_item_id=item.id).scalar()
-    if item.amount is not None and total >= float(item.amount) and item.paid_at is None:
-        item.paid_at = datetime.utcnow()
+    body = {
+        'id': payment.id,
+        'paid_total': float(item.paid_total),
+        'paid_at': item.paid_at.isoformat() if item.paid_at else None,
+    }
     db.session.commit()
-    return jsonify({'id': payment.id}), 201
+    return jsonify(body), 201
 
+
+@api_bp.route('/payments/reconcile', methods=['POST'])
+@login_required
+def reconcile_payments():
+    manager_required()
+    if request.mimetype not in CSV_TYPES:
+        return jsonify({'error': 'Content-Type must be text/csv'}), 415
+    family_id = request.args.get('family_id', type=int)
+    dry_run = request.args.get('dry_run') in ('1', 'true')
+    report = reconcile(parse_csv(request.stream), family_id, dry_run)
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    return jsonify(report)
@@ -1,5 +1,6 @@
+import hmac
 import os
-import json
+import tempfile
 from flask import (
     Flask,
     render_template,
@@ -8,7 +9,7 @@ from flask import (
     url_for,
     abort,
     Response,
-    stream_with_context,
+    jsonify,
 )
 from flask_migrate import Migrate, upgrade
 from flask_login import (
@@ -18,13 +19,23 @@ from flask_login import (
     login_required,
     current_user,
 )
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
-from models import db, User, Invitation, Family, Bill, BillItem, NotificationLog
-from sqlalchemy import func
+from models import db, User, Invitation, Family, Bill, MemberBalance
 from api import api_bp
-from events import add_listener, remove_listener, send_event
-from mailer import send_email
+from balances import balances_cli
+from seed import seed_command
+from rollover import bills_cli
+from reminders import reminders_cli
+from idempotency import idempotency_cli
+from reconcile import payments_cli
+from events import add_listener, stream as event_stream
+from publishing import publish_bill
+from identity import load_identity
+from dbpool import engine_options, pool_stats
+import replica
+import metrics
+import sqltrace
+from passwords import hash_password, needs_rehash, verify_password
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "dev-secret")
@@ -32,6 +43,34 @@ app.secret_key = os.getenv("SECRET_KEY", "dev-secret")
 # Database configuration
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///app.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+# Optional read replica for read-only views, and how long a user who wrote stays on the primary
+app.config['SQLALCHEMY_BINDS'] = replica.binds(os.getenv('DATABASE_REPLICA_URL'))
+app.config['REPLICA_STICKY_SECONDS'] = float(os.getenv('REPLICA_STICKY_SECONDS', '5'))
+# Log every request's SQL statements and likely N+1 patterns (always on in debug mode)
+app.config['SQLTRACE'] = os.getenv('SQLTRACE', '').lower() in ('1', 'true', 'yes')
+# Token for the operations endpoints under /internal; they 404 when unset
+app.config['INTERNAL_API_TOKEN'] = os.getenv('INTERNAL_API_TOKEN')
+
+# Idempotency-Key on API writes: how long responses are kept, how long a
+# duplicate waits for the first request, and when an unfinished claim is abandoned
+app.config['IDEMPOTENCY_TTL'] = int(os.getenv('IDEMPOTENCY_TTL', str(24 * 3600)))
+app.config['IDEMPOTENCY_WAIT'] = float(os.getenv('IDEMPOTENCY_WAIT', '5'))
+app.config['IDEMPOTENCY_LOCK_TIMEOUT'] = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', '300'))
+
+# Server-Sent Events: heartbeat interval and optional maximum stream length
+app.config['SSE_HEARTBEAT'] = float(os.getenv('SSE_HEARTBEAT', '15'))
+app.config['SSE_MAX_DURATION'] = float(os.getenv('SSE_MAX_DURATION', '0'))
+app.config['SSE_RETRY'] = float(os.getenv('SSE_RETRY', '2'))
+
+# Bill statements: background rendering and the on-disk PDF cache
+app.config['STATEMENT_RENDERING'] = os.getenv('STATEMENT_RENDERING', 'background')
+app.config['STATEMENT_WORKERS'] = int(os.getenv('STATEMENT_WORKERS', '2'))
+app.config['STATEMENT_CACHE_DIR'] = os.getenv(
+    'STATEMENT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'familyphonepay-statements')
+)
+app.config['STATEMENT_CACHE_MAX_BYTES'] = int(os.getenv('STATEMENT_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+app.config['STATEMENT_EVICT_INTERVAL'] = int(os.getenv('STATEMENT_EVICT_INTERVAL', '60'))
 
 # Initialize extensions
 db.init_app(app)
@@ -41,11 +80,20 @@ login_manager.login_view = 'signin'
 
 
 app.register_blueprint(api_bp)
+replica.init_app(app)
+metrics.init_app(app)
+sqltrace.init_app(app)
+app.cli.add_command(balances_cli)
+app.cli.add_command(payments_cli)
+app.cli.add_command(seed_command)
+app.cli.add_command(bills_cli)
+app.cli.add_command(reminders_cli)
+app.cli.add_command(idempotency_cli)
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return load_identity(int(user_id))
 
 
 @app.route('/')
@@ -68,7 +116,7 @@ def register():
         else:
             user = User(
                 username=username,
-                password_hash=generate_password_hash(password),
+                password_hash=hash_password(password),
                 role='user',
             )
             db.session.add(user)
@@ -92,7 +140,7 @@ def accept_invite(token):
         else:
             user = User(
                 username=username,
-                password_hash=generate_password_hash(password),
+                password_hash=hash_password(password),
                 email=invite.email,
                 role='user',
                 family_id=invite.family_id,
@@ -111,51 +159,69 @@ def signin():
         username = request.form.get('username')
         password = request.form.get('password')
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password_hash, password):
+        if user and verify_password(user.password_hash, password):
+            if needs_rehash(user.password_hash):
+                user.password_hash = hash_password(password)
+                db.session.commit()
             login_user(user)
             return redirect(url_for('dashboard'))
         error = 'Invalid username or password.'
     return render_template('signin.html', error=error)
 
 @app.route('/dashboard')
+@replica.read_only
 @login_required
 def dashboard():
     bill_amount = None
     if current_user.family_id:
-        bill = (
-            Bill.query.filter_by(family_id=current_user.family_id)
+        # latest published bill joined to this member's maintained balance row
+        row = (
+            db.session.query(Bill.id, MemberBalance.amount_owed)
+            .outerjoin(
+                MemberBalance,
+                (MemberBalance.bill_id == Bill.id) & (MemberBalance.user_id == current_user.id),
+            )
+            .filter(Bill.family_id == current_user.family_id)
             .filter(Bill.published_at.isnot(None))
             .order_by(Bill.published_at.desc())
             .first()
         )
-        if bill:
-            bill_amount = db.session.query(
-                func.coalesce(func.sum(BillItem.amount), 0)
-            ).filter_by(bill_id=bill.id, user_id=current_user.id).scalar()
-            bill_amount = float(bill_amount or 0)
+        if row:
+            bill_amount = float(row.amount_owed or 0)
     return render_template('dashboard.html', bill=bill_amount)
 
 
 @app.route('/events')
 @login_required
 def sse_events():
-    q = add_listener()
-
-    def stream(q):
-        try:
-            # send a single keep-alive event so tests return immediately
-            data = None
-            try:
-                data = q.get_nowait()
-            except Exception:
-                pass
-            yield f"data: {data if data is not None else ''}\n\n"
-        finally:
-            remove_listener(q)
-
-    return Response(stream_with_context(stream(q)), mimetype="text/event-stream")
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    family_id, user_id = current_user.family_id, current_user.id
+    # The stream only needs the ids captured above, so hand the database
+    # connection back before the response starts instead of holding it for
+    # the lifetime of the connection.
+    db.session.remove()
+
+    def generate():
+        # registered only once the stream starts, so a client that leaves
+        # before the first chunk leaves no queue behind
+        q = add_listener(family_id, user_id)
+        yield from event_stream(
+            q, app.config['SSE_HEARTBEAT'], app.config['SSE_MAX_DURATION'], last_event_id,
+            app.config['SSE_RETRY'],
+        )
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
 
 @app.route('/profile')
+@replica.read_only
 @login_required
 def profile():
     return render_template('profile.html')
@@ -189,36 +255,16 @@ def add_item():
                 error = 'At least one amount is required.'
 
         if not error:
-            bill = Bill(
-                family_id=family.id,
-                created_by=current_user.id,
+            publish_bill(
+                family,
+                current_user.id,
+                'New bill item added',
+                description,
+                items=amounts,
+                description=description,
+                recipients=[m for m in members if m.id in amounts],
                 total_amount=total,
-                published_at=datetime.utcnow(),
             )
-            db.session.add(bill)
-            db.session.commit()
-            for uid, amt in amounts.items():
-                item = BillItem(
-                    bill_id=bill.id,
-                    user_id=uid,
-                    description=description,
-                    amount=amt,
-                )
-                db.session.add(item)
-            db.session.commit()
-            subject = 'New bill item added'
-            for uid in amounts:
-                member = User.query.get(uid)
-                if member.email:
-                    try:
-                        send_email(member.email, subject, description)
-                    except Exception:
-                        pass
-                db.session.add(
-                    NotificationLog(user_id=member.id, bill_id=bill.id, message=subject)
-                )
-            db.session.commit()
-            send_event(json.dumps({'amount': float(total)}))
             return redirect(url_for('dashboard'))
     return render_template('add_item.html', error=error, members=members)
 
@@ -240,6 +286,30 @@ def signout():
 def handle_bad_request(e):
     return render_template("400.html", message=getattr(e, "description", "Bad Request")), 400
 
+def internal_token_required():
+    token = app.config['INTERNAL_API_TOKEN']
+    given = request.headers.get('X-Internal-Token', '')
+    if not given and request.authorization and request.authorization.type == 'bearer':
+        given = request.authorization.token or ''
+    if not token or not hmac.compare_digest(given.encode(), token.encode()):
+        abort(404)
+
+
+@app.route('/internal/pool')
+def internal_pool():
+    internal_token_required()
+    stats = pool_stats(db.engine)
+    if replica.BIND_KEY in db.engines:
+        stats['replica'] = pool_stats(db.engines[replica.BIND_KEY])
+    return jsonify(stats)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    internal_token_required()
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/run-migrations')
 def run_migrations():
     upgrade()
@@ -0,0 +1,353 @@
+"""Maintenance of the denormalized ``member_balance`` table and ``BillItem.paid_total``.
+
+Every flush that adds, changes or deletes a ``BillItem`` or ``Payment``
+applies the matching deltas to ``member_balance`` and to the items'
+``paid_total`` in the same transaction. Code that writes items or payments
+with Core statements (bulk inserts) bypasses the ORM and must call
+``apply_deltas`` and ``apply_payments``, or ``rebuild``, itself.
+"""
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from decimal import Decimal
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import and_, bindparam, case, event, func, inspect, null, select, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+
+from models import db, BillItem, MemberBalance, Payment
+
+balances_cli = AppGroup('balances', help='Maintain the member balance table.')
+
+_table = MemberBalance.__table__
+_items = BillItem.__table__
+
+# an item counts as paid once its payments are within half a cent of the amount
+PAID_TOLERANCE = Decimal('0.005')
+
+# ``item_id`` is set, and ``stored``/``expected`` are paid totals, when an
+# item's paid_total drifted; otherwise they are a balance's (owed, paid)
+Drift = namedtuple('Drift', 'bill_id user_id item_id stored expected')
+
+
+def _dec(value):
+    return Decimal(str(value)) if value is not None else Decimal(0)
+
+
+def apply_deltas(conn, deltas):
+    """Add owed/paid deltas to ``member_balance`` rows, creating them as needed.
+
+    ``deltas`` maps ``(bill_id, user_id)`` to ``(owed_delta, paid_delta)``.
+    """
+    rows = [
+        {
+            'bill_id': bill_id,
+            'user_id': user_id,
+            'amount_owed': owed,
+            'amount_paid': paid,
+            'outstanding': owed - paid,
+        }
+        for (bill_id, user_id), (owed, paid) in deltas.items()
+        if bill_id is not None and user_id is not None and (owed or paid)
+    ]
+    if not rows:
+        return
+    dialect = {'sqlite': sqlite, 'postgresql': postgresql}.get(conn.dialect.name)
+    if dialect is not None:
+        stmt = dialect.insert(_table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[_table.c.bill_id, _table.c.user_id],
+            set_={
+                col: _table.c[col] + stmt.excluded[col]
+                for col in ('amount_owed', 'amount_paid', 'outstanding')
+            },
+        )
+        conn.execute(stmt, rows)
+        return
+    for row in rows:
+        result = conn.execute(
+            _table.update()
+            .where(_table.c.bill_id == row['bill_id'], _table.c.user_id == row['user_id'])
+            .values(
+                amount_owed=_table.c.amount_owed + row['amount_owed'],
+                amount_paid=_table.c.amount_paid + row['amount_paid'],
+                outstanding=_table.c.outstanding + row['outstanding'],
+            )
+        )
+        if result.rowcount == 0:
+            conn.execute(_table.insert(), [row])
+
+
+def _paid_update():
+    delta = bindparam('delta', type_=_items.c.paid_total.type)
+    # SET expressions see the row as it was before the update, so this is
+    # the new total; the row lock makes concurrent increments queue up
+    total = _items.c.paid_total + delta
+    return (
+        _items.update()
+        .where(_items.c.id == bindparam('item_id'))
+        .values(
+            paid_total=total,
+            paid_at=case(
+                (
+                    total >= _items.c.amount - PAID_TOLERANCE,
+                    func.coalesce(_items.c.paid_at, bindparam('now', type_=_items.c.paid_at.type)),
+                ),
+                (delta < 0, null()),
+                else_=_items.c.paid_at,
+            ),
+        )
+    )
+
+
+def apply_payments(conn, deltas, now=None, returning=False):
+    """Add payment ``deltas`` (``{bill_item_id: amount}``) to the items' ``paid_total``.
+
+    Each item is changed by one atomic UPDATE that also sets ``paid_at`` when
+    the item becomes fully paid, and clears it when a removed payment leaves
+    the item short. With ``returning``, returns ``{item_id: (paid_total,
+    paid_at)}`` for the changed items.
+    """
+    now = now or datetime.utcnow()
+    rows = [
+        {'item_id': item_id, 'delta': delta, 'now': now}
+        for item_id, delta in deltas.items()
+        if item_id is not None and delta
+    ]
+    if not rows:
+        return {}
+    stmt = _paid_update()
+    if not returning:
+        conn.execute(stmt, rows)
+        return {}
+    if not conn.dialect.update_returning:
+        conn.execute(stmt, rows)
+        return {
+            row.id: (row.paid_total, row.paid_at)
+            for row in conn.execute(
+                select(_items.c.id, _items.c.paid_total, _items.c.paid_at)
+                .where(_items.c.id.in_([row['item_id'] for row in rows]))
+            )
+        }
+    stmt = stmt.returning(_items.c.paid_total, _items.c.paid_at)
+    result = {}
+    for row in rows:
+        returned = conn.execute(stmt, row).one_or_none()
+        if returned is not None:
+            result[row['item_id']] = tuple(returned)
+    return result
+
+
+def _old_and_new(obj, attrs):
+    """Return the (old, new) values of ``attrs`` for a flushed object."""
+    state = inspect(obj)
+    old, new = [], []
+    for attr in attrs:
+        hist = state.attrs[attr].history
+        current = getattr(obj, attr)
+        new.append(current)
+        old.append(hist.deleted[0] if hist.deleted else current)
+    return tuple(old), tuple(new)
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_balances(session, flush_context):
+    deltas = defaultdict(lambda: [Decimal(0), Decimal(0)])
+    payments = []  # (bill_item_id, amount delta)
+
+    for obj in session.new:
+        if isinstance(obj, BillItem):
+            deltas[(obj.bill_id, obj.user_id)][0] += _dec(obj.amount)
+        elif isinstance(obj, Payment):
+            payments.append((obj.bill_item_id, _dec(obj.amount)))
+    for obj in session.dirty:
+        if isinstance(obj, BillItem):
+            (bill_id, user_id, amount), new = _old_and_new(obj, ('bill_id', 'user_id', 'amount'))
+            if (bill_id, user_id, amount) != new:
+                deltas[(bill_id, user_id)][0] -= _dec(amount)
+                deltas[new[:2]][0] += _dec(new[2])
+        elif isinstance(obj, Payment):
+            (item_id, amount), new = _old_and_new(obj, ('bill_item_id', 'amount'))
+            if (item_id, amount) != new:
+                payments.append((item_id, -_dec(amount)))
+                payments.append((new[0], _dec(new[1])))
+    for obj in session.deleted:
+        if isinstance(obj, BillItem):
+            deltas[(obj.bill_id, obj.user_id)][0] -= _dec(obj.amount)
+        elif isinstance(obj, Payment):
+            payments.append((obj.bill_item_id, -_dec(obj.amount)))
+
+    if not deltas and not payments:
+        return
+    conn = session.connection()
+    if payments:
+        paid = defaultdict(Decimal)
+        for item_id, amount in payments:
+            paid[item_id] += amount
+        # keep loaded items in step without expiring them
+        for item_id, values in apply_payments(conn, paid, returning=True).items():
+            item = session.identity_map.get(identity_key(BillItem, item_id))
+            if item is not None:
+                set_committed_value(item, 'paid_total', values[0])
+                set_committed_value(item, 'paid_at', values[1])
+        ids = {item_id for item_id, _ in payments}
+        owners = dict(
+            (row.id, (row.bill_id, row.user_id))
+            for row in conn.execute(
+                select(BillItem.id, BillItem.bill_id, BillItem.user_id).where(BillItem.id.in_(ids))
+            )
+        )
+        for item_id, amount in payments:
+            if item_id in owners:
+                deltas[owners[item_id]][1] += amount
+    if deltas:
+        apply_deltas(conn, {key: tuple(value) for key, value in deltas.items()})
+
+
+def _expected(bill_ids=None):
+    """Select the balances recomputed from bill_item and payment."""
+    owed = (
+        select(
+            BillItem.bill_id,
+            BillItem.user_id,
+            func.sum(BillItem.amount).label('owed'),
+        )
+        .where(BillItem.user_id.isnot(None))
+        .group_by(BillItem.bill_id, BillItem.user_id)
+    )
+    paid = (
+        select(
+            BillItem.bill_id,
+            BillItem.user_id,
+            func.sum(Payment.amount).label('paid'),
+        )
+        .join(Payment, Payment.bill_item_id == BillItem.id)
+        .where(BillItem.user_id.isnot(None))
+        .group_by(BillItem.bill_id, BillItem.user_id)
+    )
+    if bill_ids is not None:
+        owed = owed.where(BillItem.bill_id.in_(bill_ids))
+        paid = paid.where(BillItem.bill_id.in_(bill_ids))
+    owed = owed.subquery()
+    paid = paid.subquery()
+    paid_amount = func.coalesce(paid.c.paid, 0)
+    return select(
+        owed.c.bill_id,
+        owed.c.user_id,
+        func.coalesce(owed.c.owed, 0).label('amount_owed'),
+        paid_amount.label('amount_paid'),
+        (func.coalesce(owed.c.owed, 0) - paid_amount).label('outstanding'),
+    ).outerjoin(
+        paid, and_(paid.c.bill_id == owed.c.bill_id, paid.c.user_id == owed.c.user_id)
+    )
+
+
+def rebuild(conn, bill_ids=None):
+    """Recompute balances and paid totals from scratch for all bills or just ``bill_ids``."""
+    paid_total = (
+        select(func.coalesce(func.sum(Payment.amount), 0))
+        .where(Payment.bill_item_id == _items.c.id)
+        .scalar_subquery()
+    )
+    update = _items.update().values(paid_total=paid_total)
+    if bill_ids is not None:
+        update = update.where(_items.c.bill_id.in_(bill_ids))
+    conn.execute(update)
+    delete = _table.delete()
+    if bill_ids is not None:
+        delete = delete.where(_table.c.bill_id.in_(bill_ids))
+    conn.execute(delete)
+    expected = _expected(bill_ids)
+    conn.execute(
+        _table.insert().from_select(
+            ['bill_id', 'user_id', 'amount_owed', 'amount_paid', 'outstanding'], expected
+        )
+    )
+
+
+def verify(conn, tolerance=Decimal('0.005')):
+    """Return a ``Drift`` for every drifted balance row and item paid total."""
+    expected = _expected().subquery()
+    stored = _table
+    drift = []
+    differs = or_(
+        stored.c.bill_id.is_(None),
+        func.abs(stored.c.amount_owed - expected.c.amount_owed) > tolerance,
+        func.abs(stored.c.amount_paid - expected.c.amount_paid) > tolerance,
+        func.abs(stored.c.outstanding - expected.c.outstanding) > tolerance,
+    )
+    rows = conn.execute(
+        select(expected, stored.c.amount_owed.label('stored_owed'), stored.c.amount_paid.label('stored_paid'))
+        .outerjoin(
+            stored,
+            and_(stored.c.bill_id == expected.c.bill_id, stored.c.user_id == expected.c.user_id),
+        )
+        .where(differs)
+    )
+    for row in rows:
+        drift.append(Drift(
+            row.bill_id,
+            row.user_id,
+            None,
+            (row.stored_owed, row.stored_paid),
+            (row.amount_owed, row.amount_paid),
+        ))
+    orphans = conn.execute(
+        select(stored.c.bill_id, stored.c.user_id, stored.c.amount_owed, stored.c.amount_paid)
+        .outerjoin(
+            expected,
+            and_(stored.c.bill_id == expected.c.bill_id, stored.c.user_id == expected.c.user_id),
+        )
+        .where(expected.c.bill_id.is_(None))
+        .where(or_(stored.c.amount_owed != 0, stored.c.amount_paid != 0))
+    )
+    for row in orphans:
+        drift.append(Drift(row.bill_id, row.user_id, None, (row.amount_owed, row.amount_paid), (0, 0)))
+    paid = (
+        select(Payment.bill_item_id, func.sum(Payment.amount).label('amount'))
+        .group_by(Payment.bill_item_id)
+        .subquery()
+    )
+    expected_paid = func.coalesce(paid.c.amount, 0)
+    items = conn.execute(
+        select(_items.c.bill_id, _items.c.user_id, _items.c.id, _items.c.paid_total, expected_paid.label('expected'))
+        .outerjoin(paid, paid.c.bill_item_id == _items.c.id)
+        .where(func.abs(_items.c.paid_total - expected_paid) > tolerance)
+        .order_by(_items.c.id)
+    )
+    for row in items:
+        drift.append(Drift(row.bill_id, row.user_id, row.id, row.paid_total, row.expected))
+    return drift
+
+
+@balances_cli.command('rebuild')
+@click.option('--bill-id', 'bill_ids', type=int, multiple=True, help='Only rebuild these bills.')
+def rebuild_command(bill_ids):
+    """Recompute member balances from bill items and payments."""
+    rebuild(db.session.connection(), list(bill_ids) or None)
+    db.session.commit()
+    click.echo('Member balances rebuilt.')
+
+
+@balances_cli.command('verify')
+@click.option('--fix', is_flag=True, help='Rebuild the bills that drifted.')
+def verify_command(fix):
+    """Report member balances and paid totals that differ from bill items and payments."""
+    conn = db.session.connection()
+    drift = verify(conn)
+    for row in drift:
+        if row.item_id is None:
+            click.echo(f'bill {row.bill_id} user {row.user_id}: stored owed/paid {row.stored}, expected {row.expected}')
+        else:
+            click.echo(f'bill {row.bill_id} item {row.item_id}: stored paid_total {row.stored}, expected {row.expected}')
+    if drift and fix:
+        rebuild(conn, sorted({row.bill_id for row in drift}))
+        db.session.commit()
+        click.echo(f'Rebuilt {len(drift)} drifted balances.')
+    elif not drift:
+        click.echo('Member balances are consistent.')
+    else:
+        raise SystemExit(1)
@@ -0,0 +1,74 @@
+"""Report logins per second per core for each password hashing setting.
+
+Usage::
+
+    python -m bench.auth_throughput --methods scrypt:32768:8:1 pbkdf2:sha256:600000
+
+For every method the script times password verification alone, spread
+over ``--processes`` worker processes (default: one per core), and a full
+``POST /signin`` through the test client in this process. Both figures
+are divided by the number of cores doing the work.
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_METHODS = [
+    'scrypt:32768:8:1',
+    'scrypt:16384:8:1',
+    'pbkdf2:sha256:1000000',
+    'pbkdf2:sha256:600000',
+]
+
+
+def _verify_many(pwhash, count):
+    from werkzeug.security import check_password_hash
+    for _ in range(count):
+        check_password_hash(pwhash, 'bench-password')
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--methods', nargs='+', default=DEFAULT_METHODS)
+    parser.add_argument('--logins', type=int, default=50, help='Verifications per process.')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='auth-bench-'), 'app.db')}"
+    from app import app
+    from models import db, User
+    import passwords
+
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(username='bench'))
+        db.session.commit()
+
+    print(f"{'method':<24} {'verify/s/core':>14} {'signin/s':>10}")
+    with ProcessPoolExecutor(args.processes) as pool:
+        for method in args.methods:
+            pwhash = passwords.hash_password('bench-password', method)
+            start = time.perf_counter()
+            done = sum(pool.map(_verify_many, [pwhash] * args.processes, [args.logins] * args.processes))
+            per_core = done / (time.perf_counter() - start) / args.processes
+
+            passwords.METHOD = method
+            with app.app_context():
+                User.query.filter_by(username='bench').update({'password_hash': pwhash})
+                db.session.commit()
+            client = app.test_client()
+            start = time.perf_counter()
+            for _ in range(args.logins):
+                rv = client.post('/signin', data={'username': 'bench', 'password': 'bench-password'})
+                assert rv.status_code == 302, rv.status_code
+                client.get('/signout')
+            signins = args.logins / (time.perf_counter() - start)
+            print(f'{method:<24} {per_core:>14.1f} {signins:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Compare two bench.suite result files and flag latency regressions.
+
+Usage::
+
+    python -m bench.compare baseline.json candidate.json --threshold 10
+
+Prints the p50/p95/p99 change of every scenario and driver present in
+both files and exits with status 1 if any p95 grew by more than
+``--threshold`` percent.
+"""
+import argparse
+import json
+import sys
+
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps')
+
+
+def change(old, new):
+    if not old:
+        return None
+    return (new - old) / old * 100
+
+
+def compare(baseline, candidate, threshold):
+    """Return the table rows and the regressions of ``candidate`` against ``baseline``."""
+    rows, regressions = [], []
+    for name, drivers in candidate['results'].items():
+        for driver, result in drivers.items():
+            old = baseline['results'].get(name, {}).get(driver)
+            if not old:
+                continue
+            cells = []
+            for metric in METRICS:
+                delta = change(old.get(metric), result.get(metric))
+                cells.append((old.get(metric), result.get(metric), delta))
+            rows.append((name, driver, cells))
+            p95 = cells[1][2]
+            if p95 is not None and p95 > threshold:
+                regressions.append((name, driver, p95))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Allowed p95 growth in percent.')
+    args = parser.parse_args()
+
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+    with open(args.candidate) as fh:
+        candidate = json.load(fh)
+    for label, report in (('baseline', baseline), ('candidate', candidate)):
+        meta = report.get('meta', {})
+        print(f"{label}: commit {meta.get('commit')} on {meta.get('database')}, {meta.get('params')}")
+
+    rows, regressions = compare(baseline, candidate, args.threshold)
+    print(f"{'scenario':<16} {'driver':<12} " + ' '.join(f'{m:>26}' for m in METRICS))
+    for name, driver, cells in rows:
+        text = []
+        for old, new, delta in cells:
+            pct = f'{delta:+.1f}%' if delta is not None else 'n/a'
+            text.append(f'{old or 0:.1f} -> {new or 0:.1f} ({pct})'.rjust(26))
+        print(f'{name:<16} {driver:<12} ' + ' '.join(text))
+    for name, driver, delta in regressions:
+        print(f'REGRESSION {name} ({driver}): p95 {delta:+.1f}%')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Show /dashboard latency as the number of bill items grows.
+
+Usage::
+
+    python -m bench.dashboard_latency --items 10 100 1000 10000 100000
+
+For each size a fresh published bill gets that many items for one member.
+The script times ``GET /dashboard`` (which reads ``member_balance``) next
+to the ``SUM(bill_item.amount)`` query it replaced.
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='dashboard-bench-'), 'app.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+    from sqlalchemy import func
+    from werkzeug.security import generate_password_hash
+    from app import app
+    from balances import rebuild
+    from models import db, Bill, BillItem, Family, User
+
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        family = Family(name='Bench')
+        user = User(username='bench', password_hash=generate_password_hash('bench'), family=family)
+        db.session.add_all([family, user])
+        db.session.commit()
+        family_id, user_id = family.id, user.id
+
+    client = app.test_client()
+    client.post('/signin', data={'username': 'bench', 'password': 'bench'})
+    published = datetime.utcnow()
+    print(f"{'items':>8} {'dashboard p50':>14} {'dashboard p95':>14} {'SUM query p50':>14}")
+    for n in args.items:
+        published += timedelta(seconds=1)
+        with app.app_context():
+            bill = Bill(family_id=family_id, created_by=user_id, published_at=published)
+            db.session.add(bill)
+            db.session.flush()
+            db.session.execute(
+                BillItem.__table__.insert(),
+                [{'bill_id': bill.id, 'user_id': user_id, 'description': 'line', 'amount': 1}] * n,
+            )
+            rebuild(db.session.connection(), [bill.id])
+            db.session.commit()
+            bill_id = bill.id
+
+        timings = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            client.get('/dashboard')
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+
+        with app.app_context():
+            sums = []
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                db.session.query(func.coalesce(func.sum(BillItem.amount), 0)).filter_by(
+                    bill_id=bill_id, user_id=user_id
+                ).scalar()
+                sums.append(time.perf_counter() - start)
+            sums.sort()
+
+        def ms(values, pct):
+            return f'{values[int(len(values) * pct / 100)] * 1000:12.3f}ms'
+
+        print(f'{n:>8} {ms(timings, 50)} {ms(timings, 95)} {ms(sums, 50)}')
+
+
+if __name__ == '__main__':
+    main()
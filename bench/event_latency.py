@@ -0,0 +1,100 @@
+"""Measure cross-process SSE event delivery latency through a broker.
+
+Usage::
+
+    python -m bench.event_latency --backend unix --subscribers 4 --messages 500
+    python -m bench.event_latency --backend postgres --url postgresql://...
+
+Each subscriber process stands in for a gunicorn worker; the parent
+publishes timestamped messages and every subscriber reports how long each
+one took to arrive.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from brokers import create_broker, PostgresBroker, UnixSocketBroker
+
+
+def make_broker(backend, url, directory):
+    if backend == 'unix':
+        return UnixSocketBroker(directory)
+    if backend == 'postgres':
+        return PostgresBroker(url)
+    return create_broker(backend, url)
+
+
+def subscriber(backend, url, directory, expected, ready, results):
+    latencies = []
+    done = multiprocessing.Event()
+
+    def handler(message):
+        latencies.append(time.time() - json.loads(message['data'])['sent'])
+        if len(latencies) >= expected:
+            done.set()
+
+    broker = make_broker(backend, url, directory)
+    broker.start(handler)
+    ready.set()
+    done.wait(timeout=60)
+    broker.close()
+    results.put(latencies)
+
+
+def percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=['unix', 'postgres'], default='unix')
+    parser.add_argument('--url', default=os.getenv('DATABASE_URL', ''))
+    parser.add_argument('--subscribers', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--interval-ms', type=float, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='event-bench-')
+    results = multiprocessing.Queue()
+    procs = []
+    for _ in range(args.subscribers):
+        ready = multiprocessing.Event()
+        p = multiprocessing.Process(
+            target=subscriber,
+            args=(args.backend, args.url, directory, args.messages, ready, results),
+        )
+        p.start()
+        ready.wait(timeout=10)
+        procs.append(p)
+
+    publisher = make_broker(args.backend, args.url, directory)
+    start = time.perf_counter()
+    for i in range(args.messages):
+        data = json.dumps({'seq': i, 'sent': time.time()})
+        publisher.publish({'family_id': 1, 'user_id': None, 'data': data})
+        time.sleep(args.interval_ms / 1000.0)
+    elapsed = time.perf_counter() - start
+
+    latencies = []
+    for _ in procs:
+        latencies.extend(results.get(timeout=60))
+    for p in procs:
+        p.join()
+    publisher.close()
+    latencies.sort()
+    delivered = len(latencies)
+    expected = args.messages * args.subscribers
+    print(
+        f'{args.backend}: delivered {delivered}/{expected} '
+        f'publish_rate={args.messages / elapsed:.0f}/s '
+        f'p50={percentile(latencies, 50) * 1000:.3f}ms '
+        f'p95={percentile(latencies, 95) * 1000:.3f}ms '
+        f'p99={percentile(latencies, 99) * 1000:.3f}ms'
+    )
+
+
+if __name__ == '__main__':
+    main()
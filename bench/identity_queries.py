@@ -0,0 +1,61 @@
+"""Count the database queries per request the identity cache saves.
+
+Usage::
+
+    python -m bench.identity_queries [pytest args, default tests/test_api.py]
+
+Runs the test suite twice in-process, once with the identity cache disabled
+and once enabled, and counts the statements executed while a request is
+being handled. The tests share one app context between requests, where
+Flask-Login would keep the loaded user, so the script clears it at the start
+of every request as a separate production request would.
+"""
+import os
+import sys
+
+
+def main():
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+    import pytest
+    from flask import g, has_request_context, request_started
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from app import app
+    import identity
+
+    counts = {'requests': 0, 'queries': 0}
+
+    def on_request(sender, **extra):
+        g.pop('_login_user', None)
+        counts['requests'] += 1
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            counts['queries'] += 1
+
+    request_started.connect(on_request, app)
+    event.listen(Engine, 'before_cursor_execute', on_execute)
+
+    args = sys.argv[1:] or ['tests/test_api.py']
+    results = {}
+    for label, ttl in (('uncached', 0), ('cached', identity.CACHE_TTL)):
+        identity.cache.clear()
+        identity.cache.ttl = ttl
+        identity.cache.hits = identity.cache.misses = 0
+        counts.update(requests=0, queries=0)
+        code = pytest.main(['-q', '-p', 'no:cacheprovider', *args])
+        if code != 0:
+            raise SystemExit(code)
+        results[label] = dict(counts, hits=identity.cache.hits, misses=identity.cache.misses)
+
+    for label, result in results.items():
+        per_request = result['queries'] / result['requests'] if result['requests'] else 0
+        print(f"{label:>9}: {result['requests']} requests, {result['queries']} queries, "
+              f'{per_request:.2f} queries/request')
+    saved = results['uncached']['queries'] - results['cached']['queries']
+    print(f"saved {saved} queries = {saved / max(results['cached']['requests'], 1):.2f} per request, "
+          f"cache hits {results['cached']['hits']}, misses {results['cached']['misses']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Measure the family ledger export in rows per second and peak memory.
+
+Usage::
+
+    python -m bench.ledger_export --rows 1000000 --format csv
+
+Seeds one family with ``--rows`` bill items (plus a payment for every
+tenth item) on a throwaway SQLite database, or on ``--database-url``, then
+streams ``GET /api/families/<id>/ledger`` and discards the body. Peak RSS
+is reported before and after the export, so a flat figure means memory does
+not grow with the number of rows.
+"""
+import argparse
+import os
+import resource
+import tempfile
+import time
+
+CHUNK = 10000
+
+
+def peak_rss_mib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--items-per-bill', type=int, default=1000)
+    parser.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url or (
+        f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='ledger-bench-'), 'app.db')}"
+    )
+    from werkzeug.security import generate_password_hash
+    from app import app
+    from models import db, Bill, BillItem, Family, Payment, User
+
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        family = Family(name='Bench')
+        user = User(
+            username='bench', password_hash=generate_password_hash('bench'),
+            role='manager', family=family,
+        )
+        db.session.add_all([family, user])
+        db.session.commit()
+        family_id, user_id = family.id, user.id
+
+        seeded = 0
+        while seeded < args.rows:
+            bill = Bill(family_id=family_id, created_by=user_id)
+            db.session.add(bill)
+            db.session.flush()
+            count = min(args.items_per_bill, args.rows - seeded)
+            for start in range(0, count, CHUNK):
+                db.session.execute(BillItem.__table__.insert(), [
+                    {'bill_id': bill.id, 'user_id': user_id, 'description': 'line', 'amount': 1}
+                    for _ in range(min(CHUNK, count - start))
+                ])
+            seeded += count
+            db.session.commit()
+        item_ids = [i for (i,) in db.session.query(BillItem.id).filter(BillItem.id % 10 == 0)]
+        for start in range(0, len(item_ids), CHUNK):
+            db.session.execute(Payment.__table__.insert(), [
+                {'bill_item_id': i, 'user_id': user_id, 'amount': 1}
+                for i in item_ids[start:start + CHUNK]
+            ])
+        db.session.commit()
+        del item_ids
+
+    client = app.test_client()
+    client.post('/signin', data={'username': 'bench', 'password': 'bench'})
+    before = peak_rss_mib()
+    start = time.perf_counter()
+    response = client.get(f'/api/families/{family_id}/ledger?format={args.format}', buffered=False)
+    rows = sum(chunk.count(b'\n') for chunk in response.response)
+    response.close()
+    elapsed = time.perf_counter() - start
+    if args.format == 'csv':
+        rows -= 1
+    print(
+        f'{rows} rows in {elapsed:.2f}s = {rows / elapsed:,.0f} rows/s, '
+        f'peak RSS {before:.1f} MiB before export, {peak_rss_mib():.1f} MiB after'
+    )
+
+
+if __name__ == '__main__':
+    main()
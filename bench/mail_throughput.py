@@ -0,0 +1,79 @@
+"""Compare per-recipient ``urlopen`` delivery with the pooled, batched mailer.
+
+Usage::
+
+    python -m bench.mail_throughput --recipients 12 --latency-ms 50
+
+Both strategies talk to a local SendGrid stub, so the numbers reflect round
+trips and connection setup rather than the real API.
+"""
+import argparse
+import json
+import os
+import time
+from urllib import request
+
+from bench.sendgrid_stub import SendGridStub
+from mailer import Mailer
+
+
+def send_serial(url, emails):
+    for email in emails:
+        payload = {
+            "personalizations": [{"to": [{"email": email}]}],
+            "from": {"email": os.environ['EMAIL_FROM']},
+            "subject": 'bench',
+            "content": [{"type": "text/plain", "value": 'bench'}],
+        }
+        req = request.Request(
+            url,
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST',
+        )
+        with request.urlopen(req) as resp:
+            resp.read()
+
+
+def run(label, fn, emails, rounds, stub):
+    stub.requests = stub.recipients = 0
+    stub.connections.clear()
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(emails)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    total = sum(timings)
+    print(
+        f'{label:<10} recipients/s={len(emails) * rounds / total:10.1f} '
+        f'p50={timings[len(timings) // 2] * 1000:8.2f}ms '
+        f'max={timings[-1] * 1000:8.2f}ms '
+        f'requests={stub.requests} connections={len(stub.connections)}'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--recipients', type=int, default=12)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    os.environ.setdefault('SENDGRID_API_KEY', 'bench')
+    os.environ.setdefault('EMAIL_FROM', 'bench@example.com')
+    stub = SendGridStub(latency_ms=args.latency_ms).start()
+    emails = [f'member{i}@example.com' for i in range(args.recipients)]
+    mailer = Mailer(stub.url, workers=args.workers, batch_size=args.batch_size)
+    try:
+        run('serial', lambda e: send_serial(stub.url, e), emails, args.rounds, stub)
+        run('mailer', lambda e: mailer.send(e, 'bench', 'bench'), emails, args.rounds, stub)
+    finally:
+        mailer.close()
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Measure payment reconciliation throughput in payments per second.
+
+Usage::
+
+    python -m bench.reconcile_throughput --payments 50000
+
+Seeds one open item per payment on a throwaway SQLite database, writes a
+matching CSV export (half matched by reference, half by user and amount)
+and reconciles it.
+"""
+import argparse
+import os
+import random
+import tempfile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--payments', type=int, default=50000)
+    parser.add_argument('--members', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='reconcile-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'app.db')}"
+    from app import app
+    from ingest import parse_csv
+    from models import db, Bill, BillItem, Family, User
+    from reconcile import reconcile
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        db.create_all()
+        family = Family(name='Bench')
+        db.session.add(family)
+        db.session.flush()
+        db.session.execute(
+            User.__table__.insert(),
+            [{'username': f'member{i}', 'family_id': family.id} for i in range(args.members)],
+        )
+        user_ids = [u for (u,) in db.session.query(User.id)]
+        bill = Bill(family_id=family.id)
+        db.session.add(bill)
+        db.session.flush()
+        rows = [
+            {
+                'bill_id': bill.id,
+                'user_id': rng.choice(user_ids),
+                'description': 'line',
+                'amount': rng.randint(500, 9000) / 100,
+            }
+            for _ in range(args.payments)
+        ]
+        db.session.execute(BillItem.__table__.insert(), rows)
+        db.session.commit()
+
+        path = os.path.join(workdir, 'payments.csv')
+        with open(path, 'w') as fh:
+            fh.write('user_id,amount,reference\n')
+            for item_id, user_id, amount in db.session.query(BillItem.id, BillItem.user_id, BillItem.amount):
+                reference = f'FPP-{item_id}' if item_id % 2 else ''
+                fh.write(f'{user_id},{amount},{reference}\n')
+
+        with open(path, 'rb') as fh:
+            report = reconcile(parse_csv(fh))
+        db.session.commit()
+    print(
+        f"{report['rows']} payments, {report['matched']} matched, "
+        f"{report['items_paid']} items paid in {report['seconds']}s "
+        f"= {report['payments_per_second']} payments/s"
+    )
+
+
+if __name__ == '__main__':
+    main()
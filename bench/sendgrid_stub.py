@@ -0,0 +1,100 @@
+"""Local stand-in for the SendGrid ``/v3/mail/send`` endpoint.
+
+Run it standalone and point the app at it::
+
+    python -m bench.sendgrid_stub --port 8025 --latency-ms 40
+    SENDGRID_API_URL=http://127.0.0.1:8025/v3/mail/send flask run
+
+The server speaks HTTP/1.1 with keep-alive, answers ``202 Accepted`` like the
+real API, and counts requests and personalizations so benchmarks can check
+how many round trips a delivery took.
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        server = self.server
+        try:
+            payload = json.loads(body)
+            recipients = len(payload.get('personalizations', []))
+        except ValueError:
+            recipients = 0
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+            server.recipients += recipients
+            server.connections.add(self.client_address)
+        if server.disconnect == 'request':
+            # the request arrived but its response is lost
+            self.close_connection = True
+            return
+        status = server.status
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        if server.disconnect == 'idle':
+            # hang up without announcing it, like an idle keep-alive timeout
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SendGridStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0, status=202):
+        super().__init__((host, port), _Handler)
+        self.latency = latency_ms / 1000.0
+        self.status = status
+        # None, 'idle' (close after each response) or 'request' (close
+        # instead of responding)
+        self.disconnect = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.recipients = 0
+        self.connections = set()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v3/mail/send'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--status', type=int, default=202)
+    args = parser.parse_args()
+    stub = SendGridStub(args.host, args.port, args.latency_ms, args.status)
+    print(f'SendGrid stub listening on {stub.url}')
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
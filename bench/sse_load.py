@@ -0,0 +1,165 @@
+"""Open many concurrent ``/events`` streams and measure server memory per stream.
+
+Usage::
+
+    # start a gevent gunicorn on a throwaway SQLite database and test it
+    python -m bench.sse_load --spawn --streams 2000
+
+    # or load an already running server (pass its master or worker pid)
+    python -m bench.sse_load --url http://127.0.0.1:8000 --username alice \\
+        --password pw --pid 12345 --streams 2000
+
+Memory is the resident set size of the server process tree read from
+``/proc``, so the numbers are only available on Linux.
+"""
+import argparse
+import http.client
+import os
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode, urlsplit
+
+
+def rss_kb(pid):
+    """Resident memory of ``pid`` and its children in kilobytes."""
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f'/proc/{current}/status') as fh:
+                for line in fh:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+            with open(f'/proc/{current}/task/{current}/children') as fh:
+                pids.extend(int(p) for p in fh.read().split())
+        except FileNotFoundError:
+            continue
+    return total
+
+
+def login(host, port, username, password):
+    conn = http.client.HTTPConnection(host, port)
+    conn.request(
+        'POST',
+        '/signin',
+        body=urlencode({'username': username, 'password': password}),
+        headers={'Content-Type': 'application/x-www-form-urlencoded'},
+    )
+    resp = conn.getresponse()
+    resp.read()
+    cookie = resp.getheader('Set-Cookie')
+    conn.close()
+    if not cookie:
+        raise SystemExit('login failed')
+    return cookie.split(';', 1)[0]
+
+
+def open_stream(host, port, cookie):
+    sock = socket.create_connection((host, port))
+    request = (
+        f'GET /events HTTP/1.1\r\nHost: {host}\r\nCookie: {cookie}\r\n'
+        'Accept: text/event-stream\r\n\r\n'
+    )
+    sock.sendall(request.encode('ascii'))
+    data = b''
+    while b'retry:' not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError('stream closed')
+        data += chunk
+    if b' 200 ' not in data.split(b'\r\n', 1)[0]:
+        raise ConnectionError(data.split(b'\r\n', 1)[0].decode())
+    return sock
+
+
+def spawn_server(port, heartbeat):
+    db_path = os.path.join(tempfile.mkdtemp(prefix='sse-load-'), 'app.db')
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{db_path}', SSE_HEARTBEAT=str(heartbeat))
+    os.environ['DATABASE_URL'] = env['DATABASE_URL']
+    from werkzeug.security import generate_password_hash
+    from app import app
+    from models import db, User, Family
+
+    with app.app_context():
+        db.create_all()
+        family = Family(name='Load')
+        db.session.add_all([
+            family,
+            User(username='load', password_hash=generate_password_hash('load'), family=family),
+        ])
+        db.session.commit()
+    env.update(PORT=str(port), WEB_CONCURRENCY='1')
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+        env=env,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return proc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--username', default='load')
+    parser.add_argument('--password', default='load')
+    parser.add_argument('--pid', type=int)
+    parser.add_argument('--spawn', action='store_true')
+    parser.add_argument('--streams', type=int, default=1000)
+    parser.add_argument('--heartbeat', type=float, default=5)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.streams + 256)), hard))
+
+    parts = urlsplit(args.url)
+    host, port = parts.hostname, parts.port or 80
+    proc = None
+    if args.spawn:
+        proc = spawn_server(port, args.heartbeat)
+        args.pid = proc.pid
+    try:
+        cookie = login(host, port, args.username, args.password)
+        streams = [open_stream(host, port, cookie)]
+        baseline = rss_kb(args.pid) if args.pid else None
+        start = time.perf_counter()
+        for _ in range(args.streams - 1):
+            streams.append(open_stream(host, port, cookie))
+        opened = time.perf_counter() - start
+        print(f'opened {len(streams)} streams in {opened:.2f}s')
+
+        # wait for one heartbeat round and count streams that are still live
+        selector = selectors.DefaultSelector()
+        for sock in streams:
+            selector.register(sock, selectors.EVENT_READ)
+        alive = set()
+        deadline = time.monotonic() + args.heartbeat * 2
+        while len(alive) < len(streams) and time.monotonic() < deadline:
+            for key, _ in selector.select(timeout=0.5):
+                if key.fileobj.recv(4096):
+                    alive.add(key.fileobj)
+        print(f'{len(alive)} streams delivered a heartbeat')
+
+        if baseline is not None:
+            used = rss_kb(args.pid) - baseline
+            print(f'server RSS grew {used / 1024:.1f} MiB, {used / max(1, len(streams) - 1):.1f} KiB per stream')
+        for sock in streams:
+            sock.close()
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
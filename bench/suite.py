@@ -0,0 +1,262 @@
+"""Latency and throughput of the hot endpoints on a seeded database.
+
+Usage::
+
+    python -m bench.suite --families 200 --members 5 --bills 12 --output bench-results.json
+    python -m bench.suite --database-url postgresql://localhost/fpp_bench --reset
+    python -m bench.compare baseline.json bench-results.json
+
+The database (a throwaway SQLite file unless ``--database-url`` is given)
+is seeded with ``--families`` families of ``--members`` members, each with
+``--bills`` published bills and ``--items`` items per member and bill.
+Every scenario is then driven through the Flask test client, and through
+a real HTTP server with ``--threads`` concurrent clients, and its
+p50/p95/p99 latency and throughput are printed and written as JSON.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from statistics import mean, quantiles
+from urllib.parse import urlencode
+
+PASSWORD = 'bench'
+SCENARIOS = ('dashboard', 'bill_info', 'publish_bill', 'add_item', 'record_payment')
+CHUNK = 5000
+
+
+def seed(db, args):
+    """Fill the database with bulk inserts and return ids the scenarios use."""
+    from werkzeug.security import generate_password_hash
+    from balances import rebuild
+    from models import Bill, BillItem, Family, User
+
+    rng = random.Random(args.seed)
+    conn = db.session.connection()
+    # one cheap hash shared by every account keeps seeding fast
+    pwhash = generate_password_hash(PASSWORD, 'pbkdf2:sha256:1000')
+    now = datetime.utcnow()
+
+    def insert(table, rows):
+        for i in range(0, len(rows), CHUNK):
+            conn.execute(table.insert(), rows[i:i + CHUNK])
+
+    insert(Family.__table__, [{'name': f'Family {f}', 'created_at': now} for f in range(args.families)])
+    family_ids = [f for (f,) in db.session.query(Family.id).order_by(Family.id)]
+    users = [{
+        'username': 'manager', 'email': 'manager@example.com', 'password_hash': pwhash,
+        'role': 'manager', 'family_id': family_ids[0],
+    }]
+    for f in family_ids:
+        users.extend({
+            'username': f'f{f}m{m}', 'email': f'f{f}m{m}@example.com', 'password_hash': pwhash,
+            'role': 'user', 'family_id': f,
+        } for m in range(args.members))
+    insert(User.__table__, users)
+    members = {}
+    for uid, fid in db.session.query(User.id, User.family_id):
+        members.setdefault(fid, []).append(uid)
+
+    bills = []
+    for f in family_ids:
+        bills.extend({
+            'family_id': f, 'cycle_month': b % 12 + 1, 'total_amount': 0,
+            'published_at': now - timedelta(days=30 * (args.bills - b)),
+        } for b in range(args.bills))
+    insert(Bill.__table__, bills)
+    items = []
+    for bill_id, fid in db.session.query(Bill.id, Bill.family_id):
+        for uid in members.get(fid, ()):
+            items.extend({
+                'bill_id': bill_id, 'user_id': uid, 'description': 'Line',
+                'amount': rng.randint(1000, 9000) / 100, 'is_recurring': False,
+            } for _ in range(args.items))
+            if len(items) >= CHUNK:
+                insert(BillItem.__table__, items)
+                items = []
+    insert(BillItem.__table__, items)
+    rebuild(conn)
+    db.session.commit()
+
+    family_id = family_ids[0]
+    return {
+        'family_id': family_id,
+        'members': members[family_id],
+        'bill_ids': [b for (b,) in db.session.query(Bill.id).filter_by(family_id=family_id)],
+        'item_ids': [i for (i,) in db.session.query(BillItem.id).join(Bill).filter(Bill.family_id == family_id)],
+    }
+
+
+def requests_for(name, ids, rng):
+    """Return ``(method, path, body, headers)`` for one request of scenario ``name``."""
+    if name == 'dashboard':
+        return 'GET', '/dashboard', None, {}
+    if name == 'bill_info':
+        return 'GET', f"/api/bills/{rng.choice(ids['bill_ids'])}", None, {}
+    if name == 'publish_bill':
+        body = json.dumps({'family_id': ids['family_id'], 'total_amount': 50})
+        return 'POST', '/api/bills', body, {'Content-Type': 'application/json'}
+    if name == 'add_item':
+        form = {'description': 'Bench item'}
+        form.update({f'amount_{uid}': '5' for uid in ids['members']})
+        return 'POST', '/add-item', urlencode(form), {'Content-Type': 'application/x-www-form-urlencoded'}
+    if name == 'record_payment':
+        body = json.dumps({'amount': 1})
+        return 'POST', f"/api/items/{rng.choice(ids['item_ids'])}/payments", body, {'Content-Type': 'application/json'}
+    raise ValueError(name)
+
+
+def summarize(latencies, elapsed, errors):
+    if len(latencies) < 2:
+        return {'requests': len(latencies), 'errors': errors}
+    cuts = quantiles(latencies, n=100, method='inclusive')
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'mean_ms': round(mean(latencies) * 1000, 3),
+        'p50_ms': round(cuts[49] * 1000, 3),
+        'p95_ms': round(cuts[94] * 1000, 3),
+        'p99_ms': round(cuts[98] * 1000, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+    }
+
+
+def run_test_client(app, name, ids, count, seed_value):
+    client = app.test_client()
+    client.post('/signin', data={'username': 'manager', 'password': PASSWORD})
+    rng = random.Random(seed_value)
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for _ in range(count):
+        method, path, body, headers = requests_for(name, ids, rng)
+        start = time.perf_counter()
+        rv = client.open(path, method=method, data=body, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        errors += rv.status_code >= 400
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+def _login(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/signin', urlencode({'username': 'manager', 'password': PASSWORD}),
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    resp = conn.getresponse()
+    resp.read()
+    return conn, resp.getheader('Set-Cookie').split(';', 1)[0]
+
+
+def run_http(port, name, ids, count, threads, seed_value):
+    def worker(index):
+        conn, cookie = _login(port)
+        rng = random.Random(seed_value + index)
+        latencies, errors = [], 0
+        for _ in range(count // threads):
+            method, path, body, headers = requests_for(name, ids, rng)
+            start = time.perf_counter()
+            conn.request(method, path, body, dict(headers, Cookie=cookie))
+            resp = conn.getresponse()
+            resp.read()
+            latencies.append(time.perf_counter() - start)
+            errors += resp.status >= 400
+        conn.close()
+        return latencies, errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(worker, range(threads)))
+    elapsed = time.perf_counter() - started
+    return summarize([l for lat, _ in results for l in lat], elapsed, sum(e for _, e in results))
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url')
+    parser.add_argument('--reset', action='store_true', help='Drop and recreate the tables first.')
+    parser.add_argument('--families', type=int, default=100)
+    parser.add_argument('--members', type=int, default=5)
+    parser.add_argument('--bills', type=int, default=12)
+    parser.add_argument('--items', type=int, default=2, help='Items per member and bill.')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario and driver.')
+    parser.add_argument('--threads', type=int, default=8, help='Concurrent HTTP clients.')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--drivers', nargs='+', choices=('test_client', 'http'), default=['test_client', 'http'])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench-results.json')
+    args = parser.parse_args()
+
+    url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='bench-suite-'), 'app.db')}"
+    os.environ['DATABASE_URL'] = url
+    # measure the requests, not email delivery or statement rendering
+    os.environ.setdefault('STATEMENT_RENDERING', 'off')
+    os.environ.pop('SENDGRID_API_KEY', None)
+    from werkzeug.serving import make_server
+    from app import app
+    from models import db, User
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app.logger.setLevel(logging.ERROR)
+    with app.app_context():
+        if args.reset:
+            db.drop_all()
+        db.create_all()
+        if db.session.query(User.id).first() is not None:
+            parser.error('the database already has users; pass --reset to recreate it')
+        started = time.perf_counter()
+        ids = seed(db, args)
+        seed_seconds = time.perf_counter() - started
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = {}
+    print(f"{'scenario':<16} {'driver':<12} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9} {'errors':>7}")
+    try:
+        for name in args.scenarios:
+            results[name] = {}
+            for driver in args.drivers:
+                with app.app_context():
+                    if driver == 'test_client':
+                        result = run_test_client(app, name, ids, args.requests, args.seed)
+                    else:
+                        result = run_http(server.server_port, name, ids, args.requests, args.threads, args.seed)
+                results[name][driver] = result
+                print(f"{name:<16} {driver:<12} {result.get('p50_ms', 0):>9.2f} {result.get('p95_ms', 0):>9.2f} "
+                      f"{result.get('p99_ms', 0):>9.2f} {result.get('throughput_rps', 0):>9.1f} {result['errors']:>7}")
+    finally:
+        server.shutdown()
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'database': url.split(':', 1)[0],
+            'python': platform.python_version(),
+            'seed_seconds': round(seed_seconds, 2),
+            'params': {k: getattr(args, k) for k in (
+                'families', 'members', 'bills', 'items', 'requests', 'threads', 'seed')},
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
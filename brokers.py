@@ -0,0 +1,292 @@
+"""Message brokers that carry SSE events between gunicorn workers.
+
+Every backend delivers a published message to the ``handler`` of every
+started broker, including the one in the publishing process. Each process
+runs at most one subscriber thread and the handler fans messages out to
+that process' listeners (see ``events._dispatch``).
+
+``publish`` also gives each message its ``id`` from a sequence shared by
+every publisher on the backend. The id is taken and the message sent under
+one lock, so every subscriber receives messages in id order, whichever
+worker published them, and a client's ``Last-Event-ID`` means the same on
+every worker.
+"""
+import os
+import json
+import fcntl
+import glob
+import select
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+CHANNEL = 'familyphonepay_events'
+SEQUENCE = 'familyphonepay_event_id'
+# pg_advisory_xact_lock key that orders publishes across workers
+PUBLISH_LOCK = 0x46505045
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+PG_MAX_PAYLOAD = 7999
+UNIX_MAX_PAYLOAD = 65507
+
+
+class Broker:
+    def start(self, handler):
+        self.handler = handler
+
+    def publish(self, message: dict) -> int:
+        """Send ``message`` with a new ``id`` and return the id."""
+        raise NotImplementedError
+
+    def last_id(self) -> int:
+        """Return the newest id handed out so far."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def _deliver(self, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        self.handler(message)
+
+
+class InProcessBroker(Broker):
+    """Deliver messages synchronously inside the publishing process."""
+
+    def __init__(self):
+        self._id_lock = threading.Lock()
+        self._last_id = 0
+
+    def publish(self, message):
+        with self._id_lock:
+            self._last_id += 1
+            self.handler({**message, 'id': self._last_id})
+            return self._last_id
+
+    def last_id(self):
+        with self._id_lock:
+            return self._last_id
+
+
+class UnixSocketBroker(Broker):
+    """Fan out over Unix datagram sockets in a shared directory.
+
+    Each process binds its own socket in ``directory`` and publishing sends
+    the message to every socket found there. Sockets left behind by dead
+    workers are removed the first time a send to them is refused. The last
+    id is kept in a file in the same directory, locked while publishing.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.getenv(
+            'EVENT_SOCKET_DIR', os.path.join(tempfile.gettempdir(), 'familyphonepay-events')
+        )
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.sock')
+        self.id_path = os.path.join(self.directory, 'last-event-id')
+        self._sock = None
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def start(self, handler):
+        super().start(handler)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._thread = threading.Thread(target=self._run, name='event-broker', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                payload = self._sock.recv(UNIX_MAX_PAYLOAD)
+            except OSError:
+                break
+            if payload:
+                self._deliver(payload)
+
+    def _read_id(self, f):
+        f.seek(0)
+        return int(f.read().strip() or 0)
+
+    def last_id(self):
+        with open(self.id_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            return self._read_id(f)
+
+    def publish(self, message):
+        with self._sender_lock, open(self.id_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            event_id = self._read_id(f) + 1
+            payload = json.dumps({**message, 'id': event_id}).encode('utf-8')
+            if len(payload) > UNIX_MAX_PAYLOAD:
+                raise ValueError('Event payload too large')
+            f.seek(0)
+            f.truncate()
+            f.write(str(event_id))
+            f.flush()
+            self._send(payload)
+            return event_id
+
+    def _send(self, payload):
+        for path in glob.glob(os.path.join(self.directory, '*.sock')):
+            try:
+                self._sender.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                if path != self.path:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+
+    def close(self):
+        self._closed = True
+        if self._sock is not None:
+            # an empty datagram wakes the subscriber thread so it can exit
+            try:
+                self._sender.sendto(b'', self.path)
+            except OSError:
+                pass
+            if self._thread is not None:
+                self._thread.join(timeout=1)
+            self._sock.close()
+        self._sender.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def _pg_dsn(url):
+    # SQLAlchemy URLs may name the driver, e.g. postgresql+psycopg2://
+    scheme, _, rest = url.partition('://')
+    return f"{scheme.split('+')[0]}://{rest}"
+
+
+class PostgresBroker(Broker):
+    """Use Postgres LISTEN/NOTIFY on a dedicated connection per worker.
+
+    Ids come from the ``familyphonepay_event_id`` sequence, created on first
+    use.
+    """
+
+    def __init__(self, url=None, channel=CHANNEL, reconnect_delay=1.0):
+        import psycopg2
+
+        self._psycopg2 = psycopg2
+        self.dsn = _pg_dsn(url or os.environ['DATABASE_URL'])
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._pub_conn = None
+        self._pub_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._ready = threading.Event()
+
+    def _connect(self):
+        conn = self._psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        return conn
+
+    def start(self, handler):
+        super().start(handler)
+        self._thread = threading.Thread(target=self._run, name='event-broker', daemon=True)
+        self._thread.start()
+        self._ready.wait(timeout=5)
+
+    def _run(self):
+        while not self._closed:
+            try:
+                conn = self._connect()
+            except self._psycopg2.Error:
+                time.sleep(self.reconnect_delay)
+                continue
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN "{self.channel}"')
+                self._ready.set()
+                while not self._closed:
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._deliver(conn.notifies.pop(0).payload)
+            except (self._psycopg2.Error, OSError):
+                time.sleep(self.reconnect_delay)
+            finally:
+                conn.close()
+
+    def _publisher(self):
+        if self._pub_conn is None or self._pub_conn.closed:
+            conn = self._psycopg2.connect(self.dsn)
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_advisory_xact_lock(%s)', (PUBLISH_LOCK,))
+                cur.execute(f'CREATE SEQUENCE IF NOT EXISTS "{SEQUENCE}"')
+            conn.commit()
+            self._pub_conn = conn
+        return self._pub_conn
+
+    def last_id(self):
+        with self._pub_lock:
+            conn = self._publisher()
+            with conn.cursor() as cur:
+                cur.execute(f'SELECT last_value, is_called FROM "{SEQUENCE}"')
+                value, called = cur.fetchone()
+            conn.commit()
+            return value if called else value - 1
+
+    def publish(self, message):
+        with self._pub_lock:
+            for attempt in (0, 1):
+                conn = self._publisher()
+                try:
+                    with conn.cursor() as cur:
+                        # publishers queue on the lock, so notifications
+                        # commit, and are delivered, in id order
+                        cur.execute('SELECT pg_advisory_xact_lock(%s)', (PUBLISH_LOCK,))
+                        cur.execute('SELECT nextval(%s)', (SEQUENCE,))
+                        event_id = cur.fetchone()[0]
+                        payload = json.dumps({**message, 'id': event_id})
+                        if len(payload.encode('utf-8')) > PG_MAX_PAYLOAD:
+                            raise ValueError('Event payload too large')
+                        cur.execute('SELECT pg_notify(%s, %s)', (self.channel, payload))
+                    conn.commit()
+                    return event_id
+                except self._psycopg2.OperationalError:
+                    conn.close()
+                    if attempt:
+                        raise
+                except Exception:
+                    conn.rollback()
+                    raise
+
+    def close(self):
+        self._closed = True
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        if self._pub_conn is not None:
+            self._pub_conn.close()
+
+
+def create_broker(kind=None, url=None) -> Broker:
+    """Build the broker named by ``EVENT_BROKER`` (memory, unix or postgres).
+
+    The default, ``auto``, uses Postgres when ``DATABASE_URL`` points at
+    Postgres and the in-process broker otherwise.
+    """
+    kind = kind or os.getenv('EVENT_BROKER', 'auto')
+    url = url or os.getenv('DATABASE_URL', '')
+    if kind == 'auto':
+        kind = 'postgres' if url.startswith('postgres') else 'memory'
+    if kind == 'memory':
+        return InProcessBroker()
+    if kind == 'unix':
+        return UnixSocketBroker()
+    if kind == 'postgres':
+        return PostgresBroker(url)
+    raise ValueError(f'Unknown event broker: {kind}')
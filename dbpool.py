@@ -0,0 +1,153 @@
+"""Database engine options from the environment, and pool statistics.
+
+Every gunicorn worker has its own pool, so the per-worker limits are
+derived from ``DB_MAX_CONNECTIONS`` (the share of the server's connection
+limit the web service may use) divided by ``WEB_CONCURRENCY``. Workers
+with a fixed number of threads need no more pooled connections than
+threads, plus one for each thread that may render a statement while a
+request still holds its connection; gevent workers may use their whole
+share. ``DB_POOL_SIZE`` and
+``DB_MAX_OVERFLOW`` override the derived values. SQLite keeps
+SQLAlchemy's defaults.
+
+Each worker also holds connections outside the pool. The Postgres event
+broker keeps one LISTEN and one publishing connection to ``DATABASE_URL``,
+and these are taken out of the share. A replica (``DATABASE_REPLICA_URL``)
+gets a pool of the same size, counted against the replica server's
+``max_connections``.
+"""
+import os
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+def _flag(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# the LISTEN connection and the publishing connection of brokers.PostgresBroker
+BROKER_CONNECTIONS = 2
+
+
+def broker_connections(url, env=os.environ):
+    """Connections each worker's event broker holds to the database at ``url``."""
+    database_url = env.get('DATABASE_URL', '')
+    kind = env.get('EVENT_BROKER', 'auto')
+    if kind == 'auto':
+        kind = 'postgres' if database_url.startswith('postgres') else 'memory'
+    return BROKER_CONNECTIONS if kind == 'postgres' and url == database_url else 0
+
+
+def statement_connections(url, env=os.environ):
+    """Pooled connections statement rendering may take from ``url`` besides the requests'."""
+    if url != env.get('DATABASE_URL', ''):
+        return 0
+    mode = env.get('STATEMENT_RENDERING', 'background')
+    if mode == 'off':
+        return 0
+    if mode == 'inline':
+        # each request thread renders while holding its own connection
+        return max(1, int(env.get('GUNICORN_THREADS', '1')))
+    return int(env.get('STATEMENT_WORKERS', '2'))
+
+
+def engine_options(url, env=os.environ):
+    """Return ``SQLALCHEMY_ENGINE_OPTIONS`` for the database at ``url``."""
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {}
+    workers = max(1, int(env.get('WEB_CONCURRENCY', '2')))
+    share = int(env.get('DB_MAX_CONNECTIONS', '20')) // workers
+    per_worker = max(1, share - broker_connections(url, env))
+    if env.get('GUNICORN_WORKER_CLASS', 'gevent') == 'gevent':
+        concurrency = per_worker
+    else:
+        concurrency = max(1, int(env.get('GUNICORN_THREADS', '1'))) + statement_connections(url, env)
+    pool_size = int(env.get('DB_POOL_SIZE') or min(concurrency, per_worker))
+    max_overflow = int(env.get('DB_MAX_OVERFLOW') or max(0, min(concurrency, per_worker) - pool_size))
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': float(env.get('DB_POOL_TIMEOUT', '10')),
+        'pool_recycle': int(env.get('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': _flag(env.get('DB_POOL_PRE_PING', 'true')),
+        'pool_use_lifo': True,
+    }
+    statement_timeout = env.get('DB_STATEMENT_TIMEOUT_MS')
+    if statement_timeout and make_url(url).get_backend_name() == 'postgresql':
+        options['connect_args'] = {'options': f'-c statement_timeout={int(statement_timeout)}'}
+    return options
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A ``QueuePool`` that records checkout waits, overflow and invalidations."""
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.overflow_events = 0
+        self.invalidations = 0
+        event.listen(self, 'invalidate', self._on_invalidate)
+        event.listen(self, 'soft_invalidate', self._on_invalidate)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def _inc_overflow(self):
+        added = super()._inc_overflow()
+        if added and self._overflow > 0:
+            with self._stats_lock:
+                self.overflow_events += 1
+        return added
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._stats_lock:
+            self.invalidations += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'pool_size': self.size(),
+                'max_overflow': self._max_overflow,
+                'checked_in': self.checkedin(),
+                'checked_out': self.checkedout(),
+                'overflow': self.overflow(),
+                'checkouts': self.checkouts,
+                'wait_seconds_total': round(self.wait_seconds, 6),
+                'wait_seconds_max': round(self.max_wait_seconds, 6),
+                'timeouts': self.timeouts,
+                'overflow_events': self.overflow_events,
+                'invalidations': self.invalidations,
+            }
+
+
+def pool_stats(engine):
+    """Return the statistics of ``engine``'s pool, however it is configured."""
+    pool = engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        stats = pool.stats()
+    else:
+        stats = {'status': pool.status()}
+    stats['pool_class'] = type(pool).__name__
+    stats['pid'] = os.getpid()
+    return stats
@@ -1,20 +1,274 @@
+import os
 import queue
+import threading
+import time
+from collections import deque, namedtuple
 
-listeners = []
+from brokers import create_broker
 
-def add_listener():
-    q = queue.Queue()
-    listeners.append(q)
+QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', '100'))
+OVERFLOW_POLICY = os.getenv('EVENT_OVERFLOW_POLICY', 'drop-oldest')
+POLICIES = ('drop-oldest', 'coalesce-latest')
+HISTORY_SIZE = int(os.getenv('EVENT_HISTORY_SIZE', '50'))
+
+Event = namedtuple('Event', 'id data')
+
+# topic name -> set of listeners subscribed to it
+_topics = {}
+_lock = threading.Lock()
+counters = {'published': 0, 'delivered': 0, 'dropped': 0}
+
+# topic name -> ring buffer of recent events, and the newest id evicted from it
+_history = {}
+_evicted = {}
+# ids come from the broker's shared sequence: the last one handed out when
+# this worker's subscriber started (older events cannot be replayed here),
+# and the newest one delivered to it since
+_started_id = 0
+_last_seen = 0
+
+_broker = None
+_broker_pid = None
+_broker_lock = threading.Lock()
+
+# message kind -> callback for the non-SSE messages sent with ``broadcast``
+_handlers = {}
+
+
+def family_topic(family_id):
+    return f'family:{family_id}'
+
+
+def user_topic(user_id):
+    return f'user:{user_id}'
+
+
+class Listener(queue.Queue):
+    """A bounded queue that never blocks the publisher.
+
+    When the queue is full, ``drop-oldest`` discards the oldest pending
+    message and ``coalesce-latest`` collapses everything pending into the
+    newest message. Either way the number of discarded messages is added to
+    ``dropped``.
+    """
+
+    def __init__(self, topics, maxsize=None, policy=None):
+        super().__init__(maxsize=QUEUE_SIZE if maxsize is None else maxsize)
+        self.policy = policy or OVERFLOW_POLICY
+        if self.policy not in POLICIES:
+            raise ValueError(f'Unknown overflow policy: {self.policy}')
+        self.topics = tuple(topics)
+        self.dropped = 0
+
+    def offer(self, item):
+        """Enqueue ``item`` without blocking and return how many were dropped."""
+        with self.mutex:
+            dropped = 0
+            if 0 < self.maxsize <= len(self.queue):
+                if self.policy == 'coalesce-latest':
+                    dropped = len(self.queue)
+                    self.queue.clear()
+                else:
+                    self.queue.popleft()
+                    dropped = 1
+            self.queue.append(item)
+            self.dropped += dropped
+            self.not_empty.notify()
+        return dropped
+
+
+def add_listener(family_id=None, user_id=None, maxsize=None, policy=None):
+    # a worker that only serves /events still needs its broker subscriber
+    get_broker()
+    topics = []
+    if family_id is not None:
+        topics.append(family_topic(family_id))
+    if user_id is not None:
+        topics.append(user_topic(user_id))
+    q = Listener(topics, maxsize, policy)
+    with _lock:
+        for topic in topics:
+            _topics.setdefault(topic, set()).add(q)
     return q
 
 
 def remove_listener(q):
+    with _lock:
+        for topic in q.topics:
+            subscribers = _topics.get(topic)
+            if subscribers is None:
+                continue
+            subscribers.discard(q)
+            if not subscribers:
+                del _topics[topic]
+
+
+def get_broker():
+    """Return this process' broker, starting its subscriber on first use.
+
+    The broker is created lazily and re-created after a fork so every
+    gunicorn worker owns exactly one subscriber thread.
+    """
+    global _broker, _broker_pid
+    with _broker_lock:
+        if _broker is None or _broker_pid != os.getpid():
+            broker = create_broker()
+            _start(broker)
+            _broker, _broker_pid = broker, os.getpid()
+        return _broker
+
+
+def _start(broker):
+    global _started_id, _last_seen
+    broker.start(_dispatch)
+    with _lock:
+        _started_id = _last_seen = broker.last_id()
+        _history.clear()
+        _evicted.clear()
+
+
+def set_broker(broker):
+    """Replace the current broker, e.g. with one configured explicitly."""
+    global _broker, _broker_pid
+    with _broker_lock:
+        old = _broker if _broker_pid == os.getpid() else None
+        _start(broker)
+        _broker, _broker_pid = broker, os.getpid()
+    if old is not None:
+        old.close()
+
+
+def send_event(data: str, family_id=None, user_id=None):
+    """Publish ``data`` to the listeners of a family and/or a single user.
+
+    The message goes through the broker so listeners connected to other
+    workers receive it as well.
+    """
+    if family_id is None and user_id is None:
+        raise ValueError('send_event needs a family_id or user_id')
+    get_broker().publish({'family_id': family_id, 'user_id': user_id, 'data': data})
+    with _lock:
+        counters['published'] += 1
+
+
+def on_message(kind, handler):
+    """Call ``handler(payload)`` in every worker for each ``broadcast`` of ``kind``."""
+    _handlers[kind] = handler
+
+
+def broadcast(kind, payload):
+    """Send ``payload`` to the ``kind`` handlers of every worker, this one included."""
+    get_broker().publish({'kind': kind, 'payload': payload})
+
+
+def _dispatch(message):
+    global _last_seen
+    kind = message.get('kind')
+    if kind is not None:
+        handler = _handlers.get(kind)
+        if handler is not None:
+            handler(message['payload'])
+        return
+    event = Event(message['id'], message['data'])
+    topics = []
+    if message.get('family_id') is not None:
+        topics.append(family_topic(message['family_id']))
+    if message.get('user_id') is not None:
+        topics.append(user_topic(message['user_id']))
+    targets = set()
+    with _lock:
+        _last_seen = max(_last_seen, event.id)
+        for topic in topics:
+            ring = _history.get(topic)
+            if ring is None:
+                ring = _history[topic] = deque(maxlen=HISTORY_SIZE)
+            elif len(ring) == ring.maxlen:
+                _evicted[topic] = max(_evicted.get(topic, 0), ring[0].id)
+            ring.append(event)
+            targets.update(_topics.get(topic, ()))
+    dropped = 0
+    for q in targets:
+        dropped += q.offer(event)
+    with _lock:
+        counters['delivered'] += len(targets)
+        counters['dropped'] += dropped
+
+
+def replay(topics, last_id):
+    """Return the events on ``topics`` published after ``last_id``.
+
+    Returns ``None`` when some of those events are no longer held in the
+    ring buffers, or ``last_id`` is newer than anything this worker has seen
+    (an id from before the sequence was reset), in which case the client has
+    to resynchronise.
+    """
+    with _lock:
+        if not _started_id <= last_id <= _last_seen:
+            return None
+        if any(last_id < _evicted.get(topic, 0) for topic in topics):
+            return None
+        missed = {
+            event.id: event
+            for topic in topics
+            for event in _history.get(topic, ())
+            if event.id > last_id
+        }
+    return [missed[i] for i in sorted(missed)]
+
+
+def latest_id(topics, default=0):
+    """Return the newest buffered event id on ``topics``."""
+    with _lock:
+        ids = [_history[t][-1].id for t in topics if _history.get(t)]
+    return max(ids, default=default)
+
+
+def stream(q, heartbeat=15.0, max_duration=0, last_event_id=None, retry=2.0):
+    """Yield Server-Sent Event frames for listener ``q`` until the client leaves.
+
+    A comment line is sent every ``heartbeat`` seconds of silence so proxies
+    keep the connection open and dead clients are noticed. With a
+    ``max_duration`` the stream ends after that many seconds and the browser
+    reconnects, which spreads long-lived connections across workers.
+    Browsers wait ``retry`` seconds before reconnecting.
+
+    When the client reconnects with ``last_event_id`` the events it missed
+    are replayed first; if they are no longer buffered a single ``resync``
+    event tells it to reload instead.
+    """
+    deadline = time.monotonic() + max_duration if max_duration else None
+    seen = 0
     try:
-        listeners.remove(q)
-    except ValueError:
-        pass
+        yield f'retry: {int(retry * 1000)}\n\n'
+        if last_event_id is not None:
+            missed = replay(q.topics, last_event_id)
+            if missed is None:
+                seen = latest_id(q.topics, last_event_id)
+                yield f'id: {seen}\nevent: resync\ndata: {{}}\n\n'
+            else:
+                for event in missed:
+                    seen = event.id
+                    yield f'id: {event.id}\ndata: {event.data}\n\n'
+        while deadline is None or time.monotonic() < deadline:
+            try:
+                event = q.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ': keep-alive\n\n'
+                continue
+            # the listener was registered before the replay, so skip
+            # anything the replay already sent
+            if event.id <= seen:
+                continue
+            yield f'id: {event.id}\ndata: {event.data}\n\n'
+    finally:
+        remove_listener(q)
 
 
-def send_event(data: str):
-    for q in list(listeners):
-        q.put(data)
+def stats():
+    """Return event counters plus the current listener count and queue depth."""
+    with _lock:
+        listeners = set().union(*_topics.values()) if _topics else set()
+        result = dict(counters)
+    result['listeners'] = len(listeners)
+    result['queued'] = sum(q.qsize() for q in listeners)
+    return result
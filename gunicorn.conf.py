@@ -0,0 +1,34 @@
+import os
+
+# Gunicorn settings, read from the environment so Render and local runs share them.
+# gevent workers serve each request on a greenlet, so an idle /events stream
+# costs a few kilobytes instead of a whole sync worker.
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '2000'))
+threads = int(os.getenv('GUNICORN_THREADS', '1'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+keepalive = 5
+
+
+def post_fork(server, worker):
+    # psycopg2 blocks in C unless it waits on the gevent hub, which would
+    # stall every greenlet in the worker during a query
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def worker_exit(server, worker):
+    # runs in the worker: keep what it counted since its last snapshot
+    from metrics import MULTIPROC_DIR, write_snapshot
+    if MULTIPROC_DIR:
+        write_snapshot()
+
+
+def child_exit(server, worker):
+    # runs in the arbiter once the worker is gone, before its pid can be reused
+    from metrics import MULTIPROC_DIR, mark_process_dead
+    if MULTIPROC_DIR:
+        mark_process_dead(worker.pid)
@@ -0,0 +1,197 @@
+"""``Idempotency-Key`` support for the API's POST endpoints.
+
+The first request with a key commits a claim row, unique per user and key,
+before its view runs, and stores the response in that row afterwards. A
+retry with the same key and body gets the stored response back without
+running the view again. A duplicate that arrives while the first request is
+still running waits up to ``IDEMPOTENCY_WAIT`` seconds for it and then gets
+409. Reusing a key for a different request is rejected with 422. A 5xx
+response, or an exception, from a view that committed nothing releases the
+key so the request can be retried; once the view has committed, its
+response is kept whatever the status, so a retry never repeats the write.
+Keys expire after
+``IDEMPOTENCY_TTL`` seconds; ``flask idempotency purge`` deletes them.
+
+Bodies up to ``MAX_HASHED_BODY`` bytes are part of the fingerprint. Larger or
+chunked uploads, such as bulk item imports and payment reconciliation, are
+fingerprinted by their content type and length only, so their stream still
+reaches the view unread and memory stays bounded.
+
+The claim and the stored response are separate commits. If a worker dies
+after the view committed its writes but before the response was stored, the
+key stays claimed (retries get 409) until ``IDEMPOTENCY_LOCK_TIMEOUT``
+expires, and a retry after that runs the view again.
+"""
+import hashlib
+import io
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app, g, has_request_context, jsonify, request
+from flask.cli import AppGroup
+from flask_login import current_user
+from sqlalchemy import delete, event, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from metrics import registry
+from models import db, IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+MAX_HASHED_BODY = 1024 * 1024
+POLL_INTERVAL = 0.05
+
+IDEMPOTENT_REQUESTS = registry.counter(
+    'idempotent_requests_total', 'API writes sent with an Idempotency-Key, by outcome.', ('outcome',)
+)
+
+idempotency_cli = AppGroup('idempotency', help='Maintain stored Idempotency-Key responses.')
+
+
+def _fingerprint():
+    digest = hashlib.sha256(f'{request.method} {request.full_path}\n'.encode())
+    length = request.content_length
+    if length is None or length > MAX_HASHED_BODY:
+        # reading a streamed upload here would hold all of it in memory
+        digest.update(f'{request.content_type} {length}'.encode())
+        return digest.hexdigest()
+    body = request.get_data(cache=True)
+    # the view may still read the form, the cached data or the raw stream
+    request.stream = io.BytesIO(body)
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def _stale(now):
+    """Expired keys, and claims whose request died without releasing them."""
+    lock_timeout = timedelta(seconds=current_app.config['IDEMPOTENCY_LOCK_TIMEOUT'])
+    return or_(
+        IdempotencyKey.expires_at <= now,
+        IdempotencyKey.status.is_(None) & (IdempotencyKey.created_at <= now - lock_timeout),
+    )
+
+
+def _claim(key, fingerprint):
+    """Return ``(row, claimed)``: a new committed claim, or the earlier request's row."""
+    deadline = time.monotonic() + current_app.config['IDEMPOTENCY_WAIT']
+    while True:
+        now = datetime.utcnow()
+        db.session.execute(
+            delete(IdempotencyKey).where(
+                IdempotencyKey.user_id == current_user.id, IdempotencyKey.key == key, _stale(now)
+            )
+        )
+        row = db.session.execute(
+            select(IdempotencyKey)
+            .where(IdempotencyKey.user_id == current_user.id, IdempotencyKey.key == key)
+            .execution_options(populate_existing=True)
+        ).scalar_one_or_none()
+        if row is None:
+            row = IdempotencyKey(
+                user_id=current_user.id,
+                key=key,
+                request_hash=fingerprint,
+                created_at=now,
+                expires_at=now + timedelta(seconds=current_app.config['IDEMPOTENCY_TTL']),
+            )
+            db.session.add(row)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # a concurrent duplicate committed its claim first
+                db.session.rollback()
+                continue
+            return row, True
+        db.session.commit()
+        if row.status is not None or row.request_hash != fingerprint or time.monotonic() >= deadline:
+            return row, False
+        time.sleep(POLL_INTERVAL)
+
+
+def _replay_or_claim():
+    key = request.headers.get(HEADER)
+    if request.method != 'POST' or key is None or not current_user.is_authenticated:
+        return None
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return jsonify({'error': f'{HEADER} must be 1 to {MAX_KEY_LENGTH} characters'}), 400
+    fingerprint = _fingerprint()
+    row, claimed = _claim(key, fingerprint)
+    if claimed:
+        g.idempotency_key_id = row.id
+        IDEMPOTENT_REQUESTS.inc(outcome='executed')
+        return None
+    if row.request_hash != fingerprint:
+        IDEMPOTENT_REQUESTS.inc(outcome='mismatch')
+        return jsonify({'error': f'{HEADER} was already used for a different request'}), 422
+    if row.status is None:
+        IDEMPOTENT_REQUESTS.inc(outcome='conflict')
+        response = jsonify({'error': f'A request with this {HEADER} is still in progress'})
+        response.status_code = 409
+        response.headers['Retry-After'] = '1'
+        return response
+    IDEMPOTENT_REQUESTS.inc(outcome='replayed')
+    response = current_app.response_class(row.body, status=row.status, content_type=row.content_type)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+@event.listens_for(db.session, 'after_commit')
+def _view_committed(session):
+    # the claim's own commit happens before the key id is set
+    if has_request_context() and 'idempotency_key_id' in g:
+        g.idempotency_committed = True
+
+
+def _store_response(response):
+    row_id = g.pop('idempotency_key_id', None)
+    if row_id is None:
+        return response
+    committed = g.pop('idempotency_committed', False)
+    # anything the view left uncommitted is discarded at teardown anyway
+    db.session.rollback()
+    if not committed and (response.status_code >= 500 or response.is_streamed):
+        db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.id == row_id))
+    elif response.is_streamed and response.status_code < 500:
+        # the view's stream can't be stored, so hold the claim until it
+        # times out; error pages are buffered and stored below
+        return response
+    else:
+        db.session.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.id == row_id)
+            .values(status=response.status_code, content_type=response.content_type, body=response.get_data())
+        )
+    db.session.commit()
+    return response
+
+
+def _release_claim(exc):
+    # the view raised, so after_request never stored a response
+    row_id = g.pop('idempotency_key_id', None)
+    if row_id is None or g.pop('idempotency_committed', False):
+        # a view that committed keeps its claim until IDEMPOTENCY_LOCK_TIMEOUT
+        return
+    db.session.rollback()
+    db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.id == row_id))
+    db.session.commit()
+
+
+def init_app(blueprint):
+    """Honour ``Idempotency-Key`` on every POST handled by ``blueprint``."""
+    blueprint.before_request(_replay_or_claim)
+    blueprint.after_request(_store_response)
+    blueprint.teardown_request(_release_claim)
+
+
+def purge(conn, now=None):
+    """Delete expired keys and abandoned claims; return how many were removed."""
+    return conn.execute(delete(IdempotencyKey).where(_stale(now or datetime.utcnow()))).rowcount
+
+
+@idempotency_cli.command('purge')
+def purge_command():
+    """Delete expired Idempotency-Key responses."""
+    removed = purge(db.session.connection())
+    db.session.commit()
+    click.echo(f'Removed {removed} expired idempotency keys.')
@@ -0,0 +1,146 @@
+"""The identity Flask-Login loads on every request, cached per process.
+
+Most requests only need a member's id, role, family and username, so
+``load_identity`` keeps those in a bounded LRU cache with a TTL and hands
+out an ``Identity`` instead of the ORM ``User``. The full ``User`` is loaded
+on first access to any other attribute. Entries are dropped whenever a
+``User`` row is flushed, and the committed ids are broadcast through the
+event broker so the other workers drop theirs too. If the broker cannot be
+reached, they see the change once the TTL expires.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from flask_login import UserMixin
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+import events
+from models import db, User
+
+CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', '1024'))
+CACHE_TTL = float(os.getenv('IDENTITY_CACHE_TTL', '60'))
+
+FIELDS = ('id', 'role', 'family_id', 'username')
+
+
+class IdentityCache:
+    """A thread-safe LRU mapping of user id to identity fields with a TTL."""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+    def put(self, user_id, fields):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, fields)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = IdentityCache()
+
+
+class Identity(UserMixin):
+    """The logged-in member as seen by ``current_user``."""
+
+    def __init__(self, id, role, family_id, username):
+        self.id = id
+        self.role = role
+        self.family_id = family_id
+        self.username = username
+        self._user = None
+
+    @property
+    def user(self):
+        """The ORM ``User``, loaded on first use."""
+        if self._user is None:
+            self._user = db.session.get(User, self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+
+def load_identity(user_id):
+    """Return the ``Identity`` for ``user_id`` or ``None`` if there is no such user."""
+    fields = cache.get(user_id)
+    if fields is None:
+        # subscribe before caching anything, so no invalidation is missed
+        events.get_broker()
+        row = db.session.execute(
+            select(User.id, User.role, User.family_id, User.username).where(User.id == user_id)
+        ).first()
+        if row is None:
+            return None
+        fields = tuple(row)
+        cache.put(user_id, fields)
+    return Identity(*fields)
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_changed_users(session, flush_context):
+    # new rows too: a reused primary key must not inherit a stale entry
+    changed = session.info.setdefault('identity_changed', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User) and obj.id is not None:
+            changed.add(obj.id)
+            cache.invalidate(obj.id)
+
+
+def _invalidate(user_ids):
+    for user_id in user_ids:
+        cache.invalidate(user_id)
+
+
+events.on_message('identity', _invalidate)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed_users(session):
+    # another request may have cached the old row between flush and commit
+    changed = sorted(session.info.pop('identity_changed', ()))
+    if not changed:
+        return
+    _invalidate(changed)
+    try:
+        events.broadcast('identity', changed)
+    except Exception:
+        current_app.logger.warning('Identity invalidation not broadcast; other workers wait for the TTL', exc_info=True)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changed_users(session):
+    session.info.pop('identity_changed', None)
@@ -0,0 +1,157 @@
+"""Streaming bulk ingestion of bill items from NDJSON or CSV uploads.
+
+Rows are parsed one line at a time from the request stream, validated and
+written with multi-row INSERTs of ``CHUNK_SIZE`` rows, so memory use depends
+on the chunk size rather than on the size of the upload.
+"""
+import csv
+import io
+import json
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+
+from balances import apply_deltas
+from models import db, BillItem, User, touch_bills
+
+CHUNK_SIZE = 500
+MAX_ERRORS = 1000
+MAX_LINE = 64 * 1024
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/jsonl', 'application/json-lines')
+CSV_TYPES = ('text/csv',)
+
+_TRUE = ('1', 'true', 'yes', 'y')
+
+
+def _lines(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8', errors='replace', newline='')
+    while True:
+        line = text.readline(MAX_LINE)
+        if not line:
+            return
+        if len(line) >= MAX_LINE and not line.endswith('\n'):
+            # drain the rest of an oversized line so the next row starts cleanly
+            while line and not line.endswith('\n'):
+                line = text.readline(MAX_LINE)
+            yield ValueError('line too long')
+            continue
+        yield line
+
+
+def parse_ndjson(stream):
+    """Yield ``(line_number, row)`` pairs; ``row`` is an exception if unparsable."""
+    for number, line in enumerate(_lines(stream), start=1):
+        if isinstance(line, Exception):
+            yield number, line
+        elif line.strip():
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield number, ValueError('invalid JSON')
+                continue
+            yield number, row if isinstance(row, dict) else ValueError('row must be an object')
+
+
+def parse_csv(stream):
+    """Yield ``(line_number, row)`` pairs from a CSV body with a header row."""
+    oversized = []
+
+    def lines():
+        for number, line in enumerate(_lines(stream), start=1):
+            if isinstance(line, Exception):
+                # keep the line count right; DictReader skips blank lines
+                oversized.append((number, line))
+                line = '\n'
+            yield line
+
+    reader = csv.DictReader(lines())
+    for row in reader:
+        while oversized:
+            yield oversized.pop(0)
+        yield reader.line_num, row
+    yield from oversized
+
+
+def validate(row, member_ids):
+    """Return the column values for ``row`` or raise ``ValueError``."""
+    description = row.get('description')
+    description = str(description).strip() if description is not None else ''
+    if not description:
+        raise ValueError('description required')
+    if len(description) > 200:
+        raise ValueError('description longer than 200 characters')
+    amount = row.get('amount')
+    if amount is None or amount == '':
+        raise ValueError('amount required')
+    try:
+        amount = Decimal(str(amount)).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError('amount must be a number')
+    if not amount.is_finite() or abs(amount) >= Decimal('1e8'):
+        raise ValueError('amount out of range')
+    user_id = row.get('user_id')
+    if user_id in (None, ''):
+        user_id = None
+    else:
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            raise ValueError('user_id must be an integer')
+        if user_id not in member_ids:
+            raise ValueError('user_id is not a member of this family')
+    recurring = row.get('is_recurring', False)
+    if isinstance(recurring, str):
+        recurring = recurring.strip().lower() in _TRUE
+    return {
+        'description': description,
+        'amount': amount,
+        'user_id': user_id,
+        'is_recurring': bool(recurring),
+    }
+
+
+def ingest_items(bill, rows, chunk_size=CHUNK_SIZE):
+    """Insert the valid ``rows`` into ``bill`` inside the current transaction.
+
+    Returns a report with the number of inserted and rejected rows and the
+    first ``MAX_ERRORS`` errors. The caller commits.
+    """
+    member_ids = {
+        uid for (uid,) in db.session.query(User.id).filter_by(family_id=bill.family_id)
+    }
+    table = BillItem.__table__
+    conn = db.session.connection()
+    chunk = []
+    deltas = defaultdict(lambda: [Decimal(0), Decimal(0)])
+    report = {'inserted': 0, 'rejected': 0, 'errors': [], 'errors_truncated': False}
+
+    def flush():
+        if chunk:
+            conn.execute(table.insert().values(chunk))
+            report['inserted'] += len(chunk)
+            chunk.clear()
+
+    for number, row in rows:
+        try:
+            if isinstance(row, Exception):
+                raise row
+            values = validate(row, member_ids)
+        except ValueError as exc:
+            report['rejected'] += 1
+            if len(report['errors']) < MAX_ERRORS:
+                report['errors'].append({'line': number, 'error': str(exc)})
+            else:
+                report['errors_truncated'] = True
+            continue
+        values['bill_id'] = bill.id
+        chunk.append(values)
+        deltas[(bill.id, values['user_id'])][0] += values['amount']
+        if len(chunk) >= chunk_size:
+            flush()
+    flush()
+    # Core inserts bypass the ORM flush hooks that maintain member balances
+    # and bill versions
+    apply_deltas(conn, {key: tuple(value) for key, value in deltas.items()})
+    if report['inserted']:
+        touch_bills(conn, [bill.id])
+    return report
@@ -0,0 +1,108 @@
+"""Streaming export of a family's bills, items, payments and notifications.
+
+Each record type is read with its own query executed with ``yield_per``,
+which uses a server-side cursor where the driver supports one (psycopg2), so
+only ``YIELD_PER`` rows are held in memory at a time however long the
+family's history is. Rows are encoded as NDJSON or CSV as they arrive.
+"""
+import csv
+import io
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from sqlalchemy import func, null, select
+
+from models import db, Bill, BillItem, NotificationLog, Payment
+
+YIELD_PER = 1000
+# encoded rows are written to the response in batches of this many
+BATCH_SIZE = 200
+
+COLUMNS = (
+    'type', 'id', 'bill_id', 'bill_item_id', 'user_id', 'description',
+    'amount', 'cycle_month', 'due_date', 'date',
+)
+
+
+def _queries(family_id, since=None):
+    """Return ``(type, select)`` pairs, each selecting rows in COLUMNS order."""
+    changed = func.coalesce(Bill.updated_at, Bill.published_at)
+    bills = select(
+        Bill.id, Bill.id, null(), Bill.created_by, null(), Bill.total_amount,
+        Bill.cycle_month, Bill.due_date, Bill.published_at,
+    ).where(Bill.family_id == family_id).order_by(Bill.id)
+    # items carry no timestamp of their own; any item write bumps the
+    # bill's updated_at, so an incremental pull re-sends those bills' items
+    items = select(
+        BillItem.id, BillItem.bill_id, null(), BillItem.user_id, BillItem.description,
+        BillItem.amount, null(), null(), BillItem.paid_at,
+    ).join(Bill, Bill.id == BillItem.bill_id).where(Bill.family_id == family_id).order_by(BillItem.id)
+    payments = select(
+        Payment.id, BillItem.bill_id, Payment.bill_item_id, Payment.user_id, null(),
+        Payment.amount, null(), null(), Payment.paid_at,
+    ).join(BillItem, BillItem.id == Payment.bill_item_id).join(Bill, Bill.id == BillItem.bill_id).where(
+        Bill.family_id == family_id
+    ).order_by(Payment.id)
+    notifications = select(
+        NotificationLog.id, NotificationLog.bill_id, null(), NotificationLog.user_id,
+        NotificationLog.message, null(), null(), null(), NotificationLog.sent_at,
+    ).join(Bill, Bill.id == NotificationLog.bill_id).where(Bill.family_id == family_id).order_by(
+        NotificationLog.id
+    )
+    if since is not None:
+        bills = bills.where(changed >= since)
+        items = items.where(changed >= since)
+        payments = payments.where(Payment.paid_at >= since)
+        notifications = notifications.where(NotificationLog.sent_at >= since)
+    return [('bill', bills), ('item', items), ('payment', payments), ('notification', notifications)]
+
+
+def ledger_rows(family_id, since=None, yield_per=YIELD_PER):
+    """Yield one tuple in ``COLUMNS`` order per ledger record."""
+    conn = db.session.connection().execution_options(yield_per=yield_per)
+    for kind, query in _queries(family_id, since):
+        for row in conn.execute(query):
+            yield (kind,) + tuple(row)
+
+
+def _plain(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _batches(lines):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= BATCH_SIZE:
+            yield ''.join(batch)
+            batch.clear()
+    if batch:
+        yield ''.join(batch)
+
+
+def encode_ndjson(rows):
+    return _batches(
+        json.dumps(dict(zip(COLUMNS, map(_plain, row))), separators=(',', ':')) + '\n'
+        for row in rows
+    )
+
+
+def encode_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def lines():
+        writer.writerow(COLUMNS)
+        for row in rows:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow([_plain(value) for value in row])
+        yield buffer.getvalue()
+
+    return _batches(lines())
@@ -1,33 +1,218 @@
 import os
 import json
-from urllib import request
+import threading
+import http.client
+import select
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, NamedTuple, Optional
+from urllib.parse import urlsplit
 
-SENDGRID_API_URL = 'https://api.sendgrid.com/v3/mail/send'
+from metrics import MAIL_RECIPIENTS, MAIL_SECONDS
 
+SENDGRID_API_URL = os.getenv('SENDGRID_API_URL', 'https://api.sendgrid.com/v3/mail/send')
 
-def send_email(to_email: str, subject: str, content: str) -> None:
-    """Send a simple email via SendGrid."""
+# SendGrid accepts at most 1000 personalizations per request
+MAX_BATCH_SIZE = 1000
+
+
+class DeliveryResult(NamedTuple):
+    email: str
+    ok: bool
+    status: Optional[int] = None
+    error: Optional[str] = None
+
+
+def _settings():
     api_key = os.getenv('SENDGRID_API_KEY')
     from_email = os.getenv('EMAIL_FROM')
     if not api_key or not from_email:
         raise RuntimeError('Email settings not configured')
+    return api_key, from_email
+
+
+def _closed_by_server(sock):
+    # an idle keep-alive socket only becomes readable once the server hangs up
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+class Mailer:
+    """Deliver mail through SendGrid from a bounded pool of worker threads.
+
+    Recipients are grouped into batches of ``personalizations`` so one HTTP
+    request reaches many members, and each worker thread keeps its own
+    keep-alive connection to the API host.
+
+    SendGrid has no idempotency key for mail sends, so a request is only
+    retried when it cannot have reached the API: a failed connect. Once the
+    batch has been written, a lost response fails the batch rather than
+    risking a second copy to every recipient.
+    """
+
+    def __init__(self, api_url=None, workers=None, batch_size=None, timeout=None):
+        self.api_url = api_url or SENDGRID_API_URL
+        self.workers = workers or int(os.getenv('MAIL_WORKERS', '4'))
+        self.batch_size = min(batch_size or int(os.getenv('MAIL_BATCH_SIZE', '500')), MAX_BATCH_SIZE)
+        self.timeout = timeout or float(os.getenv('MAIL_TIMEOUT', '10'))
+        parts = urlsplit(self.api_url)
+        self._scheme = parts.scheme
+        self._host = parts.hostname
+        self._port = parts.port
+        self._path = parts.path or '/'
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='mailer'
+                )
+            return self._executor
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn.sock is not None and _closed_by_server(conn.sock):
+            self._drop_connection()
+            conn = None
+        if conn is None:
+            cls = http.client.HTTPSConnection if self._scheme == 'https' else http.client.HTTPConnection
+            conn = cls(self._host, self._port, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
 
-    payload = {
-        "personalizations": [{"to": [{"email": to_email}]}],
-        "from": {"email": from_email},
-        "subject": subject,
-        "content": [{"type": "text/plain", "value": content}],
-    }
-    data = json.dumps(payload).encode('utf-8')
-    req = request.Request(
-        SENDGRID_API_URL,
-        data=data,
-        headers={
+    def _post(self, body, api_key):
+        headers = {
             'Authorization': f'Bearer {api_key}',
             'Content-Type': 'application/json',
-        },
-        method='POST',
-    )
-    # Perform request but ignore response content
-    with request.urlopen(req) as resp:
-        resp.read()
+        }
+        for attempt in (0, 1):
+            conn = self._connection()
+            if conn.sock is not None:
+                break
+            try:
+                conn.connect()
+                break
+            except OSError:
+                self._drop_connection()
+                if attempt:
+                    raise
+        try:
+            conn.request('POST', self._path, body=body, headers=headers)
+            resp = conn.getresponse()
+            text = resp.read()
+        except (http.client.HTTPException, OSError):
+            # the batch may have been delivered, so don't send it again
+            self._drop_connection()
+            raise
+        if resp.will_close:
+            self._drop_connection()
+        return resp.status, text
+
+    def _send_batch(self, emails, subject, content, substitutions, api_key, from_email):
+        started = time.perf_counter()
+        results = self._deliver(emails, subject, content, substitutions, api_key, from_email)
+        MAIL_SECONDS.observe(time.perf_counter() - started)
+        failed = sum(1 for result in results if not result.ok)
+        MAIL_RECIPIENTS.inc(len(results) - failed, result='ok')
+        if failed:
+            MAIL_RECIPIENTS.inc(failed, result='failed')
+        return results
+
+    def _deliver(self, emails, subject, content, substitutions, api_key, from_email):
+        personalizations = []
+        for email in emails:
+            p = {"to": [{"email": email}]}
+            if substitutions and email in substitutions:
+                p["substitutions"] = substitutions[email]
+            personalizations.append(p)
+        payload = {
+            "personalizations": personalizations,
+            "from": {"email": from_email},
+            "subject": subject,
+            "content": [{"type": "text/plain", "value": content}],
+        }
+        try:
+            status, text = self._post(json.dumps(payload).encode('utf-8'), api_key)
+        except Exception as exc:
+            return [DeliveryResult(e, False, None, str(exc)) for e in emails]
+        if status >= 400:
+            error = text.decode('utf-8', 'replace')[:200]
+            return [DeliveryResult(e, False, status, error) for e in emails]
+        return [DeliveryResult(e, True, status) for e in emails]
+
+    def send(
+        self,
+        recipients: Iterable[str],
+        subject: str,
+        content: str,
+        substitutions: Optional[Dict[str, Dict[str, str]]] = None,
+    ) -> Dict[str, DeliveryResult]:
+        """Send one message to many recipients and return a result per address.
+
+        ``substitutions`` optionally maps an address to the SendGrid
+        substitution tags used in that recipient's copy of ``content``.
+        """
+        api_key, from_email = _settings()
+        emails = list(dict.fromkeys(e for e in recipients if e))
+        if not emails:
+            return {}
+        batches = [
+            emails[i:i + self.batch_size]
+            for i in range(0, len(emails), self.batch_size)
+        ]
+        pool = self._pool()
+        futures = [
+            pool.submit(self._send_batch, batch, subject, content, substitutions, api_key, from_email)
+            for batch in batches
+        ]
+        results = {}
+        for future in futures:
+            for result in future.result():
+                results[result.email] = result
+        return results
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+_mailer = None
+_mailer_lock = threading.Lock()
+
+
+def get_mailer() -> Mailer:
+    global _mailer
+    with _mailer_lock:
+        if _mailer is None:
+            _mailer = Mailer()
+        return _mailer
+
+
+def send_bulk(
+    recipients: Iterable[str],
+    subject: str,
+    content: str,
+    substitutions: Optional[Dict[str, Dict[str, str]]] = None,
+) -> Dict[str, DeliveryResult]:
+    """Send a message to several recipients using the shared mailer."""
+    return get_mailer().send(recipients, subject, content, substitutions)
+
+
+def send_email(to_email: str, subject: str, content: str) -> None:
+    """Send a simple email via SendGrid."""
+    result = send_bulk([to_email], subject, content).get(to_email)
+    if result is not None and not result.ok:
+        raise RuntimeError(f'Email to {to_email} failed: {result.status} {result.error}')
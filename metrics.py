@@ -0,0 +1,352 @@
+"""Application metrics in the Prometheus text exposition format.
+
+Counters and histograms live in this process. With ``METRICS_MULTIPROC_DIR``
+set, every gunicorn worker also writes a snapshot of them to
+``<dir>/metrics-<pid>.json`` every ``METRICS_FLUSH_INTERVAL`` seconds (and
+just before answering a scrape), and ``/metrics`` merges the files of all
+workers: counters and histograms are summed, including those of workers
+that have exited, while gauges only count workers that are still alive.
+When gunicorn reaps a worker, ``mark_process_dead`` folds its counters and
+histograms into ``metrics-dead.json`` and removes its file, so a later
+process that reuses the pid does not bring its gauges back.
+Point the directory at a fresh, empty location on every deploy.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR')
+FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        """Register ``func`` returning ``(name, type, help, {labels: value})`` tuples.
+
+        Collectors report values owned by other modules (event queues, the
+        connection pool) at snapshot time; ``type`` is counter or gauge.
+        """
+        self.collectors.append(func)
+        return func
+
+    def snapshot(self):
+        """Return this process' metrics as a JSON-serialisable dict."""
+        result = {}
+        for metric in self.metrics:
+            with metric._lock:
+                samples = [[list(k), v if metric.type == 'counter' else [list(v[0]), v[1], v[2]]]
+                           for k, v in metric.values.items()]
+            result[metric.name] = {
+                'type': metric.type,
+                'help': metric.help,
+                'labels': list(metric.labels),
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'samples': samples,
+            }
+        for collect in self.collectors:
+            for name, kind, help, values in collect():
+                labels = sorted({k for key in values for k, _ in key})
+                result[name] = {
+                    'type': kind,
+                    'help': help,
+                    'labels': labels,
+                    'buckets': [],
+                    'samples': [[[dict(key).get(l, '') for l in labels], v] for key, v in values.items()],
+                }
+        return result
+
+
+registry = Registry()
+
+REQUESTS = registry.counter(
+    'http_requests_total', 'HTTP requests by endpoint, method and status.', ('endpoint', 'method', 'status')
+)
+REQUEST_SECONDS = registry.histogram(
+    'http_request_duration_seconds', 'Time to handle a request.', ('endpoint', 'method')
+)
+DB_QUERIES = registry.histogram(
+    'db_queries_per_request', 'Database statements executed per request.', ('endpoint',), COUNT_BUCKETS
+)
+DB_SECONDS = registry.histogram(
+    'db_query_seconds_per_request', 'Time spent in database statements per request.', ('endpoint',)
+)
+MAIL_SECONDS = registry.histogram('mail_send_duration_seconds', 'Time to deliver one batch of email.')
+MAIL_RECIPIENTS = registry.counter('mail_recipients_total', 'Email recipients by delivery result.', ('result',))
+BILLS_PUBLISHED = registry.counter('bills_published_total', 'Bills published.')
+
+
+@registry.collector
+def _event_stats():
+    from events import stats
+    current = stats()
+    return [
+        ('sse_events_published_total', 'counter', 'Events published by this worker.',
+         {(): current['published']}),
+        ('sse_events_delivered_total', 'counter', 'Events queued for SSE listeners.',
+         {(): current['delivered']}),
+        ('sse_events_dropped_total', 'counter', 'Events dropped from full listener queues.',
+         {(): current['dropped']}),
+        ('sse_listeners', 'gauge', 'Open SSE streams.', {(): current['listeners']}),
+        ('sse_queued_events', 'gauge', 'Events waiting in SSE listener queues.', {(): current['queued']}),
+    ]
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def merge(snapshots):
+    """Merge ``(alive, snapshot)`` pairs from several processes into one snapshot."""
+    merged = {}
+    for alive, snapshot in snapshots:
+        for name, metric in snapshot.items():
+            if metric['type'] == 'gauge' and not alive:
+                continue
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for key, value in metric['samples']:
+                key = tuple(key)
+                current = target['samples'].get(key)
+                if metric['type'] == 'histogram':
+                    if current is None:
+                        current = target['samples'][key] = [[0] * len(value[0]), 0.0, 0]
+                    current[0] = [a + b for a, b in zip(current[0], value[0])]
+                    current[1] += value[1]
+                    current[2] += value[2]
+                else:
+                    target['samples'][key] = (current or 0) + value
+    return merged
+
+
+def render(merged):
+    """Return ``merged`` metrics in the Prometheus text format."""
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for key, value in sorted(metric['samples'].items()):
+            if metric['type'] != 'histogram':
+                lines.append(f"{name}{_format_labels(metric['labels'], key)} {_format_value(value)}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket in zip(list(metric['buckets']) + ['+Inf'], counts):
+                cumulative += bucket
+                le = bound if bound == '+Inf' else _format_value(bound)
+                lines.append(f"{name}_bucket{_format_labels(metric['labels'], key, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(metric['labels'], key)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(metric['labels'], key)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def write_snapshot(directory=None):
+    directory = directory or MULTIPROC_DIR
+    os.makedirs(directory, exist_ok=True)
+    _write_json(directory, f'metrics-{os.getpid()}.json', registry.snapshot())
+
+
+DEAD_SNAPSHOT = 'metrics-dead.json'
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(directory, name, data):
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(data, fh)
+    os.replace(tmp, os.path.join(directory, name))
+
+
+def mark_process_dead(pid, directory=None):
+    """Fold the snapshot of exited worker ``pid`` into the dead snapshot, without its gauges."""
+    directory = directory or MULTIPROC_DIR
+    path = os.path.join(directory, f'metrics-{pid}.json')
+    snapshot = _read_snapshot(path)
+    if snapshot is not None:
+        dead = _read_snapshot(os.path.join(directory, DEAD_SNAPSHOT)) or {}
+        merged = merge([(False, dead), (False, snapshot)])
+        _write_json(directory, DEAD_SNAPSHOT, {
+            name: dict(metric, samples=[[list(key), value] for key, value in metric['samples'].items()])
+            for name, metric in merged.items()
+        })
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def exposition(directory=None):
+    """Return the text for ``/metrics``: this process, or every worker in ``directory``."""
+    directory = directory or MULTIPROC_DIR
+    if not directory:
+        return render(merge([(True, registry.snapshot())]))
+    write_snapshot(directory)
+    snapshots = []
+    for name in os.listdir(directory):
+        if not (name.startswith('metrics-') and name.endswith('.json')):
+            continue
+        snapshot = _read_snapshot(os.path.join(directory, name))
+        if snapshot is None:
+            continue
+        pid = name[len('metrics-'):-len('.json')]
+        snapshots.append((pid.isdigit() and _pid_alive(int(pid)), snapshot))
+    return render(merge(snapshots))
+
+
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def _start_flusher():
+    """Start the snapshot thread of this worker, once per process."""
+    global _flusher_pid
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+
+    def run():
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                write_snapshot()
+            except OSError:
+                pass
+
+    threading.Thread(target=run, name='metrics-flush', daemon=True).start()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        context._metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_started', None)
+    if started is not None and has_request_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+        g.db_seconds = g.get('db_seconds', 0.0) + time.perf_counter() - started
+
+
+def init_app(app):
+    """Record request latency, status and database use for every request."""
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+        if MULTIPROC_DIR:
+            _start_flusher()
+
+    @app.after_request
+    def _record_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _record_request(exc):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        status = g.pop('metrics_status', 500 if exc is not None else 200)
+        REQUESTS.inc(endpoint=endpoint, method=request.method, status=status)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+        DB_QUERIES.observe(g.pop('db_queries', 0), endpoint=endpoint)
+        DB_SECONDS.observe(g.pop('db_seconds', 0.0), endpoint=endpoint)
@@ -0,0 +1,48 @@
+"""add member_balance table
+
+Revision ID: 9c2e7d4b1a3f
+Revises: f671c5e1b0b8
+Create Date: 2026-10-18 09:00:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = '9c2e7d4b1a3f'
+down_revision = 'f671c5e1b0b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'member_balance',
+        sa.Column('bill_id', sa.Integer(), sa.ForeignKey('bill.id'), nullable=False),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('user.id'), nullable=False),
+        sa.Column('amount_owed', sa.Numeric(10, 2), nullable=False),
+        sa.Column('amount_paid', sa.Numeric(10, 2), nullable=False),
+        sa.Column('outstanding', sa.Numeric(10, 2), nullable=False),
+        sa.PrimaryKeyConstraint('bill_id', 'user_id'),
+    )
+    # backfill from existing items and payments
+    op.execute(
+        """
+        INSERT INTO member_balance (bill_id, user_id, amount_owed, amount_paid, outstanding)
+        SELECT o.bill_id, o.user_id, o.owed, COALESCE(p.paid, 0), o.owed - COALESCE(p.paid, 0)
+        FROM (
+            SELECT bill_id, user_id, COALESCE(SUM(amount), 0) AS owed
+            FROM bill_item WHERE user_id IS NOT NULL
+            GROUP BY bill_id, user_id
+        ) o
+        LEFT JOIN (
+            SELECT bi.bill_id, bi.user_id, SUM(pay.amount) AS paid
+            FROM payment pay JOIN bill_item bi ON bi.id = pay.bill_item_id
+            WHERE bi.user_id IS NOT NULL
+            GROUP BY bi.bill_id, bi.user_id
+        ) p ON p.bill_id = o.bill_id AND p.user_id = o.user_id
+        """
+    )
+
+
+def downgrade():
+    op.drop_table('member_balance')
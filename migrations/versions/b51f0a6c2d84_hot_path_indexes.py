@@ -0,0 +1,31 @@
+"""add indexes for the hot query paths
+
+Revision ID: b51f0a6c2d84
+Revises: 9c2e7d4b1a3f
+Create Date: 2026-10-18 10:00:00
+"""
+
+from alembic import op
+
+revision = 'b51f0a6c2d84'
+down_revision = '9c2e7d4b1a3f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_bill_family_published', 'bill', ['family_id', 'published_at'])
+    op.create_index('ix_bill_item_bill_user', 'bill_item', ['bill_id', 'user_id'])
+    op.create_index('ix_bill_item_user', 'bill_item', ['user_id'])
+    op.create_index('ix_payment_bill_item', 'payment', ['bill_item_id'])
+    op.create_index('ix_notification_log_user_sent', 'notification_log', ['user_id', 'sent_at'])
+    op.create_index('ix_notification_log_bill_user', 'notification_log', ['bill_id', 'user_id'])
+
+
+def downgrade():
+    op.drop_index('ix_notification_log_bill_user', table_name='notification_log')
+    op.drop_index('ix_notification_log_user_sent', table_name='notification_log')
+    op.drop_index('ix_payment_bill_item', table_name='payment')
+    op.drop_index('ix_bill_item_user', table_name='bill_item')
+    op.drop_index('ix_bill_item_bill_user', table_name='bill_item')
+    op.drop_index('ix_bill_family_published', table_name='bill')
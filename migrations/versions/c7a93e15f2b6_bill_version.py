@@ -0,0 +1,26 @@
+"""add version and updated_at to bill
+
+Revision ID: c7a93e15f2b6
+Revises: b51f0a6c2d84
+Create Date: 2026-10-18 11:00:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'c7a93e15f2b6'
+down_revision = 'b51f0a6c2d84'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('bill', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+    op.add_column('bill', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.execute('UPDATE bill SET updated_at = published_at')
+
+
+def downgrade():
+    with op.batch_alter_table('bill') as batch_op:
+        batch_op.drop_column('updated_at')
+        batch_op.drop_column('version')
@@ -0,0 +1,36 @@
+"""add idempotency_key table
+
+Revision ID: d4e8b2a91f37
+Revises: c7a93e15f2b6
+Create Date: 2026-10-18 14:00:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'd4e8b2a91f37'
+down_revision = 'c7a93e15f2b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'idempotency_key',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('user.id'), nullable=False),
+        sa.Column('key', sa.String(255), nullable=False),
+        sa.Column('request_hash', sa.String(64), nullable=False),
+        sa.Column('status', sa.SmallInteger(), nullable=True),
+        sa.Column('content_type', sa.String(100), nullable=True),
+        sa.Column('body', sa.LargeBinary(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.UniqueConstraint('user_id', 'key', name='uq_idempotency_key_user_key'),
+    )
+    op.create_index('ix_idempotency_key_expires', 'idempotency_key', ['expires_at'])
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_key_expires', table_name='idempotency_key')
+    op.drop_table('idempotency_key')
@@ -0,0 +1,36 @@
+"""add paid_total to bill_item
+
+Revision ID: e1f5a7c3b9d2
+Revises: d4e8b2a91f37
+Create Date: 2026-10-18 15:00:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'e1f5a7c3b9d2'
+down_revision = 'd4e8b2a91f37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'bill_item',
+        sa.Column('paid_total', sa.Numeric(10, 2), nullable=False, server_default='0'),
+    )
+    # backfill from existing payments
+    op.execute(
+        """
+        UPDATE bill_item SET paid_total = (
+            SELECT COALESCE(SUM(payment.amount), 0) FROM payment
+            WHERE payment.bill_item_id = bill_item.id
+        )
+        WHERE EXISTS (SELECT 1 FROM payment WHERE payment.bill_item_id = bill_item.id)
+        """
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('bill_item') as batch_op:
+        batch_op.drop_column('paid_total')
@@ -0,0 +1,27 @@
+"""add indexes for the reminder sweep
+
+Revision ID: f3b9d6e2a8c4
+Revises: e1f5a7c3b9d2
+Create Date: 2026-10-18 16:00:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'f3b9d6e2a8c4'
+down_revision = 'e1f5a7c3b9d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_bill_due_date', 'bill', ['due_date', 'id'])
+    op.create_index(
+        'ix_bill_item_unpaid', 'bill_item', ['bill_id', 'user_id'],
+        postgresql_where=sa.text('paid_at IS NULL'), sqlite_where=sa.text('paid_at IS NULL'),
+    )
+
+
+def downgrade():
+    op.drop_index('ix_bill_item_unpaid', table_name='bill_item')
+    op.drop_index('ix_bill_due_date', table_name='bill')
@@ -1,11 +1,15 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from replica import RoutingSession
 
 # SQLAlchemy instance used across the application
 # It will be initialized in app.py
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -40,35 +44,84 @@ class Bill(db.Model):
     due_date = db.Column(db.Date)
     pdf_url = db.Column(db.String(255))
     published_at = db.Column(db.DateTime)
+    # bumped by touch_bills whenever the bill, its items or their payments change
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     family = db.relationship('Family', back_populates='bills')
     items = db.relationship('BillItem', back_populates='bill')
     notifications = db.relationship('NotificationLog', back_populates='bill')
     creator = db.relationship('User', back_populates='created_bills', foreign_keys=[created_by])
 
+    __table_args__ = (
+        # latest published bill for a family (dashboard)
+        db.Index('ix_bill_family_published', 'family_id', 'published_at'),
+        # bills falling due, walked with a (due_date, id) cursor (reminders)
+        db.Index('ix_bill_due_date', 'due_date', 'id'),
+    )
+
 class BillItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    bill_id = db.Column(db.Integer, db.ForeignKey('bill.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # active_history keeps the previous value when these change so the
+    # member balance can be moved from the old to the new owner/amount
+    bill_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('bill.id'), nullable=False), active_history=True
+    )
+    user_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('user.id')), active_history=True
+    )
     description = db.Column(db.String(200))
-    amount = db.Column(db.Numeric(10, 2))
+    amount = db.column_property(db.Column(db.Numeric(10, 2)), active_history=True)
     is_recurring = db.Column(db.Boolean, default=False)
     paid_at = db.Column(db.DateTime)
+    # sum of the item's payments, maintained by balances.apply_payments
+    paid_total = db.Column(db.Numeric(10, 2), nullable=False, default=0, server_default='0')
 
     bill = db.relationship('Bill', back_populates='items')
     user = db.relationship('User', back_populates='bill_items')
     payments = db.relationship('Payment', back_populates='bill_item')
 
+    __table_args__ = (
+        # items of a bill, optionally for one member (bill_info, balances)
+        db.Index('ix_bill_item_bill_user', 'bill_id', 'user_id'),
+        db.Index('ix_bill_item_user', 'user_id'),
+        # only the unpaid items of a bill (reminders)
+        db.Index(
+            'ix_bill_item_unpaid', 'bill_id', 'user_id',
+            postgresql_where=db.text('paid_at IS NULL'), sqlite_where=db.text('paid_at IS NULL'),
+        ),
+    )
+
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    bill_item_id = db.Column(db.Integer, db.ForeignKey('bill_item.id'), nullable=False)
+    bill_item_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('bill_item.id'), nullable=False), active_history=True
+    )
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    amount = db.Column(db.Numeric(10, 2))
+    amount = db.column_property(db.Column(db.Numeric(10, 2)), active_history=True)
     paid_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     bill_item = db.relationship('BillItem', back_populates='payments')
     user = db.relationship('User')
 
+    __table_args__ = (
+        db.Index('ix_payment_bill_item', 'bill_item_id'),
+    )
+
+class MemberBalance(db.Model):
+    """What each member owes on a bill, kept in step with BillItem and Payment.
+
+    Rows are maintained by ``balances`` whenever items or payments are
+    flushed, so reads never have to aggregate the item table.
+    """
+
+    bill_id = db.Column(db.Integer, db.ForeignKey('bill.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    amount_owed = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+    amount_paid = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+    outstanding = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+
+
 class NotificationLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -79,6 +132,12 @@ class NotificationLog(db.Model):
     user = db.relationship('User', back_populates='notifications')
     bill = db.relationship('Bill', back_populates='notifications')
 
+    __table_args__ = (
+        # a member's notification history, newest first
+        db.Index('ix_notification_log_user_sent', 'user_id', 'sent_at'),
+        db.Index('ix_notification_log_bill_user', 'bill_id', 'user_id'),
+    )
+
 
 class Invitation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -89,3 +148,68 @@ class Invitation(db.Model):
     accepted_at = db.Column(db.DateTime)
 
     family = db.relationship('Family', back_populates='invitations')
+
+
+class IdempotencyKey(db.Model):
+    """A client's ``Idempotency-Key`` for an API write and the response it got.
+
+    ``status`` stays NULL while the first request with the key is running.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    key = db.Column(db.String(255), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.SmallInteger)
+    content_type = db.Column(db.String(100))
+    body = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'key', name='uq_idempotency_key_user_key'),
+        db.Index('ix_idempotency_key_expires', 'expires_at'),
+    )
+
+
+def touch_bills(conn, bill_ids=(), item_ids=()):
+    """Bump the version of the given bills and of the bills owning ``item_ids``.
+
+    Clients that cached a bill revalidate against its version, so anything
+    that writes items or payments with Core statements must call this.
+    """
+    bill = Bill.__table__
+    conditions = []
+    if bill_ids:
+        conditions.append(bill.c.id.in_(set(bill_ids)))
+    if item_ids:
+        conditions.append(bill.c.id.in_(
+            select(BillItem.bill_id).where(BillItem.id.in_(set(item_ids))).scalar_subquery()
+        ))
+    if not conditions:
+        return
+    conn.execute(
+        bill.update()
+        .where(conditions[0] if len(conditions) == 1 else conditions[0] | conditions[1])
+        .values(version=bill.c.version + 1, updated_at=datetime.utcnow())
+    )
+
+
+@event.listens_for(Session, 'after_flush')
+def _touch_changed_bills(session, flush_context):
+    bill_ids, item_ids = set(), set()
+    for obj in session.dirty:
+        if isinstance(obj, Bill) and session.is_modified(obj, include_collections=False):
+            bill_ids.add(obj.id)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, BillItem):
+            if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+                continue
+            bill_ids.add(obj.bill_id)
+            hist = inspect(obj).attrs.bill_id.history
+            bill_ids.update(hist.deleted)
+        elif isinstance(obj, Payment):
+            item_ids.add(obj.bill_item_id)
+    bill_ids.discard(None)
+    if bill_ids or item_ids:
+        touch_bills(session.connection(), bill_ids, item_ids)
@@ -0,0 +1,64 @@
+"""Password hashing with a configurable method and optional process pool.
+
+``PASSWORD_HASH_METHOD`` takes any method werkzeug understands, with its
+cost parameters, e.g. ``scrypt:32768:8:1`` or ``pbkdf2:sha256:600000``.
+Hashes made with other parameters still verify and are upgraded by
+``signin`` on the next successful login.
+
+With ``PASSWORD_HASH_WORKERS`` set, hashing and verification run in a pool
+of worker processes so a slow hash does not hold the request worker's CPU
+(or, under gevent, every other greenlet in the worker).
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '0'))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _executor():
+    """Return this process' hashing pool, re-created after a fork."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # spawn rather than fork: the pool may be started from a worker
+            # with live threads, greenlets and database connections
+            _pool = ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _run(func, *args):
+    if WORKERS > 0:
+        return _executor().submit(func, *args).result()
+    return func(*args)
+
+
+@lru_cache(maxsize=None)
+def _method_prefix(method):
+    # werkzeug fills in default parameters, e.g. 'pbkdf2' -> 'pbkdf2:sha256:1000000'
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+def hash_password(password, method=None):
+    return _run(generate_password_hash, password, method or METHOD)
+
+
+def verify_password(pwhash, password):
+    if not pwhash or password is None:
+        return False
+    return _run(check_password_hash, pwhash, password)
+
+
+def needs_rehash(pwhash, method=None):
+    """Return True if ``pwhash`` was not made with the configured method and cost."""
+    return pwhash.split('$', 1)[0] != _method_prefix(method or METHOD)
@@ -0,0 +1,106 @@
+"""Bill publishing shared by the add-item form and the bills API.
+
+A bill, its items and the notification log rows are written with bulk
+INSERTs in one transaction, and the family's members are taken from the
+already loaded ``family.members`` instead of being fetched one by one.
+Emails, the SSE update and the statement rendering go out only after
+the transaction commits, and a failure in any of them is logged rather
+than turned into an error for a write that has already happened.
+"""
+import json
+from datetime import datetime
+from decimal import Decimal
+
+from flask import current_app
+
+from balances import apply_deltas
+from events import send_event
+from mailer import send_bulk
+from metrics import BILLS_PUBLISHED
+from statements import schedule as schedule_statement
+from models import db, Bill, BillItem, NotificationLog
+
+
+def publish_bill(family, created_by, subject, body, items=None, description=None,
+                 recipients=None, **fields):
+    """Create and publish a bill for ``family`` and notify its members.
+
+    ``items`` maps member ids to the amount each one owes for
+    ``description``. ``recipients`` defaults to every family member.
+    ``body`` is the email text, or a callable that builds it from the new
+    bill id. Extra keyword arguments are set on the ``Bill``.
+    """
+    items = items or {}
+    recipients = family.members if recipients is None else recipients
+    bill = Bill(
+        family_id=family.id,
+        created_by=created_by,
+        published_at=datetime.utcnow(),
+        **fields,
+    )
+    db.session.add(bill)
+    db.session.flush()
+    conn = db.session.connection()
+    if items:
+        conn.execute(
+            BillItem.__table__.insert(),
+            [
+                {
+                    'bill_id': bill.id,
+                    'user_id': uid,
+                    'description': description,
+                    'amount': amount,
+                    'is_recurring': False,
+                }
+                for uid, amount in items.items()
+            ],
+        )
+        # Core inserts bypass the ORM flush hook that maintains balances
+        apply_deltas(conn, {
+            (bill.id, uid): (Decimal(str(amount)), Decimal(0)) for uid, amount in items.items()
+        })
+    if recipients:
+        conn.execute(
+            NotificationLog.__table__.insert(),
+            [
+                {'user_id': m.id, 'bill_id': bill.id, 'message': subject, 'sent_at': bill.published_at}
+                for m in recipients
+            ],
+        )
+    bill_id, family_id = bill.id, family.id
+    amount = float(fields.get('total_amount') or 0)
+    emails = [m.email for m in recipients]
+    db.session.commit()
+    BILLS_PUBLISHED.inc()
+
+    notify(emails, subject, body(bill_id) if callable(body) else body)
+    announce(bill_id, family_id, amount)
+    return bill_id
+
+
+def announce(bill_id, family_id, amount):
+    """Send the family's SSE update and schedule the bill's statement.
+
+    Call it after the bill's changes commit; failures are logged, not raised.
+    """
+    try:
+        send_event(json.dumps({'amount': amount}), family_id=family_id)
+    except Exception as exc:
+        current_app.logger.warning('Update for bill %s not sent: %s', bill_id, exc)
+    try:
+        schedule_statement(bill_id)
+    except Exception as exc:
+        current_app.logger.warning('Statement of bill %s not scheduled: %s', bill_id, exc)
+
+
+def notify(emails, subject, body):
+    """Email ``emails`` and log, rather than raise, delivery failures."""
+    try:
+        results = send_bulk(emails, subject, body)
+    except Exception as exc:
+        current_app.logger.warning('Email delivery skipped: %s', exc)
+        return {}
+    for result in results.values():
+        if not result.ok:
+            current_app.logger.warning('Email to %s failed: %s', result.email, result.error)
+    return results
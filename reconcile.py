@@ -0,0 +1,211 @@
+"""Match a bank or processor payment export to open bill items in bulk.
+
+The open items are loaded once into in-memory indexes keyed by item id
+(for payments whose reference names an item, e.g. ``FPP-123``) and by
+``(user, outstanding amount)``. Matched payments are inserted with bulk
+INSERTs, and the items' paid totals are then bumped with one batched UPDATE
+that also marks the items they settle as paid.
+"""
+import re
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select
+
+from balances import apply_deltas, apply_payments
+from ingest import parse_csv
+from models import db, BillItem, Payment, User, touch_bills
+
+payments_cli = AppGroup('payments', help='Payment maintenance commands.')
+
+CHUNK_SIZE = 1000
+MAX_UNMATCHED = 1000
+REFERENCE_PATTERN = re.compile(r'\b(?:FPP|ITEM)[-# ]?(\d+)\b', re.IGNORECASE)
+
+CENT = Decimal('0.01')
+
+
+class OpenItems:
+    """In-memory index of unpaid bill items and what is still owed on them."""
+
+    def __init__(self, rows):
+        self.items = {}
+        self.by_user_amount = defaultdict(deque)
+        for item_id, bill_id, user_id, outstanding in rows:
+            outstanding = Decimal(str(outstanding)).quantize(CENT)
+            self.items[item_id] = [bill_id, user_id, outstanding]
+            self.by_user_amount[(user_id, outstanding)].append(item_id)
+
+    @classmethod
+    def load(cls, session, family_id=None):
+        query = (
+            select(
+                BillItem.id,
+                BillItem.bill_id,
+                BillItem.user_id,
+                BillItem.amount - BillItem.paid_total,
+            )
+            .where(BillItem.paid_at.is_(None), BillItem.user_id.isnot(None))
+            .where(BillItem.amount.isnot(None))
+            .order_by(BillItem.id)
+        )
+        if family_id is not None:
+            query = query.where(
+                BillItem.user_id.in_(select(User.id).where(User.family_id == family_id))
+            )
+        return cls(session.execute(query))
+
+    def match(self, user_id, amount, reference):
+        """Return the item id ``amount`` should be applied to, or ``None``."""
+        found = REFERENCE_PATTERN.search(reference or '')
+        if found:
+            item_id = int(found.group(1))
+            item = self.items.get(item_id)
+            if item is not None and (user_id is None or item[1] == user_id):
+                return item_id
+        if user_id is None:
+            return None
+        candidates = self.by_user_amount.get((user_id, amount))
+        while candidates:
+            item_id = candidates.popleft()
+            item = self.items.get(item_id)
+            # entries go stale when an item is paid down via its reference
+            if item is not None and item[2] == amount:
+                return item_id
+        return None
+
+    def apply(self, item_id, amount):
+        """Record ``amount`` against ``item_id``; return True once it is settled."""
+        item = self.items[item_id]
+        item[2] -= amount
+        if item[2] <= 0:
+            del self.items[item_id]
+            return True
+        self.by_user_amount[(item[1], item[2])].append(item_id)
+        return False
+
+
+def _parse_amount(value):
+    try:
+        amount = Decimal(str(value).strip().lstrip('$')).quantize(CENT)
+    except (InvalidOperation, AttributeError):
+        raise ValueError('amount must be a number')
+    if not amount.is_finite() or amount <= 0:
+        raise ValueError('amount must be positive')
+    return amount
+
+
+def _parse_date(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.strip())
+    except ValueError:
+        raise ValueError('paid_at must be an ISO date')
+
+
+def reconcile(rows, family_id=None, dry_run=False):
+    """Match payment ``rows`` to open items and record them.
+
+    ``rows`` yields ``(line_number, dict)`` pairs with ``amount`` and either
+    ``user_id`` or ``email``, plus optional ``reference`` and ``paid_at``.
+    Runs inside the current transaction; the caller commits.
+    """
+    started = time.perf_counter()
+    session = db.session
+    index = OpenItems.load(session, family_id)
+    emails = {
+        email.lower(): uid
+        for uid, email in session.execute(select(User.id, User.email).where(User.email.isnot(None)))
+    }
+    conn = session.connection()
+    now = datetime.utcnow()
+    payments, settled = [], []
+    deltas = defaultdict(lambda: [Decimal(0), Decimal(0)])
+    paid = defaultdict(Decimal)
+    report = {'rows': 0, 'matched': 0, 'unmatched': 0, 'items_paid': 0, 'unmatched_rows': []}
+
+    def unmatched(number, reason):
+        report['unmatched'] += 1
+        if len(report['unmatched_rows']) < MAX_UNMATCHED:
+            report['unmatched_rows'].append({'line': number, 'reason': reason})
+
+    def flush():
+        if payments and not dry_run:
+            conn.execute(Payment.__table__.insert(), payments)
+        payments.clear()
+
+    for number, row in rows:
+        report['rows'] += 1
+        if isinstance(row, Exception):
+            unmatched(number, str(row))
+            continue
+        try:
+            amount = _parse_amount(row.get('amount'))
+            paid_at = _parse_date(row.get('paid_at')) or now
+            user_id = row.get('user_id') or None
+            user_id = int(user_id) if user_id is not None else None
+        except ValueError as exc:
+            unmatched(number, str(exc))
+            continue
+        if user_id is None and row.get('email'):
+            user_id = emails.get(row['email'].strip().lower())
+            if user_id is None:
+                unmatched(number, 'unknown email')
+                continue
+        item_id = index.match(user_id, amount, row.get('reference'))
+        if item_id is None:
+            unmatched(number, 'no open item matches')
+            continue
+        bill_id, owner_id = index.items[item_id][:2]
+        payments.append({
+            'bill_item_id': item_id,
+            'user_id': user_id or owner_id,
+            'amount': amount,
+            'paid_at': paid_at,
+        })
+        deltas[(bill_id, owner_id)][1] += amount
+        paid[item_id] += amount
+        if index.apply(item_id, amount):
+            settled.append(item_id)
+        report['matched'] += 1
+        if len(payments) >= CHUNK_SIZE:
+            flush()
+    flush()
+
+    report['items_paid'] = len(settled)
+    if not dry_run:
+        # Core statements bypass the ORM flush hooks that maintain paid
+        # totals, balances and bill versions
+        apply_payments(conn, paid, now)
+        apply_deltas(conn, {key: tuple(value) for key, value in deltas.items()})
+        touch_bills(conn, {bill_id for bill_id, _ in deltas})
+    elapsed = time.perf_counter() - started
+    report['seconds'] = round(elapsed, 3)
+    report['payments_per_second'] = round(report['rows'] / elapsed, 1) if elapsed else None
+    return report
+
+
+@payments_cli.command('reconcile')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--family-id', type=int, help='Only match items of this family.')
+@click.option('--dry-run', is_flag=True, help='Match without writing anything.')
+def reconcile_command(path, family_id, dry_run):
+    """Record the payments in a CSV export against open bill items."""
+    with open(path, 'rb') as fh:
+        report = reconcile(parse_csv(fh), family_id, dry_run)
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    for row in report['unmatched_rows']:
+        click.echo(f"line {row['line']}: {row['reason']}")
+    click.echo(
+        f"{report['matched']} of {report['rows']} payments matched, "
+        f"{report['items_paid']} items paid, "
+        f"{report['payments_per_second']} payments/s"
+    )
@@ -0,0 +1,143 @@
+"""Email members who still owe on bills that fall due soon.
+
+The sweep walks the bills due in the next ``--days`` days through the
+``(due_date, id)`` index with a keyset cursor. For each chunk it reads the
+unpaid items through the partial index on unpaid ``bill_item`` rows, so
+the work grows with the number of bills falling due, not with the billing
+history. Members who were already reminded about a bill since the start of
+the window (at least one day back from ``today``), according to
+``notification_log``, are left out. Every family gets one
+batched email, personalised through substitutions. A reminder is logged
+only once it has been delivered, so failed ones are retried on the next
+run.
+"""
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import exists, func, select, tuple_
+
+from models import db, Bill, BillItem, NotificationLog, User
+from mailer import send_bulk
+
+reminders_cli = AppGroup('reminders', help='Payment reminder commands.')
+
+CHUNK_SIZE = 500
+MESSAGE = 'Payment reminder'
+SUBJECT = 'Payment reminder'
+BODY = 'Hi -name-, -amount- is still open on your family phone bill, due -due_date-.'
+
+
+def due_bills(start, end, after=None, limit=CHUNK_SIZE):
+    """Published bills due between ``start`` and ``end``, after the ``(due_date, id)`` cursor."""
+    query = (
+        select(Bill.due_date, Bill.id, Bill.family_id)
+        .where(Bill.due_date.between(start, end), Bill.published_at.isnot(None))
+        .order_by(Bill.due_date, Bill.id)
+        .limit(limit)
+    )
+    if after is not None:
+        query = query.where(tuple_(Bill.due_date, Bill.id) > tuple_(*after))
+    return query
+
+
+def unpaid_members(bill_ids, since):
+    """What each member still owes on ``bill_ids``, unless reminded since ``since``."""
+    reminded = exists().where(
+        NotificationLog.bill_id == BillItem.bill_id,
+        NotificationLog.user_id == BillItem.user_id,
+        NotificationLog.message == MESSAGE,
+        NotificationLog.sent_at >= since,
+    )
+    outstanding = func.sum(BillItem.amount - BillItem.paid_total)
+    return (
+        select(BillItem.bill_id, BillItem.user_id, User.email, User.name, User.username, outstanding)
+        .join(User, User.id == BillItem.user_id)
+        .where(BillItem.bill_id.in_(bill_ids), BillItem.paid_at.is_(None), User.email.isnot(None), ~reminded)
+        .group_by(BillItem.bill_id, BillItem.user_id, User.email, User.name, User.username)
+        .having(outstanding > 0)
+    )
+
+
+def _send(family_rows):
+    """Email one family's members; return the ``(user_id, bill_id)`` pairs delivered."""
+    members = {}
+    for bill_id, user_id, email, name, username, amount, due_date in family_rows:
+        entry = members.setdefault(email, {'user_id': user_id, 'name': name or username, 'amount': 0,
+                                           'due_date': due_date, 'bills': []})
+        entry['amount'] += amount
+        entry['due_date'] = min(entry['due_date'], due_date)
+        entry['bills'].append(bill_id)
+    substitutions = {
+        email: {
+            '-name-': entry['name'],
+            '-amount-': f"${entry['amount']:.2f}",
+            '-due_date-': entry['due_date'].isoformat(),
+        }
+        for email, entry in members.items()
+    }
+    try:
+        results = send_bulk(list(members), SUBJECT, BODY, substitutions)
+    except Exception as exc:
+        current_app.logger.warning('Reminders not sent: %s', exc)
+        return []
+    return [
+        (entry['user_id'], bill_id)
+        for email, entry in members.items()
+        if email in results and results[email].ok
+        for bill_id in entry['bills']
+    ]
+
+
+def send_reminders(days=3, chunk_size=CHUNK_SIZE, today=None):
+    """Remind members about bills due in the next ``days`` days, committing per chunk."""
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    today = today or now.date()
+    # from the same day as the window, and never shorter than a day, so
+    # --days 0 still reminds only once
+    since = datetime.combine(today, datetime.min.time()) - timedelta(days=max(days, 1))
+    report = {'bills': 0, 'families': 0, 'reminders': 0, 'delivered': 0}
+    after = None
+    while True:
+        bills = db.session.execute(due_bills(today, today + timedelta(days=days), after, chunk_size)).all()
+        if not bills:
+            break
+        after = tuple(bills[-1][:2])
+        due = {bill_id: (due_date, family_id) for due_date, bill_id, family_id in bills}
+        families = defaultdict(list)
+        for bill_id, user_id, email, name, username, amount in db.session.execute(unpaid_members(list(due), since)):
+            due_date, family_id = due[bill_id]
+            families[family_id].append((bill_id, user_id, email, name, username, amount, due_date))
+        logs = []
+        for rows in families.values():
+            delivered = _send(rows)
+            report['reminders'] += len(rows)
+            report['delivered'] += len(delivered)
+            logs.extend(
+                {'user_id': user_id, 'bill_id': bill_id, 'message': MESSAGE, 'sent_at': now}
+                for user_id, bill_id in delivered
+            )
+        if logs:
+            db.session.execute(NotificationLog.__table__.insert(), logs)
+        db.session.commit()
+        report['bills'] += len(bills)
+        report['families'] += len(families)
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+@reminders_cli.command('send')
+@click.option('--days', type=click.IntRange(min=0), default=3, show_default=True,
+              help='Remind about bills due within this many days, at most once per window.')
+@click.option('--chunk-size', type=int, default=CHUNK_SIZE, show_default=True, help='Bills per transaction.')
+def send_command(days, chunk_size):
+    """Email members with unpaid items on bills that fall due soon."""
+    report = send_reminders(days, chunk_size)
+    click.echo(
+        f"{report['delivered']} of {report['reminders']} reminders delivered to "
+        f"{report['families']} families for {report['bills']} due bills in {report['seconds']}s"
+    )
@@ -0,0 +1,106 @@
+"""Send the reads of read-only requests to an optional replica database.
+
+With ``DATABASE_REPLICA_URL`` set, ``GET`` and ``HEAD`` requests to views
+marked with ``@read_only`` run their queries on the replica; everything
+else, and any statement that writes or locks rows, uses the primary. A
+request that writes pins its user to the primary for
+``REPLICA_STICKY_SECONDS`` (kept in the Flask session), so members read
+their own writes while the replica catches up. Writes are noticed both on
+ORM flushes and on every INSERT, UPDATE or DELETE executed through Core.
+"""
+import time
+
+from flask import g, has_app_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.dml import UpdateBase
+
+from dbpool import engine_options
+
+BIND_KEY = 'replica'
+STICKY_KEY = '_db_primary_until'
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+def read_only(view):
+    """Mark ``view`` as safe to serve from the replica."""
+    view.read_only = True
+    return view
+
+
+def binds(url):
+    """Return ``SQLALCHEMY_BINDS`` for the replica at ``url``, or ``{}``."""
+    return {BIND_KEY: dict(engine_options(url), url=url)} if url else {}
+
+
+def _writes(clause):
+    return isinstance(clause, UpdateBase) or getattr(clause, '_for_update_arg', None) is not None
+
+
+class RoutingSession(Session):
+    """``db.session`` that reads from the replica while the request allows it."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and has_app_context()
+            and g.get('db_replica')
+            and not self._flushing
+            and not _writes(clause)
+        ):
+            engine = self._db.engines.get(BIND_KEY)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _pin():
+    # the rest of the request, and the user's next requests, read from the primary
+    if has_app_context():
+        g.db_replica = False
+        g.db_wrote = True
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _pin_after_write(session, flush_context):
+    _pin()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _pin_after_core_write(conn, cursor, statement, parameters, context, executemany):
+    # bulk paths such as rollover, reconcile and ingest write with
+    # conn.execute() and never flush
+    if context is not None and (context.isinsert or context.isupdate or context.isdelete):
+        _pin()
+
+
+def _has_replica(app):
+    return BIND_KEY in app.extensions['sqlalchemy'].engines
+
+
+def init_app(app):
+    """Choose the database of every request; needs ``db`` initialised with ``app``."""
+
+    @app.before_request
+    def _choose_database():
+        view = app.view_functions.get(request.endpoint)
+        g.db_wrote = False
+        g.db_replica = bool(
+            _has_replica(app)
+            and request.method in SAFE_METHODS
+            and getattr(view, 'read_only', False)
+            and session.get(STICKY_KEY, 0) <= time.time()
+        )
+
+    @app.after_request
+    def _stick_to_primary(response):
+        wrote = g.pop('db_wrote', False) or (request.method not in SAFE_METHODS and response.status_code < 400)
+        if wrote and _has_replica(app):
+            session[STICKY_KEY] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+        return response
+
+    @app.teardown_request
+    def _reset_database(exc):
+        g.pop('db_replica', None)
+        g.pop('db_wrote', None)
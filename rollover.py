@@ -0,0 +1,164 @@
+"""Roll every family's recurring items forward into the next billing cycle.
+
+For each family the source is its latest bill of the previous
+``cycle_month``. The new bill and copies of the source's recurring items
+(for members still in the family, or shared) are created with set-based
+``INSERT ... SELECT`` statements, one chunk of families per transaction so
+no lock is held for long. A family that already has a newer bill for the
+target cycle is skipped, so running the rollover again is harmless.
+
+Rolled-over bills are published right away but nobody is emailed; members
+see them on the dashboard and in the reminders. As with any other publish,
+each chunk's bills get their statements and SSE updates once it commits.
+"""
+import time
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import Date, DateTime, Integer, case, exists, func, literal, or_, select, true
+from sqlalchemy.orm import aliased
+
+from balances import rebuild
+from metrics import BILLS_PUBLISHED
+from models import db, Bill, BillItem, Family, User
+from publishing import announce
+
+bills_cli = AppGroup('bills', help='Billing cycle commands.')
+
+CHUNK_SIZE = 500
+
+_bill = Bill.__table__
+_item = BillItem.__table__
+
+
+def previous_month(cycle_month):
+    return 12 if cycle_month == 1 else cycle_month - 1
+
+
+def _sources(conn, family_ids, cycle_month):
+    """Latest previous-cycle bill of each family that has no newer bill for ``cycle_month``."""
+    latest = (
+        select(func.max(Bill.id))
+        .where(Bill.family_id.in_(family_ids), Bill.cycle_month == previous_month(cycle_month))
+        .group_by(Bill.family_id)
+    )
+    newer = aliased(Bill)
+    rolled = exists().where(
+        newer.family_id == Bill.family_id, newer.cycle_month == cycle_month, newer.id > Bill.id
+    )
+    return conn.execute(select(Bill.id).where(Bill.id.in_(latest), ~rolled)).scalars().all()
+
+
+def rollover_chunk(conn, family_ids, cycle_month, due_date=None, created_by=None, now=None):
+    """Roll the families in ``family_ids`` over.
+
+    Return ``(bills, items)``: the ``(id, family_id, total_amount)`` rows of
+    the new bills and the number of items inserted.
+    """
+    # a concurrent rollover of the same families waits here until this one
+    # commits, and then finds their new bills in _sources
+    conn.execute(select(Family.id).where(Family.id.in_(family_ids)).order_by(Family.id).with_for_update())
+    source_ids = _sources(conn, family_ids, cycle_month)
+    if not source_ids:
+        return [], 0
+    now = now or datetime.utcnow()
+    insert = _bill.insert().from_select(
+        ['family_id', 'created_by', 'cycle_month', 'total_amount', 'due_date', 'published_at', 'updated_at'],
+        select(
+            Bill.family_id,
+            func.coalesce(literal(created_by, Integer), Bill.created_by),
+            literal(cycle_month, Integer),
+            literal(0),
+            literal(due_date, Date),
+            literal(now, DateTime),
+            literal(now, DateTime),
+        ).where(Bill.id.in_(source_ids)).order_by(Bill.id),
+    )
+    # family id -> new bill id, taken from the insert itself so a bill a
+    # manager publishes meanwhile for the same cycle is left alone
+    if conn.dialect.insert_returning:
+        new_ids = dict(conn.execute(insert.returning(_bill.c.family_id, _bill.c.id)).all())
+    else:
+        first_new_id = (conn.execute(select(func.max(Bill.id))).scalar() or 0) + 1
+        conn.execute(insert)
+        new_ids = dict(conn.execute(
+            select(Bill.family_id, Bill.id)
+            .where(Bill.id >= first_new_id, Bill.family_id.in_(family_ids), Bill.cycle_month == cycle_month)
+        ).all())
+
+    items = conn.execute(_item.insert().from_select(
+        ['bill_id', 'user_id', 'description', 'amount', 'is_recurring'],
+        select(case(new_ids, value=Bill.family_id), BillItem.user_id, BillItem.description, BillItem.amount, true())
+        .select_from(BillItem)
+        .join(Bill, Bill.id == BillItem.bill_id)
+        .outerjoin(User, User.id == BillItem.user_id)
+        .where(
+            Bill.id.in_(source_ids),
+            BillItem.is_recurring.is_(True),
+            # members who left the family stop being billed
+            or_(BillItem.user_id.is_(None), User.family_id == Bill.family_id),
+        )
+        .order_by(BillItem.id),
+    )).rowcount
+
+    bill_ids = list(new_ids.values())
+    conn.execute(
+        _bill.update()
+        .where(_bill.c.id.in_(bill_ids))
+        .values(total_amount=select(func.coalesce(func.sum(_item.c.amount), 0))
+                .where(_item.c.bill_id == _bill.c.id)
+                .scalar_subquery())
+    )
+    # Core inserts bypass the ORM flush hook that maintains balances
+    rebuild(conn, bill_ids)
+    bills = conn.execute(select(Bill.id, Bill.family_id, Bill.total_amount).where(Bill.id.in_(bill_ids))).all()
+    return bills, items
+
+
+def rollover(cycle_month, family_id=None, due_date=None, created_by=None, chunk_size=CHUNK_SIZE):
+    """Roll all families (or one) over into ``cycle_month``, committing per chunk."""
+    if not 1 <= cycle_month <= 12:
+        raise ValueError('cycle_month must be between 1 and 12')
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    report = {'families': 0, 'bills': 0, 'items': 0}
+    after = 0
+    while True:
+        query = select(Family.id).where(Family.id > after).order_by(Family.id).limit(chunk_size)
+        if family_id is not None:
+            query = query.where(Family.id == family_id)
+        family_ids = db.session.execute(query).scalars().all()
+        if not family_ids:
+            break
+        bills, items = rollover_chunk(db.session.connection(), family_ids, cycle_month, due_date, created_by, now)
+        db.session.commit()
+        if bills:
+            BILLS_PUBLISHED.inc(len(bills))
+        for bill_id, bill_family_id, amount in bills:
+            announce(bill_id, bill_family_id, float(amount or 0))
+        report['families'] += len(family_ids)
+        report['bills'] += len(bills)
+        report['items'] += items
+        after = family_ids[-1]
+    elapsed = time.perf_counter() - started
+    report['skipped'] = report['families'] - report['bills']
+    report['seconds'] = round(elapsed, 3)
+    rows = report['bills'] + report['items']
+    report['rows_per_second'] = round(rows / elapsed, 1) if elapsed else None
+    return report
+
+
+@bills_cli.command('rollover')
+@click.option('--cycle-month', type=click.IntRange(1, 12), default=lambda: datetime.utcnow().month,
+              show_default='current month', help='Cycle to create.')
+@click.option('--family-id', type=int, help='Only roll this family over.')
+@click.option('--due-date', type=click.DateTime(['%Y-%m-%d']), help='Due date of the new bills.')
+@click.option('--chunk-size', type=int, default=CHUNK_SIZE, show_default=True, help='Families per transaction.')
+def rollover_command(cycle_month, family_id, due_date, chunk_size):
+    """Create the next cycle's bills from the recurring items of the previous one."""
+    report = rollover(cycle_month, family_id, due_date.date() if due_date else None, chunk_size=chunk_size)
+    click.echo(
+        f"{report['bills']} bills and {report['items']} items created for {report['families']} families "
+        f"({report['skipped']} skipped) in {report['seconds']}s, {report['rows_per_second']} rows/s"
+    )
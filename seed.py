@@ -0,0 +1,235 @@
+"""Generate a synthetic, production-sized dataset for local testing.
+
+``flask seed`` streams families, members, invitations, bills, items,
+payments and notification logs into the database with chunked Core
+INSERTs. Primary keys are assigned here rather than read back, so rows for
+every table are generated in one pass and memory stays bounded by the
+chunk size. The same ``--seed`` always produces the same data.
+
+Family sizes, plan prices, device instalments, one-off charges and
+payment behaviour follow fixed distributions meant to resemble a family
+phone plan; older bills are more likely to be fully paid.
+"""
+import random
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, text
+
+from balances import rebuild
+from models import db, Bill, BillItem, Family, Invitation, NotificationLog, Payment, User
+from passwords import hash_password
+
+CHUNK_SIZE = 5000
+
+FAMILY_SIZES = (1, 2, 3, 4, 5, 6, 7, 8)
+FAMILY_SIZE_WEIGHTS = (5, 20, 25, 22, 14, 8, 4, 2)
+PLAN_PRICES = (30, 40, 45, 55, 65, 80)
+DEVICE_SHARE = 0.35
+ONE_OFF_SHARE = 0.15
+# (fully paid, partially paid) shares; the rest stays unpaid
+PAYMENT_SHARES = {'old': (0.92, 0.05), 'recent': (0.55, 0.2)}
+
+
+class _Writer:
+    """Buffers rows per table and flushes them in multi-row INSERTs."""
+
+    def __init__(self, conn, chunk_size):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.buffers = {}
+        self.counts = {}
+
+    def add(self, table, row):
+        buffer = self.buffers.setdefault(table, [])
+        buffer.append(row)
+        if len(buffer) >= self.chunk_size:
+            self.flush(table)
+
+    def flush(self, table=None):
+        # parents first, so foreign keys hold when they are enforced
+        for t in [table] if table is not None else list(self.buffers):
+            rows = self.buffers.get(t)
+            if rows:
+                if table is not None:
+                    self.flush_parents(t)
+                self.conn.execute(t.insert(), rows)
+                self.counts[t.name] = self.counts.get(t.name, 0) + len(rows)
+                rows.clear()
+
+    def flush_parents(self, table):
+        for fk in table.foreign_keys:
+            parent = fk.column.table
+            if parent is not table and self.buffers.get(parent):
+                self.flush(parent)
+
+
+def _next_id(conn, model):
+    return (conn.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def _sync_sequences(conn, models):
+    if conn.dialect.name != 'postgresql':
+        return
+    for model in models:
+        table = model.__table__.name
+        conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+            f'COALESCE((SELECT MAX(id) FROM "{table}"), 1))'
+        ))
+
+
+def _money(value):
+    return round(value, 2)
+
+
+def seed(conn, families, months=12, members=None, invitations=0.3, password='password',
+         seed_value=1, chunk_size=CHUNK_SIZE, now=None):
+    """Insert ``families`` synthetic families with ``months`` bills each.
+
+    ``members`` fixes the family size; by default it follows
+    ``FAMILY_SIZE_WEIGHTS``. Returns the number of rows inserted per table.
+    """
+    rng = random.Random(seed_value)
+    now = now or datetime(2024, 1, 1)
+    pwhash = hash_password(password)
+    writer = _Writer(conn, chunk_size)
+    ids = {model: _next_id(conn, model) for model in (Family, User, Invitation, Bill, BillItem, Payment, NotificationLog)}
+    first_family = ids[Family]
+    tables = {model: model.__table__ for model in ids}
+    # plan insert order matches the foreign keys
+    for model in (Family, User, Invitation, Bill, BillItem, Payment, NotificationLog):
+        writer.buffers[tables[model]] = []
+
+    def take(model):
+        value = ids[model]
+        ids[model] += 1
+        return value
+
+    for _ in range(families):
+        family_id = take(Family)
+        created = now - timedelta(days=30 * months + rng.randint(0, 365))
+        writer.add(tables[Family], {'id': family_id, 'name': f'Family {family_id}', 'created_at': created})
+        size = members or rng.choices(FAMILY_SIZES, FAMILY_SIZE_WEIGHTS)[0]
+        users = []
+        for position in range(size):
+            user_id = take(User)
+            users.append({
+                'id': user_id,
+                'plan': rng.choice(PLAN_PRICES),
+                'device': _money(rng.uniform(15, 45)) if rng.random() < DEVICE_SHARE else None,
+            })
+            writer.add(tables[User], {
+                'id': user_id,
+                'username': f'user{user_id}',
+                'name': f'Member {user_id}',
+                'email': f'user{user_id}@example.test',
+                'password_hash': pwhash,
+                'role': 'manager' if position == 0 else 'user',
+                'family_id': family_id,
+            })
+            if position:
+                writer.add(tables[Invitation], {
+                    'id': take(Invitation),
+                    'family_id': family_id,
+                    'email': f'user{user_id}@example.test',
+                    'token': f'seed-{family_id}-{user_id}',
+                    'created_at': created,
+                    'accepted_at': created + timedelta(days=rng.randint(0, 5)),
+                })
+        if rng.random() < invitations:
+            writer.add(tables[Invitation], {
+                'id': take(Invitation),
+                'family_id': family_id,
+                'email': f'pending{family_id}@example.test',
+                'token': f'seed-{family_id}-pending',
+                'created_at': now - timedelta(days=rng.randint(0, 20)),
+                'accepted_at': None,
+            })
+
+        for month in range(months):
+            bill_id = take(Bill)
+            published = now - timedelta(days=30 * (months - month))
+            paid_share, partial_share = PAYMENT_SHARES['recent' if month >= months - 2 else 'old']
+            charges = []
+            for user in users:
+                charges.append((user, f"Plan {user['plan']}", user['plan'], True))
+                if user['device']:
+                    charges.append((user, 'Device instalment', user['device'], True))
+                if rng.random() < ONE_OFF_SHARE:
+                    charges.append((user, 'Overage', _money(rng.uniform(2, 25)), False))
+            writer.add(tables[Bill], {
+                'id': bill_id,
+                'family_id': family_id,
+                'created_by': users[0]['id'],
+                'cycle_month': published.month,
+                'total_amount': _money(sum(amount for _, _, amount, _ in charges)),
+                'due_date': (published + timedelta(days=21)).date(),
+                'published_at': published,
+                'updated_at': published,
+            })
+            for user, description, amount, recurring in charges:
+                item_id = take(BillItem)
+                roll = rng.random()
+                if roll < paid_share:
+                    paid = amount
+                elif roll < paid_share + partial_share:
+                    paid = _money(amount * rng.uniform(0.2, 0.9))
+                else:
+                    paid = 0
+                paid_at = published + timedelta(days=rng.randint(1, 25))
+                writer.add(tables[BillItem], {
+                    'id': item_id,
+                    'bill_id': bill_id,
+                    'user_id': user['id'],
+                    'description': description,
+                    'amount': amount,
+                    'is_recurring': recurring,
+                    'paid_at': paid_at if paid == amount else None,
+                    'paid_total': paid,
+                })
+                if paid:
+                    writer.add(tables[Payment], {
+                        'id': take(Payment),
+                        'bill_item_id': item_id,
+                        'user_id': user['id'],
+                        'amount': paid,
+                        'paid_at': paid_at,
+                    })
+            for user in users:
+                writer.add(tables[NotificationLog], {
+                    'id': take(NotificationLog),
+                    'user_id': user['id'],
+                    'bill_id': bill_id,
+                    'message': 'New bill available',
+                    'sent_at': published,
+                })
+    writer.flush()
+    _sync_sequences(conn, ids)
+    rebuild(conn, select(Bill.id).where(Bill.family_id >= first_family))
+    return writer.counts
+
+
+@click.command('seed')
+@click.option('--families', type=int, default=1000, show_default=True)
+@click.option('--months', type=int, default=12, show_default=True, help='Bills per family.')
+@click.option('--members', type=int, help='Fixed family size instead of the default distribution.')
+@click.option('--password', default='password', show_default=True, help='Password of every seeded user.')
+@click.option('--seed', 'seed_value', type=int, default=1, show_default=True)
+@click.option('--chunk-size', type=int, default=CHUNK_SIZE, show_default=True)
+@with_appcontext
+def seed_command(families, months, members, password, seed_value, chunk_size):
+    """Fill the database with synthetic families, bills and payments."""
+    started = time.perf_counter()
+    counts = seed(
+        db.session.connection(), families, months, members,
+        password=password, seed_value=seed_value, chunk_size=chunk_size,
+    )
+    db.session.commit()
+    elapsed = time.perf_counter() - started
+    total = sum(counts.values())
+    for table, count in counts.items():
+        click.echo(f'{table:>18}: {count}')
+    click.echo(f'{total} rows in {elapsed:.1f}s = {total / elapsed:,.0f} rows/s')
@@ -0,0 +1,156 @@
+"""Opt-in tracing of the SQL statements a request (or any block) executes.
+
+``trace()`` records every statement run by any engine in the current
+thread or greenlet with its duration and the first application frame that
+caused it. Statements with the same shape (literals and ``IN`` lists
+collapsed) repeated ``N_PLUS_ONE_THRESHOLD`` times or more are reported as
+likely N+1 patterns.
+
+With ``SQLTRACE`` enabled (or in debug mode) ``init_app`` traces every
+request, logs a summary and adds an ``X-Query-Count`` response header.
+"""
+import os
+import re
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, NamedTuple
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+N_PLUS_ONE_THRESHOLD = int(os.getenv('SQLTRACE_N_PLUS_ONE', '5'))
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+_SELF = os.path.abspath(__file__)
+_active = ContextVar('sqltrace_active', default=())
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_PARAMS = re.compile(r'%\([^)]*\)s|%s|:\w+|\$\d+|\?')
+_SPACE = re.compile(r'\s+')
+
+
+class Statement(NamedTuple):
+    sql: str
+    seconds: float
+    call_site: str
+
+
+def shape(sql):
+    """Return ``sql`` with literals, parameters and ``IN`` lists normalised."""
+    sql = _PARAMS.sub('?', _LITERALS.sub('?', sql))
+    return _SPACE.sub(' ', _IN_LISTS.sub('(?)', sql)).strip()
+
+
+def _call_site():
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if (
+            filename.startswith(_ROOT)
+            and filename != _SELF
+            and os.sep + 'site-packages' + os.sep not in filename
+        ):
+            return f'{os.path.relpath(filename, _ROOT)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return '?'
+
+
+class QueryLog:
+    def __init__(self):
+        self.statements: List[Statement] = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    @property
+    def seconds(self):
+        return sum(s.seconds for s in self.statements)
+
+    def repeated(self, threshold=None):
+        """Return ``(shape, count, call_sites)`` for shapes run ``threshold`` times or more."""
+        threshold = threshold or N_PLUS_ONE_THRESHOLD
+        counts = Counter(shape(s.sql) for s in self.statements)
+        result = []
+        for sql, count in counts.most_common():
+            if count < threshold:
+                break
+            sites = Counter(s.call_site for s in self.statements if shape(s.sql) == sql)
+            result.append((sql, count, [site for site, _ in sites.most_common()]))
+        return result
+
+    def summary(self, threshold=None):
+        lines = [f'{len(self)} queries in {self.seconds * 1000:.1f}ms']
+        for sql, count, sites in self.repeated(threshold):
+            lines.append(f'  possible N+1: {count}x {sql[:200]}')
+            lines.extend(f'    at {site}' for site in sites[:3])
+        return '\n'.join(lines)
+
+    def report(self):
+        """Every statement with its timing and call site, for test failures."""
+        return '\n'.join(
+            f'{i:3d}. {s.seconds * 1000:7.2f}ms {s.call_site}\n     {_SPACE.sub(" ", s.sql)[:300]}'
+            for i, s in enumerate(self.statements, start=1)
+        )
+
+
+@contextmanager
+def trace():
+    """Record the statements executed inside the block into a ``QueryLog``."""
+    log = QueryLog()
+    _active.set(_active.get() + (log,))
+    try:
+        yield log
+    finally:
+        # removed by identity rather than with a reset token, so a block that
+        # ends in another context (a streamed response) still detaches
+        _active.set(tuple(active for active in _active.get() if active is not log))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active.get():
+        context._sqltrace = (time.perf_counter(), _call_site())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_sqltrace', None)
+    logs = _active.get()
+    if started is None or not logs:
+        return
+    record = Statement(statement, time.perf_counter() - started[0], started[1])
+    for log in logs:
+        log.statements.append(record)
+
+
+def init_app(app):
+    """Trace every request when ``SQLTRACE`` is set or the app runs in debug mode."""
+
+    @app.before_request
+    def _start_trace():
+        if not (app.config.get('SQLTRACE') or app.debug):
+            return
+        g.sqltrace = trace()
+        g.sqltrace_log = g.sqltrace.__enter__()
+
+    @app.after_request
+    def _add_header(response):
+        log = g.get('sqltrace_log')
+        if log is not None:
+            response.headers['X-Query-Count'] = str(len(log))
+        return response
+
+    @app.teardown_request
+    def _log_trace(exc):
+        context = g.pop('sqltrace', None)
+        log = g.pop('sqltrace_log', None)
+        if context is None:
+            return
+        context.__exit__(None, None, None)
+        level = 'warning' if log.repeated() else 'info'
+        getattr(app.logger, level)('%s %s: %s', request.method, request.path, log.summary())
@@ -0,0 +1,242 @@
+"""Bill statements rendered to PDF in the background and cached on disk.
+
+A statement is keyed by the SHA-256 of the data printed on it, so a bill
+whose items have not changed is never rendered twice and a changed bill
+gets a new file (and a new ``Bill.pdf_url``) rather than overwriting one a
+client may have cached. The cache directory is trimmed to
+``STATEMENT_CACHE_MAX_BYTES`` by deleting the least recently used files, at
+most once every ``STATEMENT_EVICT_INTERVAL`` seconds per process.
+
+Rendering uses its own connection, never the caller's session, and sets
+``Bill.pdf_url`` only if the bill's ``version`` is still the one read before
+the data, so a slow render of an older version cannot replace a newer one.
+
+``STATEMENT_RENDERING`` selects ``background`` (a small thread pool),
+``inline`` (render before returning, used under ``TESTING``) or ``off``.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import select
+
+from models import db, Bill, BillItem, Family, MemberBalance, User, touch_bills
+
+LINES_PER_PAGE = 54
+
+_executor = None
+_pending = set()
+_lock = threading.Lock()
+_last_evicted = None
+
+
+def cache_dir():
+    return current_app.config['STATEMENT_CACHE_DIR']
+
+
+def cache_path(digest):
+    return os.path.join(cache_dir(), digest[:2], f'{digest}.pdf')
+
+
+def statement_data(conn, bill_id):
+    """Return everything printed on the statement of ``bill_id``, or ``None``."""
+    bill = conn.execute(
+        select(Bill.id, Bill.cycle_month, Bill.total_amount, Bill.due_date, Bill.published_at, Family.name)
+        .join(Family, Family.id == Bill.family_id)
+        .where(Bill.id == bill_id)
+    ).first()
+    if bill is None:
+        return None
+    items = conn.execute(
+        select(BillItem.id, BillItem.description, BillItem.amount, User.username)
+        .outerjoin(User, User.id == BillItem.user_id)
+        .where(BillItem.bill_id == bill_id)
+        .order_by(BillItem.id)
+    )
+    balances = conn.execute(
+        select(User.username, MemberBalance.amount_owed)
+        .join(User, User.id == MemberBalance.user_id)
+        .where(MemberBalance.bill_id == bill_id)
+        .order_by(User.username)
+    )
+    return {
+        'bill': bill.id,
+        'family': bill.name,
+        'cycle_month': bill.cycle_month,
+        'total_amount': str(bill.total_amount) if bill.total_amount is not None else None,
+        'due_date': bill.due_date.isoformat() if bill.due_date else None,
+        'published_at': bill.published_at.isoformat() if bill.published_at else None,
+        'items': [[i.id, i.description, str(i.amount), i.username] for i in items],
+        'members': [[b.username, str(b.amount_owed)] for b in balances],
+    }
+
+
+def digest(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _text_lines(data):
+    lines = [
+        f"Statement for bill #{data['bill']} - {data['family']}",
+        f"Cycle: {data['cycle_month'] or '-'}    Due: {data['due_date'] or '-'}",
+        f"Published: {data['published_at'] or '-'}",
+        '',
+    ]
+    for _, description, amount, member in data['items']:
+        lines.append(f"{(member or 'family')[:20]:<20} {(description or '')[:50]:<50} {amount:>12}")
+    lines.append('')
+    for member, owed in data['members']:
+        lines.append(f'{member[:20]:<20} owes {owed:>12}')
+    lines.append(f"Total: {data['total_amount'] or '0.00'}")
+    return lines
+
+
+def _escape(text):
+    text = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return text.encode('latin-1', 'replace')
+
+
+def render_pdf(lines):
+    """Return a minimal PDF with ``lines`` set in Courier, one page per 54 lines."""
+    pages = [lines[i:i + LINES_PER_PAGE] for i in range(0, len(lines), LINES_PER_PAGE)] or [[]]
+    # objects: 1 catalog, 2 page tree, 3 font, then a page and its content per page
+    objects = [None, None, b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>']
+    kids = []
+    for page in pages:
+        stream = b'BT /F1 9 Tf 11 TL 40 800 Td ' + b' '.join(
+            b'(' + _escape(line) + b") '" for line in page
+        ) + b' ET'
+        page_id, content_id = len(objects) + 1, len(objects) + 2
+        kids.append(page_id)
+        objects.append(
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+            b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % content_id
+        )
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+    objects[0] = b'<< /Type /Catalog /Pages 2 0 R >>'
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % k for k in kids), len(kids)
+    )
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def evict(directory, max_bytes):
+    """Delete the least recently used statements until ``directory`` fits."""
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.endswith('.pdf'):
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _evict_if_due():
+    global _last_evicted
+    now = time.monotonic()
+    with _lock:
+        if _last_evicted is not None and now - _last_evicted < current_app.config['STATEMENT_EVICT_INTERVAL']:
+            return
+        _last_evicted = now
+    evict(cache_dir(), current_app.config['STATEMENT_CACHE_MAX_BYTES'])
+
+
+def render(bill_id):
+    """Render the statement of ``bill_id`` unless it is cached; return its digest."""
+    with db.engine.begin() as conn:
+        return _render(conn, bill_id)
+
+
+def _render(conn, bill_id):
+    # read before the data: a change committed in between bumps the version,
+    # and the render scheduled for that change sets the URL instead
+    version = conn.execute(select(Bill.version).where(Bill.id == bill_id)).scalar()
+    data = statement_data(conn, bill_id)
+    if version is None or data is None:
+        return None
+    key = digest(data)
+    path = cache_path(key)
+    if os.path.exists(path):
+        # refresh the mtime so eviction treats it as recently used
+        os.utime(path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(render_pdf(_text_lines(data)))
+        os.replace(tmp, path)
+        _evict_if_due()
+    # built without url_for, which needs a request outside of SERVER_NAME setups
+    url = current_app.url_map.bind('', script_name=current_app.config['APPLICATION_ROOT']).build(
+        'api.bill_statement', {'bill_id': bill_id, 'digest': key}
+    )
+    table = Bill.__table__
+    result = conn.execute(
+        table.update()
+        .where(
+            table.c.id == bill_id,
+            table.c.version == version,
+            (table.c.pdf_url != url) | table.c.pdf_url.is_(None),
+        )
+        .values(pdf_url=url)
+    )
+    if result.rowcount:
+        touch_bills(conn, [bill_id])
+    return key
+
+
+def _render_in_background(app, bill_id):
+    with _lock:
+        _pending.discard(bill_id)
+    with app.app_context():
+        try:
+            render(bill_id)
+        except Exception:
+            app.logger.exception('Rendering the statement of bill %s failed', bill_id)
+
+
+def schedule(bill_id):
+    """Queue ``bill_id`` for rendering; call after the changes are committed."""
+    mode = current_app.config['STATEMENT_RENDERING']
+    if mode == 'off':
+        return
+    if mode == 'inline' or current_app.testing:
+        render(bill_id)
+        return
+    global _executor
+    with _lock:
+        if bill_id in _pending:
+            return
+        _pending.add(bill_id)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=current_app.config['STATEMENT_WORKERS'], thread_name_prefix='statements'
+            )
+        executor = _executor
+    executor.submit(_render_in_background, current_app._get_current_object(), bill_id)
@@ -0,0 +1,26 @@
+from contextlib import contextmanager
+
+import pytest
+
+import sqltrace
+
+
+@pytest.fixture
+def query_budget():
+    """Fail the test if the block runs more than ``limit`` SQL statements.
+
+    ``with query_budget(3) as log: client.get(...)``; ``log`` is the
+    ``sqltrace.QueryLog`` of the block.
+    """
+
+    @contextmanager
+    def budget(limit):
+        with sqltrace.trace() as log:
+            yield log
+        if len(log) > limit:
+            pytest.fail(
+                f'{len(log)} queries, budget was {limit}\n{log.summary()}\n{log.report()}',
+                pytrace=False,
+            )
+
+    return budget
@@ -1,5 +1,6 @@
 import os
 import json
+from datetime import datetime
 import pytest
 from werkzeug.security import generate_password_hash
 from itsdangerous import URLSafeTimedSerializer
@@ -8,8 +9,10 @@ from itsdangerous import URLSafeTimedSerializer
 os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
 
 import app
+import events
+from events import send_event
 from app import app as flask_app
-from models import db, User, Family, Bill, BillItem, NotificationLog, Invitation, Payment
+from models import db, User, Family, Bill, BillItem, MemberBalance, NotificationLog, Invitation, Payment
 
 
 @pytest.fixture
@@ -58,10 +61,11 @@ def test_get_bill_detail(client):
 def test_publish_bill_sends_emails(client, monkeypatch):
     sent = []
 
-    def fake_send(to_email, subject, body):
-        sent.append((to_email, subject, body))
+    def fake_send(recipients, subject, body):
+        sent.extend((to_email, subject, body) for to_email in recipients if to_email)
+        return {}
 
-    monkeypatch.setattr('api.send_email', fake_send)
+    monkeypatch.setattr('publishing.send_bulk', fake_send)
 
     with flask_app.app_context():
         family = Family.query.first()
@@ -137,6 +141,66 @@ def test_events_stream(client):
     assert rv.status_code == 200
     assert rv.mimetype == 'text/event-stream'
     assert rv.is_streamed
+    assert next(rv.response) == b'retry: 2000\n\n'
+    assert events.stats()['listeners'] == 1
+    rv.close()
+    assert events.stats()['listeners'] == 0
+
+
+def test_events_stream_closed_before_first_chunk(client):
+    login(client)
+    rv = client.get('/events', buffered=False)
+    rv.close()
+    assert events.stats()['listeners'] == 0
+
+
+def test_events_stream_delivers_family_events(client):
+    with flask_app.app_context():
+        family = Family.query.first()
+        member = User(
+            username='streamer',
+            password_hash=generate_password_hash('pw'),
+            family_id=family.id,
+        )
+        db.session.add(member)
+        db.session.commit()
+        fam_id = family.id
+
+    flask_app.config['SSE_HEARTBEAT'] = 0.05
+    login(client, 'streamer', 'pw')
+    rv = client.get('/events', buffered=False)
+    try:
+        frames = iter(rv.response)
+        next(frames)
+        assert next(frames) == b': keep-alive\n\n'
+        send_event('{"amount": 5}', family_id=fam_id)
+        send_event('{"amount": 9}', family_id=fam_id + 1)
+        assert next(frames).endswith(b'\ndata: {"amount": 5}\n\n')
+        assert next(frames) == b': keep-alive\n\n'
+    finally:
+        rv.close()
+        flask_app.config['SSE_HEARTBEAT'] = 15.0
+
+
+def test_events_stream_replays_after_last_event_id(client):
+    with flask_app.app_context():
+        fam_id = Family.query.first().id
+        manager = User.query.filter_by(username='manager').first()
+        manager.family_id = fam_id
+        db.session.commit()
+
+    send_event('{"amount": 1}', family_id=fam_id)
+    last_id = events.latest_id([events.family_topic(fam_id)])
+    send_event('{"amount": 2}', family_id=fam_id)
+
+    login(client)
+    rv = client.get('/events', headers={'Last-Event-ID': str(last_id)}, buffered=False)
+    try:
+        frames = iter(rv.response)
+        next(frames)
+        assert next(frames).endswith(b'data: {"amount": 2}\n\n')
+    finally:
+        rv.close()
 
 
 def test_record_payment_marks_item_paid(client):
@@ -161,9 +225,193 @@ def test_record_payment_marks_item_paid(client):
     login(client, 'payuser', 'pw')
     rv = client.post(f'/api/items/{item_id}/payments', json={'amount': 5})
     assert rv.status_code == 201
+    assert rv.get_json()['paid_total'] == 5
+    assert rv.get_json()['paid_at']
 
     with flask_app.app_context():
         item = BillItem.query.get(item_id)
         assert item.paid_at is not None
         payment = Payment.query.filter_by(bill_item_id=item_id).first()
         assert payment.amount == 5
+
+
+def _bill_with_member(username='bulkuser'):
+    manager = User.query.filter_by(username='manager').first()
+    family = Family.query.first()
+    member = User(username=username, password_hash=generate_password_hash('pw'), family_id=family.id)
+    db.session.add(member)
+    db.session.flush()
+    bill = Bill(family_id=family.id, created_by=manager.id, total_amount=0)
+    db.session.add(bill)
+    db.session.commit()
+    return bill.id, member.id
+
+
+def test_bulk_items_ndjson(client):
+    with flask_app.app_context():
+        bill_id, member_id = _bill_with_member()
+
+    body = '\n'.join([
+        json.dumps({'description': 'line', 'amount': 20, 'user_id': member_id}),
+        json.dumps({'description': 'device', 'amount': '5.50', 'user_id': member_id, 'is_recurring': True}),
+        '{not json',
+        json.dumps({'description': 'stranger', 'amount': 1, 'user_id': 9999}),
+        json.dumps({'amount': 1}),
+        '',
+    ])
+    login(client)
+    rv = client.post(
+        f'/api/bills/{bill_id}/items/bulk', data=body, content_type='application/x-ndjson'
+    )
+    assert rv.status_code == 201
+    report = rv.get_json()
+    assert report['inserted'] == 2
+    assert report['rejected'] == 3
+    assert [e['line'] for e in report['errors']] == [3, 4, 5]
+
+    with flask_app.app_context():
+        items = BillItem.query.filter_by(bill_id=bill_id).order_by(BillItem.id).all()
+        assert [float(i.amount) for i in items] == [20, 5.5]
+        assert items[1].is_recurring
+        balance = db.session.get(MemberBalance, (bill_id, member_id))
+        assert float(balance.amount_owed) == 25.5
+
+
+def test_bulk_items_csv_in_chunks(client, monkeypatch):
+    monkeypatch.setattr('ingest.CHUNK_SIZE', 7)
+    with flask_app.app_context():
+        bill_id, member_id = _bill_with_member()
+
+    lines = ['description,amount,user_id'] + [f'item {i},1.25,{member_id}' for i in range(50)]
+    lines.append('bad,abc,')
+    login(client)
+    rv = client.post(
+        f'/api/bills/{bill_id}/items/bulk', data='\n'.join(lines), content_type='text/csv'
+    )
+    assert rv.status_code == 201
+    report = rv.get_json()
+    assert report['inserted'] == 50
+    assert report['errors'] == [{'line': 52, 'error': 'amount must be a number'}]
+    with flask_app.app_context():
+        assert BillItem.query.filter_by(bill_id=bill_id).count() == 50
+
+
+def test_bulk_items_rejects_unknown_content_type(client):
+    with flask_app.app_context():
+        bill_id, _ = _bill_with_member()
+    login(client)
+    rv = client.post(f'/api/bills/{bill_id}/items/bulk', data='x', content_type='text/plain')
+    assert rv.status_code == 415
+
+
+def test_bill_info_conditional_get(client):
+    with flask_app.app_context():
+        bill_id, member_id = _bill_with_member()
+        db.session.add(BillItem(bill_id=bill_id, user_id=member_id, description='line', amount=10))
+        db.session.commit()
+
+    login(client)
+    rv = client.get(f'/api/bills/{bill_id}')
+    etag = rv.headers['ETag']
+    assert rv.headers['Last-Modified']
+    assert rv.status_code == 200
+
+    rv = client.get(f'/api/bills/{bill_id}', headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.data == b''
+
+    rv = client.post(f'/api/bills/{bill_id}/items', json={'description': 'fee', 'amount': 2})
+    assert rv.status_code == 201
+    rv = client.get(f'/api/bills/{bill_id}', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert len(rv.get_json()['items']) == 2
+    etag = rv.headers['ETag']
+
+    with flask_app.app_context():
+        item_id = BillItem.query.filter_by(bill_id=bill_id).order_by(BillItem.id).first().id
+    client.post(f'/api/items/{item_id}/payments', json={'amount': 1})
+    rv = client.get(f'/api/bills/{bill_id}', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+
+    # every page of the items is a representation of its own
+    etag = rv.headers['ETag']
+    rv = client.get(f'/api/bills/{bill_id}?after={item_id}', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert len(rv.get_json()['items']) == 1
+    tail = rv.headers['ETag']
+    assert client.get(f'/api/bills/{bill_id}?after={item_id}', headers={'If-None-Match': tail}).status_code == 304
+    assert client.get(f'/api/bills/{bill_id}?after={item_id}&limit=1', headers={'If-None-Match': tail}).status_code == 200
+
+
+def test_bill_info_if_modified_since_within_one_second(client):
+    edited = datetime(2025, 3, 1, 12, 0, 0, 200000)
+    bill = Bill.__table__
+    with flask_app.app_context():
+        bill_id, _ = _bill_with_member()
+        db.session.execute(bill.update().where(bill.c.id == bill_id).values(updated_at=edited))
+        db.session.commit()
+
+    login(client)
+    last_modified = client.get(f'/api/bills/{bill_id}').headers['Last-Modified']
+    assert last_modified == 'Sat, 01 Mar 2025 12:00:00 GMT'
+    with flask_app.app_context():
+        # edited again later in the same second
+        db.session.execute(
+            bill.update().where(bill.c.id == bill_id)
+            .values(updated_at=edited.replace(microsecond=700000), version=bill.c.version + 1)
+        )
+        db.session.commit()
+    rv = client.get(f'/api/bills/{bill_id}', headers={'If-Modified-Since': last_modified})
+    assert rv.status_code == 200
+    rv = client.get(f'/api/bills/{bill_id}', headers={'If-Modified-Since': 'Sat, 01 Mar 2025 12:00:01 GMT'})
+    assert rv.status_code == 304
+
+
+def test_bill_info_keyset_pagination(client):
+    with flask_app.app_context():
+        bill_id, member_id = _bill_with_member()
+        db.session.add_all([
+            BillItem(bill_id=bill_id, user_id=member_id, description=f'item {i}', amount=i)
+            for i in range(5)
+        ])
+        db.session.commit()
+
+    login(client)
+    seen, after = [], 0
+    while after is not None:
+        data = client.get(f'/api/bills/{bill_id}?limit=2&after={after}').get_json()
+        seen.extend(item['description'] for item in data['items'])
+        after = data['next_after']
+    assert seen == [f'item {i}' for i in range(5)]
+
+
+def test_family_ledger_export(client):
+    with flask_app.app_context():
+        bill_id, member_id = _bill_with_member()
+        item = BillItem(bill_id=bill_id, user_id=member_id, description='plan, "unlimited"', amount=30)
+        db.session.add(item)
+        db.session.flush()
+        db.session.add(Payment(bill_item_id=item.id, user_id=member_id, amount=10))
+        db.session.add(NotificationLog(user_id=member_id, bill_id=bill_id, message='New bill'))
+        db.session.commit()
+        family_id = Family.query.first().id
+
+    login(client)
+    rv = client.get(f'/api/families/{family_id}/ledger')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in rv.data.decode().splitlines()]
+    assert [r['type'] for r in rows] == ['bill', 'item', 'payment', 'notification']
+    assert rows[1]['amount'] == 30.0
+    assert rows[2]['bill_id'] == bill_id
+
+    rv = client.get(f'/api/families/{family_id}/ledger', headers={'Accept': 'text/csv'})
+    assert rv.mimetype == 'text/csv'
+    lines = rv.data.decode().splitlines()
+    assert lines[0].startswith('type,id,bill_id')
+    assert len(lines) == 5
+    assert '"plan, ""unlimited"""' in lines[2]
+
+    rv = client.get(f'/api/families/{family_id}/ledger?since=2999-01-01')
+    assert rv.data == b''
+    assert client.get(f'/api/families/{family_id}/ledger?since=soon').status_code == 400
@@ -8,6 +8,7 @@ os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
 import app
 from app import app as flask_app
 from models import db, User
+import passwords
 
 @pytest.fixture
 def client():
@@ -52,3 +53,39 @@ def test_signin_invalid_password(client):
     rv = client.post('/signin', data={'username': 'manager', 'password': 'wrong'}, follow_redirects=True)
     assert rv.status_code == 200
     assert b'Invalid username or password.' in rv.data
+
+
+def test_signin_upgrades_outdated_hash(client, monkeypatch):
+    monkeypatch.setattr(passwords, 'METHOD', 'pbkdf2:sha256:1000')
+    rv = client.post('/signin', data={'username': 'manager', 'password': 'pass'}, follow_redirects=True)
+    assert b'Welcome, manager!' in rv.data
+    with flask_app.app_context():
+        pwhash = User.query.filter_by(username='manager').one().password_hash
+    assert pwhash.startswith('pbkdf2:sha256:1000$')
+    assert not passwords.needs_rehash(pwhash)
+
+    # the upgraded hash still verifies, and is left alone from now on
+    client.get('/signout')
+    rv = client.post('/signin', data={'username': 'manager', 'password': 'pass'}, follow_redirects=True)
+    assert b'Welcome, manager!' in rv.data
+    with flask_app.app_context():
+        assert User.query.filter_by(username='manager').one().password_hash == pwhash
+
+
+def test_needs_rehash_compares_method_and_cost():
+    pwhash = passwords.hash_password('pw', 'pbkdf2:sha256:1000')
+    assert not passwords.needs_rehash(pwhash, 'pbkdf2:sha256:1000')
+    assert passwords.needs_rehash(pwhash, 'pbkdf2:sha256:2000')
+    assert passwords.needs_rehash(pwhash, 'scrypt')
+
+
+def test_hashing_in_process_pool(monkeypatch):
+    monkeypatch.setattr(passwords, 'WORKERS', 1)
+    monkeypatch.setattr(passwords, '_pool', None)
+    try:
+        pwhash = passwords.hash_password('pw', 'pbkdf2:sha256:1000')
+        assert passwords.verify_password(pwhash, 'pw')
+        assert not passwords.verify_password(pwhash, 'nope')
+        assert passwords._pool is not None
+    finally:
+        passwords._pool.shutdown()
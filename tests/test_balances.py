@@ -0,0 +1,173 @@
+import os
+import threading
+import pytest
+from datetime import datetime
+from sqlalchemy import create_engine
+from werkzeug.security import generate_password_hash
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+import app  # noqa: F401
+from app import app as flask_app
+from balances import rebuild, verify
+from models import db, User, Family, Bill, BillItem, MemberBalance, Payment
+
+
+@pytest.fixture
+def bill():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        family = Family(name='Smith')
+        alice = User(username='alice', password_hash=generate_password_hash('pw'), family=family)
+        db.session.add_all([family, alice])
+        db.session.flush()
+        bill = Bill(family_id=family.id, created_by=alice.id, published_at=datetime.utcnow())
+        db.session.add(bill)
+        db.session.commit()
+        yield bill
+        db.session.remove()
+        db.drop_all()
+
+
+def balance(bill):
+    row = db.session.get(MemberBalance, (bill.id, bill.created_by))
+    db.session.refresh(row)
+    return float(row.amount_owed), float(row.amount_paid), float(row.outstanding)
+
+
+def test_items_and_payments_update_balance(bill):
+    item = BillItem(bill_id=bill.id, user_id=bill.created_by, description='cell', amount=10)
+    db.session.add_all([
+        item,
+        BillItem(bill_id=bill.id, user_id=bill.created_by, description='addon', amount=5),
+        BillItem(bill_id=bill.id, description='shared fee', amount=3),
+    ])
+    db.session.commit()
+    assert balance(bill) == (15, 0, 15)
+
+    db.session.add(Payment(bill_item_id=item.id, user_id=bill.created_by, amount=4))
+    db.session.commit()
+    assert balance(bill) == (15, 4, 11)
+
+    item.amount = 12
+    db.session.commit()
+    assert balance(bill) == (17, 4, 13)
+    assert verify(db.session.connection()) == []
+
+
+def test_verify_reports_and_rebuild_fixes_drift(bill):
+    db.session.add(BillItem(bill_id=bill.id, user_id=bill.created_by, description='cell', amount=10))
+    db.session.commit()
+    db.session.execute(MemberBalance.__table__.update().values(amount_owed=99))
+    drift = verify(db.session.connection())
+    assert [(row[0], row[1]) for row in drift] == [(bill.id, bill.created_by)]
+
+    rebuild(db.session.connection())
+    db.session.commit()
+    assert balance(bill) == (10, 0, 10)
+    assert verify(db.session.connection()) == []
+
+
+def test_verify_reports_paid_total_drift(bill):
+    item = BillItem(bill_id=bill.id, user_id=bill.created_by, description='cell', amount=10)
+    db.session.add(item)
+    db.session.flush()
+    db.session.add(Payment(bill_item_id=item.id, user_id=bill.created_by, amount=4))
+    db.session.commit()
+    # a bulk path that inserted a payment without apply_payments
+    db.session.execute(BillItem.__table__.update().values(paid_total=1))
+    drift = verify(db.session.connection())
+    assert [(row.bill_id, row.item_id, row.stored, row.expected) for row in drift] == [(bill.id, item.id, 1, 4)]
+
+    result = flask_app.test_cli_runner().invoke(args=['balances', 'verify', '--fix'])
+    assert f'bill {bill.id} item {item.id}: stored paid_total' in result.output
+    assert verify(db.session.connection()) == []
+
+
+def test_verify_command(bill):
+    db.session.add(BillItem(bill_id=bill.id, user_id=bill.created_by, description='cell', amount=10))
+    db.session.commit()
+    runner = flask_app.test_cli_runner()
+    result = runner.invoke(args=['balances', 'verify'])
+    assert result.exit_code == 0
+    assert 'consistent' in result.output
+
+
+def test_payments_maintain_paid_total_and_paid_at(bill):
+    item = BillItem(bill_id=bill.id, user_id=bill.created_by, description='cell', amount=10)
+    db.session.add(item)
+    db.session.commit()
+
+    first = Payment(bill_item_id=item.id, user_id=bill.created_by, amount=6)
+    db.session.add(first)
+    db.session.flush()
+    # the loaded item is kept in step without another query
+    assert (float(item.paid_total), item.paid_at) == (6, None)
+    db.session.add(Payment(bill_item_id=item.id, user_id=bill.created_by, amount=4))
+    db.session.commit()
+    assert float(item.paid_total) == 10
+    assert item.paid_at is not None
+
+    db.session.delete(first)
+    db.session.commit()
+    assert (float(item.paid_total), item.paid_at) == (4, None)
+
+    db.session.execute(BillItem.__table__.update().values(paid_total=0))
+    rebuild(db.session.connection(), [bill.id])
+    db.session.commit()
+    db.session.refresh(item)
+    assert float(item.paid_total) == 4
+
+
+@pytest.fixture
+def file_db(tmp_path):
+    # a file database, so every thread has its own connection and transaction
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        engines = db.engines
+        saved = engines[None]
+        engines[None] = create_engine(f"sqlite:///{tmp_path / 'app.db'}", connect_args={'timeout': 30})
+        try:
+            db.create_all()
+            yield
+        finally:
+            db.session.remove()
+            engines[None].dispose()
+            engines[None] = saved
+
+
+def test_concurrent_payments_on_one_item(file_db):
+    family = Family(name='Jones')
+    payer = User(username='payer', password_hash=generate_password_hash('pw'), family=family)
+    db.session.add_all([family, payer])
+    db.session.flush()
+    item = BillItem(
+        bill=Bill(family_id=family.id, created_by=payer.id), user_id=payer.id, description='plan', amount=40,
+    )
+    db.session.add(item)
+    db.session.commit()
+    path = f'/api/items/{item.id}/payments'
+    client = flask_app.test_client()
+    client.post('/signin', data={'username': 'payer', 'password': 'pw'})
+    cookie = client.get_cookie('session').value
+    statuses = []
+
+    def pay():
+        other = flask_app.test_client()
+        other.set_cookie('session', cookie)
+        for _ in range(5):
+            statuses.append(other.post(path, json={'amount': 1}).status_code)
+
+    threads = [threading.Thread(target=pay) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert statuses == [201] * 40
+    db.session.refresh(item)
+    assert float(item.paid_total) == 40
+    assert item.paid_at is not None
+    assert db.session.query(Payment).filter_by(bill_item_id=item.id).count() == 40
+    assert verify(db.session.connection()) == []
@@ -0,0 +1,136 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import events
+from brokers import InProcessBroker, PostgresBroker, UnixSocketBroker, create_broker
+
+
+class Collector:
+    def __init__(self, expected=1):
+        self.messages = []
+        self.expected = expected
+        self.done = threading.Event()
+
+    def __call__(self, message):
+        self.messages.append(message)
+        if len(self.messages) >= self.expected:
+            self.done.set()
+
+
+def test_create_broker_defaults_to_memory_for_sqlite():
+    assert isinstance(create_broker('auto', 'sqlite:///app.db'), InProcessBroker)
+    with pytest.raises(ValueError):
+        create_broker('carrier-pigeon')
+
+
+def test_unix_broker_delivers_to_every_socket(tmp_path):
+    a, b = UnixSocketBroker(str(tmp_path)), UnixSocketBroker(str(tmp_path))
+    got_a, got_b = Collector(), Collector()
+    a.start(got_a)
+    b.start(got_b)
+    try:
+        assert a.publish({'family_id': 1, 'user_id': None, 'data': 'hi'}) == 1
+        assert got_a.done.wait(2) and got_b.done.wait(2)
+        assert got_b.messages == [{'id': 1, 'family_id': 1, 'user_id': None, 'data': 'hi'}]
+    finally:
+        a.close()
+        b.close()
+    assert [p.name for p in tmp_path.iterdir()] == ['last-event-id']
+
+
+def test_unix_broker_ids_are_shared_and_ordered(tmp_path):
+    got = Collector(expected=100)
+    subscriber = UnixSocketBroker(str(tmp_path))
+    subscriber.start(got)
+    publishers = [UnixSocketBroker(str(tmp_path)) for _ in range(2)]
+
+    def publish(broker):
+        for i in range(50):
+            broker.publish({'family_id': 1, 'user_id': None, 'data': str(i)})
+
+    threads = [threading.Thread(target=publish, args=(b,)) for b in publishers]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert got.done.wait(5)
+        assert [m['id'] for m in got.messages] == list(range(1, 101))
+        assert subscriber.last_id() == 100
+    finally:
+        for broker in [subscriber, *publishers]:
+            broker.close()
+
+
+def test_unix_broker_removes_stale_sockets(tmp_path):
+    # a worker that died without cleaning up leaves its socket file behind
+    dead_path = str(tmp_path / '999999-dead.sock')
+    dead = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    dead.bind(dead_path)
+    dead.close()
+    live = UnixSocketBroker(str(tmp_path))
+    live.start(Collector())
+    try:
+        live.publish({'family_id': 1, 'user_id': None, 'data': 'x'})
+        assert not os.path.exists(dead_path)
+    finally:
+        live.close()
+
+
+def test_event_from_another_process_reaches_listener(tmp_path):
+    events.set_broker(UnixSocketBroker(str(tmp_path)))
+    q = events.add_listener(family_id=7)
+    try:
+        code = (
+            'from brokers import UnixSocketBroker;'
+            f'b = UnixSocketBroker({str(tmp_path)!r});'
+            "b.publish({'family_id': 7, 'user_id': None, 'data': 'from-worker-b'})"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        subprocess.run([sys.executable, '-c', code], cwd=root, check=True)
+        assert q.get(timeout=2).data == 'from-worker-b'
+    finally:
+        events.remove_listener(q)
+        events.set_broker(InProcessBroker())
+
+
+def test_listen_only_process_starts_its_broker(tmp_path):
+    # the subscriber never publishes and never calls set_broker
+    code = (
+        'import events;'
+        'q = events.add_listener(family_id=7);'
+        "print('ready', flush=True);"
+        'print(q.get(timeout=5).data, flush=True)'
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, EVENT_BROKER='unix', EVENT_SOCKET_DIR=str(tmp_path))
+    worker = subprocess.Popen([sys.executable, '-c', code], cwd=root, env=env,
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        assert worker.stdout.readline().strip() == 'ready'
+        publisher = UnixSocketBroker(str(tmp_path))
+        publisher.publish({'family_id': 7, 'user_id': None, 'data': 'from-worker-a'})
+        publisher.close()
+        assert worker.stdout.readline().strip() == 'from-worker-a'
+    finally:
+        worker.kill()
+        worker.wait()
+
+
+@pytest.mark.skipif(not os.getenv('TEST_POSTGRES_URL'), reason='TEST_POSTGRES_URL not set')
+def test_postgres_broker_round_trip():
+    got = Collector()
+    broker = PostgresBroker(os.environ['TEST_POSTGRES_URL'], channel='familyphonepay_test')
+    broker.start(got)
+    try:
+        event_id = broker.publish({'family_id': 1, 'user_id': None, 'data': 'pg'})
+        assert got.done.wait(5)
+        assert got.messages[0]['data'] == 'pg'
+        assert got.messages[0]['id'] == event_id == broker.last_id()
+    finally:
+        broker.close()
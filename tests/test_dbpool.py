@@ -0,0 +1,93 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine, exc, text
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+from app import app as flask_app
+from dbpool import InstrumentedQueuePool, engine_options
+
+
+def test_sqlite_keeps_defaults():
+    assert engine_options('sqlite:///app.db', {}) == {}
+
+
+def test_pool_sized_from_workers_and_threads():
+    url = 'postgresql://u:p@db/app'
+    options = engine_options(url, {'WEB_CONCURRENCY': '4', 'DB_MAX_CONNECTIONS': '40'})
+    assert options['poolclass'] is InstrumentedQueuePool
+    assert (options['pool_size'], options['max_overflow']) == (10, 0)
+
+    options = engine_options(url, {
+        'WEB_CONCURRENCY': '4', 'DB_MAX_CONNECTIONS': '40',
+        'GUNICORN_WORKER_CLASS': 'gthread', 'GUNICORN_THREADS': '3',
+        'DB_STATEMENT_TIMEOUT_MS': '5000',
+    })
+    assert (options['pool_size'], options['max_overflow']) == (3, 0)
+    assert options['connect_args'] == {'options': '-c statement_timeout=5000'}
+
+    options = engine_options(url, {'WEB_CONCURRENCY': '2', 'DB_POOL_SIZE': '2', 'DB_MAX_CONNECTIONS': '10'})
+    assert (options['pool_size'], options['max_overflow']) == (2, 3)
+
+
+def test_broker_connections_come_out_of_the_share():
+    url = 'postgresql://u:p@db/app'
+    env = {'WEB_CONCURRENCY': '4', 'DB_MAX_CONNECTIONS': '40', 'DATABASE_URL': url}
+    assert engine_options(url, env)['pool_size'] == 8
+    assert engine_options(url, dict(env, EVENT_BROKER='unix'))['pool_size'] == 10
+    # the replica serves no LISTEN connections
+    assert engine_options('postgresql://u:p@replica/app', env)['pool_size'] == 10
+
+
+def test_statement_rendering_gets_its_own_connections():
+    url = 'postgresql://u:p@db/app'
+    env = {
+        'WEB_CONCURRENCY': '4', 'DB_MAX_CONNECTIONS': '40', 'DATABASE_URL': url, 'EVENT_BROKER': 'unix',
+        'GUNICORN_WORKER_CLASS': 'sync',
+    }
+    assert engine_options(url, env)['pool_size'] == 3
+    assert engine_options(url, dict(env, STATEMENT_WORKERS='4'))['pool_size'] == 5
+    assert engine_options(url, dict(env, STATEMENT_RENDERING='inline', GUNICORN_THREADS='2'))['pool_size'] == 4
+    assert engine_options(url, dict(env, STATEMENT_RENDERING='off'))['pool_size'] == 1
+    # capped by the worker's share, and statements never render on the replica
+    assert engine_options(url, dict(env, STATEMENT_WORKERS='20'))['pool_size'] == 10
+    assert engine_options('postgresql://u:p@replica/app', env)['pool_size'] == 1
+
+
+def test_instrumented_pool_records_waits_and_timeouts(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        poolclass=InstrumentedQueuePool, pool_size=1, max_overflow=1, pool_timeout=0.05,
+    )
+    first = engine.connect()
+    second = engine.connect()
+    with pytest.raises(exc.TimeoutError):
+        engine.connect()
+    stats = engine.pool.stats()
+    assert stats['checked_out'] == 2
+    assert stats['overflow_events'] == 1
+    assert stats['timeouts'] == 1
+    assert stats['wait_seconds_max'] >= 0.05
+
+    second.invalidate()
+    first.close()
+    second.close()
+    assert engine.pool.stats()['invalidations'] == 1
+    with engine.connect() as conn:
+        conn.execute(text('select 1'))
+    engine.dispose()
+
+
+def test_pool_endpoint_requires_token():
+    client = flask_app.test_client()
+    flask_app.config['INTERNAL_API_TOKEN'] = None
+    assert client.get('/internal/pool', headers={'X-Internal-Token': ''}).status_code == 404
+    flask_app.config['INTERNAL_API_TOKEN'] = 'secret'
+    try:
+        assert client.get('/internal/pool', headers={'X-Internal-Token': 'wrong'}).status_code == 404
+        rv = client.get('/internal/pool', headers={'X-Internal-Token': 'secret'})
+        assert rv.status_code == 200
+        assert rv.get_json()['pool_class']
+    finally:
+        flask_app.config['INTERNAL_API_TOKEN'] = None
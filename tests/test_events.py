@@ -0,0 +1,117 @@
+import queue
+
+import pytest
+
+import events
+from events import add_listener, remove_listener, send_event
+
+
+@pytest.fixture(autouse=True)
+def clean_topics():
+    yield
+    events._topics.clear()
+    events._history.clear()
+    events._evicted.clear()
+
+
+def data(q):
+    return q.get_nowait().data
+
+
+def test_events_are_routed_by_family_and_user():
+    smith = add_listener(family_id=1, user_id=10)
+    jones = add_listener(family_id=2, user_id=20)
+
+    send_event('family-1', family_id=1)
+    send_event('user-20', user_id=20)
+
+    assert data(smith) == 'family-1'
+    assert data(jones) == 'user-20'
+    with pytest.raises(queue.Empty):
+        smith.get_nowait()
+    with pytest.raises(queue.Empty):
+        jones.get_nowait()
+
+
+def test_listener_on_both_topics_receives_event_once():
+    q = add_listener(family_id=1, user_id=10)
+    send_event('hello', family_id=1, user_id=10)
+    assert q.qsize() == 1
+
+
+def test_remove_listener_unsubscribes():
+    q = add_listener(family_id=1)
+    remove_listener(q)
+    send_event('gone', family_id=1)
+    assert q.empty()
+    assert events.stats()['listeners'] == 0
+
+
+def test_drop_oldest_policy_counts_dropped():
+    q = add_listener(family_id=1, maxsize=2, policy='drop-oldest')
+    before = events.counters['dropped']
+    for i in range(5):
+        send_event(str(i), family_id=1)
+    assert [data(q), data(q)] == ['3', '4']
+    assert q.dropped == 3
+    assert events.counters['dropped'] - before == 3
+
+
+def test_coalesce_latest_policy_keeps_newest():
+    q = add_listener(family_id=1, maxsize=2, policy='coalesce-latest')
+    for i in range(3):
+        send_event(str(i), family_id=1)
+    assert data(q) == '2'
+    assert q.empty()
+    assert q.dropped == 2
+
+
+def test_send_event_requires_topic():
+    with pytest.raises(ValueError):
+        send_event('nowhere')
+
+
+def test_event_ids_increase():
+    q = add_listener(family_id=1)
+    for i in range(3):
+        send_event(str(i), family_id=1)
+    ids = [q.get_nowait().id for _ in range(3)]
+    assert ids == sorted(ids) and len(set(ids)) == 3
+
+
+def test_replay_returns_only_missed_events():
+    for i in range(4):
+        send_event(str(i), family_id=1)
+    send_event('other', family_id=2)
+    history = list(events._history['family:1'])
+    missed = events.replay(['family:1', 'user:10'], history[1].id)
+    assert [e.data for e in missed] == ['2', '3']
+
+
+def test_replay_signals_gap_beyond_buffer(monkeypatch):
+    monkeypatch.setattr(events, 'HISTORY_SIZE', 3)
+    for i in range(3):
+        send_event(str(i), family_id=1)
+    first = events._history['family:1'][0].id
+    assert [e.data for e in events.replay(['family:1'], first)] == ['1', '2']
+    send_event('3', family_id=1)
+    send_event('4', family_id=1)
+    assert events.replay(['family:1'], first) is None
+
+
+def test_stream_replays_then_resyncs():
+    for i in range(3):
+        send_event(str(i), family_id=1)
+    first = events._history['family:1'][0].id
+
+    frames = events.stream(add_listener(family_id=1), last_event_id=first)
+    next(frames)
+    assert next(frames).endswith('data: 1\n\n')
+    assert next(frames).endswith('data: 2\n\n')
+    frames.close()
+
+    frames = events.stream(add_listener(family_id=1), last_event_id=events._started_id - 1)
+    next(frames)
+    assert 'event: resync' in next(frames)
+    frames.close()
+    assert events.stats()['listeners'] == 0
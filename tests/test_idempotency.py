@@ -0,0 +1,208 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Request, g
+from sqlalchemy import create_engine
+from werkzeug.security import generate_password_hash
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+from app import app as flask_app
+from models import db, User, Family, Bill, BillItem, IdempotencyKey, Payment
+import idempotency
+import publishing
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # a file database, so concurrent requests get their own connections
+    sent = []
+    monkeypatch.setattr('publishing.send_bulk', lambda emails, subject, body: sent.append(emails) or {})
+    monkeypatch.setitem(flask_app.config, 'STATEMENT_RENDERING', 'off')
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        engines = db.engines
+        saved = engines[None]
+        engines[None] = create_engine(f"sqlite:///{tmp_path / 'app.db'}", connect_args={'timeout': 30})
+        try:
+            db.create_all()
+            family = Family(name='Smith')
+            db.session.add_all([
+                family,
+                User(username='manager', password_hash=generate_password_hash('pass'), role='manager', family=family),
+                User(username='alice', email='alice@example.com', role='user', family=family),
+            ])
+            db.session.commit()
+            client = flask_app.test_client()
+            client.family_id = family.id
+            client.sent = sent
+            client.post('/signin', data={'username': 'manager', 'password': 'pass'})
+            yield client
+        finally:
+            db.session.remove()
+            engines[None].dispose()
+            engines[None] = saved
+
+
+def post(client, path, key, **kwargs):
+    # a retry arrives as a fresh request, not in the session of the first one
+    db.session.remove()
+    g.pop('_login_user', None)
+    return client.post(path, headers={'Idempotency-Key': key}, **kwargs)
+
+
+def test_retried_bill_is_published_once(client):
+    body = {'family_id': client.family_id, 'total_amount': 40}
+    first = post(client, '/api/bills', 'bill-1', json=body)
+    retry = post(client, '/api/bills', 'bill-1', json=body)
+    assert first.status_code == retry.status_code == 201
+    assert retry.get_json() == first.get_json()
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert 'Idempotent-Replayed' not in first.headers
+    assert Bill.query.count() == 1
+    assert len(client.sent) == 1
+
+    # a new key is a new request
+    assert post(client, '/api/bills', 'bill-2', json=body).get_json() != first.get_json()
+    assert Bill.query.count() == 2
+
+
+def test_retried_payment_is_recorded_once(client):
+    bill_id = post(client, '/api/bills', 'bill', json={'family_id': client.family_id}).get_json()['id']
+    item = BillItem(bill_id=bill_id, description='Plan', amount=30)
+    db.session.add(item)
+    db.session.commit()
+    for _ in range(3):
+        rv = post(client, f'/api/items/{item.id}/payments', 'pay-1', json={'amount': 10})
+        assert rv.status_code == 201
+    assert Payment.query.count() == 1
+
+
+def test_key_reused_for_another_request(client):
+    assert post(client, '/api/bills', 'key', json={'family_id': client.family_id}).status_code == 201
+    rv = post(client, '/api/bills', 'key', json={'family_id': client.family_id, 'total_amount': 1})
+    assert rv.status_code == 422
+    assert post(client, '/api/bills', 'x' * 256, json={}).status_code == 400
+
+
+def test_large_uploads_are_streamed_to_the_view(client, monkeypatch):
+    bill_id = post(client, '/api/bills', 'bill', json={'family_id': client.family_id}).get_json()['id']
+    body = '\n'.join(json.dumps({'description': f'line {i}', 'amount': 1}) for i in range(50))
+    monkeypatch.setattr(idempotency, 'MAX_HASHED_BODY', len(body) - 1)
+
+    def buffered(*args, **kwargs):
+        raise AssertionError('the upload was read into memory')
+
+    monkeypatch.setattr(Request, 'get_data', buffered)
+    path = f'/api/bills/{bill_id}/items/bulk'
+    first = post(client, path, 'bulk', data=body, content_type='application/x-ndjson')
+    assert first.status_code == 201
+    assert first.get_json()['inserted'] == 50
+    retry = post(client, path, 'bulk', data=body, content_type='application/x-ndjson')
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert BillItem.query.filter_by(bill_id=bill_id).count() == 50
+    # without the body, only a different length or type tells requests apart
+    assert post(client, path, 'bulk', data=body + ' ', content_type='application/x-ndjson').status_code == 422
+
+
+def test_client_errors_are_replayed_and_server_errors_are_not(client, monkeypatch):
+    rv = post(client, '/api/bills', 'bad', json={})
+    assert rv.status_code == 400
+    assert post(client, '/api/bills', 'bad', json={}).headers['Idempotent-Replayed'] == 'true'
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('mail is down')
+
+    publish_bill = publishing.publish_bill
+    monkeypatch.setattr(publishing, 'publish_bill', fail)
+    monkeypatch.setitem(flask_app.config, 'PROPAGATE_EXCEPTIONS', False)
+    body = {'family_id': client.family_id}
+    assert post(client, '/api/bills', 'boom', json=body).status_code == 500
+    assert IdempotencyKey.query.filter_by(key='boom').count() == 0
+    monkeypatch.setattr(publishing, 'publish_bill', publish_bill)
+    assert post(client, '/api/bills', 'boom', json=body).status_code == 201
+
+
+def test_failure_after_commit_is_not_executed_again(client, monkeypatch):
+    publish_bill = publishing.publish_bill
+
+    def publish_then_fail(*args, **kwargs):
+        publish_bill(*args, **kwargs)
+        raise RuntimeError('broker is down')
+
+    monkeypatch.setattr(publishing, 'publish_bill', publish_then_fail)
+    monkeypatch.setitem(flask_app.config, 'PROPAGATE_EXCEPTIONS', False)
+    body = {'family_id': client.family_id}
+    assert post(client, '/api/bills', 'boom', json=body).status_code == 500
+    retry = post(client, '/api/bills', 'boom', json=body)
+    assert retry.status_code == 500
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert Bill.query.count() == 1
+
+    # a raised exception that skips after_request keeps the claim instead
+    monkeypatch.setitem(flask_app.config, 'PROPAGATE_EXCEPTIONS', True)
+    monkeypatch.setitem(flask_app.config, 'IDEMPOTENCY_WAIT', 0)
+    with pytest.raises(RuntimeError):
+        post(client, '/api/bills', 'raised', json=body)
+    assert post(client, '/api/bills', 'raised', json=body).status_code == 409
+    assert Bill.query.count() == 2
+
+
+def test_in_flight_duplicate_gets_conflict(client, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'IDEMPOTENCY_WAIT', 0.1)
+    manager = User.query.filter_by(username='manager').one()
+    now = datetime.utcnow()
+    db.session.add(IdempotencyKey(
+        user_id=manager.id, key='busy', request_hash='0' * 64, created_at=now, expires_at=now + timedelta(hours=1),
+    ))
+    db.session.commit()
+    body = {'family_id': client.family_id}
+    # the claim was made for another body
+    assert post(client, '/api/bills', 'busy', json=body).status_code == 422
+
+    IdempotencyKey.query.filter_by(key='busy').update({'request_hash': idempotency_hash(body)})
+    db.session.commit()
+    rv = post(client, '/api/bills', 'busy', json=body)
+    assert rv.status_code == 409
+    assert rv.headers['Retry-After']
+
+    # an abandoned claim is taken over once the lock times out
+    monkeypatch.setitem(flask_app.config, 'IDEMPOTENCY_LOCK_TIMEOUT', 0)
+    assert post(client, '/api/bills', 'busy', json=body).status_code == 201
+
+
+def idempotency_hash(body):
+    with flask_app.test_request_context('/api/bills', method='POST', json=body):
+        return idempotency._fingerprint()
+
+
+def test_concurrent_duplicates_execute_once(client):
+    body = {'family_id': client.family_id, 'total_amount': 25}
+    cookie = client.get_cookie('session').value
+    results = []
+
+    def send():
+        other = flask_app.test_client()
+        other.set_cookie('session', cookie)
+        rv = other.post('/api/bills', json=body, headers={'Idempotency-Key': 'race'})
+        results.append((rv.status_code, rv.get_json()))
+
+    threads = [threading.Thread(target=send) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [status for status, _ in results] == [201] * 4
+    assert len({data['id'] for _, data in results}) == 1
+    assert Bill.query.count() == 1
+    assert len(client.sent) == 1
+
+
+def test_purge_removes_expired_keys(client):
+    post(client, '/api/bills', 'old', json={'family_id': client.family_id})
+    assert idempotency.purge(db.session.connection()) == 0
+    later = datetime.utcnow() + timedelta(seconds=flask_app.config['IDEMPOTENCY_TTL'] + 1)
+    assert idempotency.purge(db.session.connection(), later) == 1
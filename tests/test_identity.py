@@ -0,0 +1,126 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+from flask import g
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+from app import app as flask_app
+from brokers import InProcessBroker, UnixSocketBroker
+from models import db, User, Family
+import events
+import identity
+
+
+@pytest.fixture
+def client():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        db.session.add(User(
+            username='manager', email='m@example.com',
+            password_hash=generate_password_hash('pass'), role='manager',
+        ))
+        db.session.commit()
+        client = flask_app.test_client()
+        client.post('/signin', data={'username': 'manager', 'password': 'pass'})
+        yield client
+        identity.cache.clear()
+        db.session.remove()
+        db.drop_all()
+
+
+def user_selects(client, path):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM user' in statement:
+            statements.append(statement)
+
+    # requests share the fixture's app context, where Flask-Login keeps the
+    # user it loaded; drop it so the user_loader runs as in production
+    g.pop('_login_user', None)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        assert client.get(path).status_code == 200
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    return len(statements)
+
+
+def test_identity_is_cached_between_requests(client):
+    identity.cache.clear()
+    assert user_selects(client, '/dashboard') == 1
+    assert user_selects(client, '/dashboard') == 0
+    assert user_selects(client, '/profile') == 0
+
+
+def test_role_and_family_changes_invalidate(client):
+    user_selects(client, '/dashboard')
+    manager = User.query.filter_by(username='manager').one()
+    manager.role = 'user'
+    db.session.commit()
+    g.pop('_login_user', None)
+    assert client.get('/manage').status_code == 403
+
+    family = Family(name='Smith')
+    manager.family = family
+    db.session.commit()
+    assert identity.load_identity(manager.id).family_id == family.id
+
+
+def test_committed_changes_reach_other_workers(client, tmp_path):
+    manager = User.query.filter_by(username='manager').one()
+    identity.load_identity(manager.id)
+    assert identity.cache.get(manager.id) is not None
+
+    events.set_broker(UnixSocketBroker(str(tmp_path)))
+    try:
+        # another worker changes the member's role
+        code = f"import events; events.broadcast('identity', [{manager.id}])"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, EVENT_BROKER='unix', EVENT_SOCKET_DIR=str(tmp_path))
+        subprocess.run([sys.executable, '-c', code], cwd=root, env=env, check=True)
+        deadline = time.monotonic() + 2
+        while identity.cache.get(manager.id) is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert identity.cache.get(manager.id) is None
+    finally:
+        events.set_broker(InProcessBroker())
+
+
+def test_commit_broadcasts_changed_users(client, monkeypatch):
+    sent = []
+    monkeypatch.setattr(events, 'broadcast', lambda kind, payload: sent.append((kind, payload)))
+    manager = User.query.filter_by(username='manager').one()
+    manager.role = 'user'
+    db.session.commit()
+    assert sent == [('identity', [manager.id])]
+
+
+def test_ttl_and_size_bound():
+    cache = identity.IdentityCache(maxsize=2, ttl=60)
+    for i in range(3):
+        cache.put(i, (i, 'user', None, f'u{i}'))
+    assert cache.get(0) is None
+    assert cache.get(2) == (2, 'user', None, 'u2')
+
+    expired = identity.IdentityCache(maxsize=2, ttl=-1)
+    expired.put(1, (1, 'user', None, 'u1'))
+    assert expired.get(1) is None
+
+
+def test_full_user_loaded_lazily(client):
+    manager = User.query.filter_by(username='manager').one()
+    db.session.expunge_all()
+    ident = identity.load_identity(manager.id)
+    assert ident._user is None
+    assert ident.username == 'manager'
+    assert ident._user is None
+    assert ident.email == 'm@example.com'
+    assert ident._user is not None
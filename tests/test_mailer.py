@@ -0,0 +1,103 @@
+import http.client
+import time
+
+import pytest
+
+from bench.sendgrid_stub import SendGridStub
+from mailer import Mailer, send_email
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    monkeypatch.setenv('SENDGRID_API_KEY', 'test-key')
+    monkeypatch.setenv('EMAIL_FROM', 'bills@example.com')
+    server = SendGridStub().start()
+    yield server
+    server.stop()
+
+
+def test_batches_recipients_into_personalizations(stub):
+    mailer = Mailer(stub.url, workers=2, batch_size=3)
+    emails = [f'user{i}@example.com' for i in range(7)]
+    try:
+        results = mailer.send(emails + [None, emails[0]], 'New bill', 'body')
+    finally:
+        mailer.close()
+    assert sorted(results) == sorted(emails)
+    assert all(r.ok and r.status == 202 for r in results.values())
+    assert stub.requests == 3
+    assert stub.recipients == 7
+
+
+def test_reuses_connection_between_sends(stub):
+    mailer = Mailer(stub.url, workers=1)
+    try:
+        for _ in range(3):
+            mailer.send(['a@example.com'], 'New bill', 'body')
+    finally:
+        mailer.close()
+    assert stub.requests == 3
+    assert len(stub.connections) == 1
+
+
+def test_reports_failures_per_recipient(stub):
+    stub.status = 400
+    mailer = Mailer(stub.url, workers=1)
+    try:
+        results = mailer.send(['a@example.com', 'b@example.com'], 'New bill', 'body')
+    finally:
+        mailer.close()
+    assert [r.ok for r in results.values()] == [False, False]
+    assert results['a@example.com'].status == 400
+
+
+def test_reconnects_when_the_server_closed_an_idle_connection(stub):
+    stub.disconnect = 'idle'
+    mailer = Mailer(stub.url, workers=1)
+    try:
+        for _ in range(3):
+            results = mailer.send(['a@example.com'], 'New bill', 'body')
+            assert results['a@example.com'].ok
+            time.sleep(0.05)
+    finally:
+        mailer.close()
+    assert stub.requests == 3
+    assert len(stub.connections) == 3
+
+
+def test_lost_response_is_not_sent_again(stub):
+    stub.disconnect = 'request'
+    mailer = Mailer(stub.url, workers=1)
+    try:
+        results = mailer.send(['a@example.com', 'b@example.com'], 'New bill', 'body')
+    finally:
+        mailer.close()
+    assert [r.ok for r in results.values()] == [False, False]
+    assert stub.requests == 1
+
+
+def test_retries_a_failed_connect(stub, monkeypatch):
+    mailer = Mailer(stub.url, workers=1)
+    connect = http.client.HTTPConnection.connect
+    calls = []
+
+    def flaky_connect(conn):
+        calls.append(conn)
+        if len(calls) == 1:
+            raise ConnectionRefusedError('refused')
+        connect(conn)
+
+    monkeypatch.setattr(http.client.HTTPConnection, 'connect', flaky_connect)
+    try:
+        results = mailer.send(['a@example.com'], 'New bill', 'body')
+    finally:
+        mailer.close()
+    assert results['a@example.com'].ok
+    assert len(calls) == 2
+    assert stub.requests == 1
+
+
+def test_send_email_requires_settings(monkeypatch):
+    monkeypatch.delenv('SENDGRID_API_KEY', raising=False)
+    with pytest.raises(RuntimeError):
+        send_email('a@example.com', 'subject', 'body')
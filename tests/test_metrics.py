@@ -0,0 +1,143 @@
+import json
+import os
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+from app import app as flask_app
+from bench.sendgrid_stub import SendGridStub
+from mailer import Mailer
+from models import db, User, Family
+import metrics
+
+TOKEN = {'Authorization': 'Bearer metrics-token'}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr('publishing.send_bulk', lambda emails, subject, body: {})
+    monkeypatch.setitem(flask_app.config, 'INTERNAL_API_TOKEN', 'metrics-token')
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        family = Family(name='Smith')
+        db.session.add_all([family, User(
+            username='manager', password_hash=generate_password_hash('pass'), role='manager', family=family,
+        )])
+        db.session.commit()
+        client = flask_app.test_client()
+        client.family_id = family.id
+        client.post('/signin', data={'username': 'manager', 'password': 'pass'})
+        yield client
+        db.session.remove()
+        db.drop_all()
+
+
+def sample(text, prefix):
+    for line in text.splitlines():
+        if line.startswith(prefix + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return 0
+
+
+def test_metrics_endpoint_reports_requests_and_subsystems(client):
+    before = client.get('/metrics', headers=TOKEN).data.decode()
+    client.get('/dashboard')
+    client.post('/api/bills', json={'family_id': client.family_id})
+    rv = client.get('/metrics', headers=TOKEN)
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/plain'
+    text = rv.data.decode()
+
+    key = 'http_requests_total{endpoint="/dashboard",method="GET",status="200"}'
+    assert sample(text, key) == sample(before, key) + 1
+    key = 'http_request_duration_seconds_bucket{endpoint="/dashboard",method="GET",le="+Inf"}'
+    assert sample(text, key) == sample(before, key) + 1
+    key = 'db_queries_per_request_sum{endpoint="/dashboard"}'
+    assert sample(text, key) > sample(before, key)
+    assert sample(text, 'bills_published_total') == sample(before, 'bills_published_total') + 1
+    assert '# TYPE sse_listeners gauge' in text
+    assert 'sse_queued_events ' in text
+
+
+def test_metrics_endpoint_requires_token(client):
+    assert client.get('/metrics').status_code == 404
+
+
+def test_mailer_latency_and_failures(monkeypatch):
+    monkeypatch.setenv('SENDGRID_API_KEY', 'key')
+    monkeypatch.setenv('EMAIL_FROM', 'bills@example.com')
+    before = metrics.registry.snapshot()
+    stub = SendGridStub().start()
+    mailer = Mailer(stub.url, workers=1)
+    try:
+        mailer.send(['a@example.com', 'b@example.com'], 'subject', 'body')
+    finally:
+        mailer.close()
+        stub.stop()
+    failing = Mailer('http://127.0.0.1:9/v3/mail/send', workers=1, timeout=1)
+    try:
+        failing.send(['c@example.com'], 'subject', 'body')
+    finally:
+        failing.close()
+    text = metrics.render(metrics.merge([(True, metrics.registry.snapshot())]))
+    old = metrics.render(metrics.merge([(True, before)]))
+    for key, delta in (
+        ('mail_recipients_total{result="ok"}', 2),
+        ('mail_recipients_total{result="failed"}', 1),
+        ('mail_send_duration_seconds_count', 2),
+    ):
+        assert sample(text, key) == sample(old, key) + delta
+
+
+def test_dead_worker_is_folded_and_its_gauges_dropped(tmp_path):
+    def worker(published, listeners):
+        return {
+            'bills_published_total': {
+                'type': 'counter', 'help': 'Bills published.', 'labels': [], 'buckets': [],
+                'samples': [[[], published]],
+            },
+            'sse_listeners': {
+                'type': 'gauge', 'help': 'Open SSE streams.', 'labels': [], 'buckets': [],
+                'samples': [[[], listeners]],
+            },
+        }
+
+    # pretend both exited workers had our pid, so they would count as alive
+    pid = os.getpid()
+    for published in (5, 7):
+        (tmp_path / f'metrics-{pid}.json').write_text(json.dumps(worker(published, 100)))
+        metrics.mark_process_dead(pid, str(tmp_path))
+        assert not (tmp_path / f'metrics-{pid}.json').exists()
+    metrics.mark_process_dead(12345, str(tmp_path))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['metrics-dead.json']
+
+    own = metrics.registry.snapshot()
+    text = metrics.exposition(str(tmp_path))
+    published = sum(v for _, v in own['bills_published_total']['samples'])
+    assert sample(text, 'bills_published_total') == published + 12
+    assert sample(text, 'sse_listeners') == own['sse_listeners']['samples'][0][1]
+
+
+def test_multiprocess_merge(tmp_path):
+    dead = {
+        'bills_published_total': {
+            'type': 'counter', 'help': 'Bills published.', 'labels': [], 'buckets': [],
+            'samples': [[[], 5]],
+        },
+        'sse_listeners': {
+            'type': 'gauge', 'help': 'Open SSE streams.', 'labels': [], 'buckets': [],
+            'samples': [[[], 100]],
+        },
+    }
+    # pids are at most 2**22 on Linux, so this one cannot be alive
+    (tmp_path / 'metrics-99999999.json').write_text(json.dumps(dead))
+    own = metrics.registry.snapshot()
+    text = metrics.exposition(str(tmp_path))
+    assert (tmp_path / f'metrics-{os.getpid()}.json').exists()
+
+    published = sum(v for _, v in own['bills_published_total']['samples'])
+    assert sample(text, 'bills_published_total') == published + 5
+    assert sample(text, 'sse_listeners') == own['sse_listeners']['samples'][0][1]
@@ -0,0 +1,97 @@
+import os
+import pytest
+from werkzeug.security import generate_password_hash
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+from app import app as flask_app
+from models import db, User, Family, BillItem, MemberBalance, NotificationLog
+import sqltrace
+
+
+@pytest.fixture
+def client(monkeypatch):
+    sent = []
+    monkeypatch.setattr('publishing.send_bulk', lambda emails, subject, body: sent.append(emails) or {})
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        db.session.add(User(
+            username='manager',
+            password_hash=generate_password_hash('pass'),
+            role='manager',
+        ))
+        db.session.commit()
+        client = flask_app.test_client()
+        client.sent = sent
+        client.post('/signin', data={'username': 'manager', 'password': 'pass'})
+        yield client
+        db.session.remove()
+        db.drop_all()
+
+
+def make_family(size):
+    family = Family(name=f'family of {size}')
+    db.session.add(family)
+    db.session.flush()
+    db.session.add_all([
+        User(username=f'f{family.id}m{i}', email=f'f{family.id}m{i}@example.com', family=family)
+        for i in range(size)
+    ])
+    db.session.commit()
+    return family.id
+
+
+def test_publish_bill_queries_constant_in_family_size(client):
+    counts = []
+    for size in (2, 12):
+        fam_id = make_family(size)
+        with sqltrace.trace() as log:
+            rv = client.post('/api/bills', json={'family_id': fam_id, 'total_amount': 50})
+        assert rv.status_code == 201
+        assert not log.repeated(), log.summary()
+        counts.append(len(log))
+        assert NotificationLog.query.filter_by(bill_id=rv.get_json()['id']).count() == size
+    assert counts[0] == counts[1]
+    assert [len(emails) for emails in client.sent] == [2, 12]
+
+
+def test_add_item_queries_constant_in_family_size(client):
+    counts = []
+    for size in (2, 12):
+        fam_id = make_family(size)
+        manager = User.query.filter_by(username='manager').first()
+        manager.family_id = fam_id
+        db.session.commit()
+        members = User.query.filter_by(family_id=fam_id).all()
+        form = {'description': 'line'}
+        form.update({f'amount_{m.id}': '10' for m in members if m.username != 'manager'})
+        with sqltrace.trace() as log:
+            rv = client.post('/add-item', data=form)
+        assert rv.status_code == 302
+        assert not log.repeated(), log.summary()
+        counts.append(len(log))
+        assert BillItem.query.join(User).filter(User.family_id == fam_id).count() == size
+        assert MemberBalance.query.filter_by(user_id=members[-1].id).one().amount_owed == 10
+    assert counts[0] == counts[1]
+
+
+def test_side_effects_after_commit_are_best_effort(client, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('broker is down')
+
+    monkeypatch.setattr('publishing.send_event', fail)
+    monkeypatch.setattr('publishing.schedule_statement', fail)
+    fam_id = make_family(2)
+    rv = client.post('/api/bills', json={'family_id': fam_id, 'total_amount': 50})
+    assert rv.status_code == 201
+    bill_id = rv.get_json()['id']
+    rv = client.post(f'/api/bills/{bill_id}/items', json={'description': 'Fee', 'amount': 5})
+    assert rv.status_code == 201
+    rv = client.post(
+        f'/api/bills/{bill_id}/items/bulk',
+        data='{"description": "Plan", "amount": 20}\n',
+        content_type='application/x-ndjson',
+    )
+    assert rv.status_code == 201
+    assert BillItem.query.filter_by(bill_id=bill_id).count() == 2
@@ -0,0 +1,153 @@
+"""EXPLAIN the hot queries and fail when one of them falls back to a full scan.
+
+The SQLite checks always run. Set ``TEST_POSTGRES_URL`` to also check the
+plans on Postgres; they are built in a throwaway schema with sequential
+scans disabled so the planner shows whether an index path exists at all.
+"""
+import json
+import os
+import re
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, event, select, text
+from werkzeug.security import generate_password_hash
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+import app  # noqa: F401
+from app import app as flask_app
+from models import db, User, Family, Bill, BillItem, MemberBalance, NotificationLog, Payment
+import reminders
+
+HOT_QUERIES = {
+    'dashboard': lambda: (
+        select(Bill.id, MemberBalance.amount_owed)
+        .outerjoin(
+            MemberBalance,
+            (MemberBalance.bill_id == Bill.id) & (MemberBalance.user_id == 1),
+        )
+        .where(Bill.family_id == 1, Bill.published_at.isnot(None))
+        .order_by(Bill.published_at.desc())
+        .limit(1)
+    ),
+    'bill_info_items': lambda: select(BillItem).where(BillItem.bill_id == 1),
+    'member_items': lambda: select(BillItem).where(BillItem.bill_id == 1, BillItem.user_id == 1),
+    'record_payment_total': lambda: select(Payment.amount).where(Payment.bill_item_id == 1),
+    'notification_history': lambda: (
+        select(NotificationLog)
+        .where(NotificationLog.user_id == 1)
+        .order_by(NotificationLog.sent_at.desc())
+        .limit(20)
+    ),
+    'bill_notifications': lambda: (
+        select(NotificationLog).where(NotificationLog.bill_id == 1, NotificationLog.user_id == 1)
+    ),
+    'reminder_due_bills': lambda: reminders.due_bills(
+        datetime(2025, 3, 1), datetime(2025, 3, 4), after=(datetime(2025, 3, 1), 1)
+    ),
+    'reminder_unpaid_items': lambda: reminders.unpaid_members([1, 2], datetime(2025, 3, 1)),
+}
+
+# "SCAN bill" walks the whole table and "SCAN bill USING INDEX ..." the whole
+# index; a hot query should only ever SEARCH
+FULL_SCAN = re.compile(r'^SCAN (?!CONSTANT ROW)')
+
+
+def sqlite_full_scans(conn, sql, params=()):
+    rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}', params).all()
+    return [row[-1] for row in rows if FULL_SCAN.match(row[-1])]
+
+
+@pytest.fixture
+def sqlite_db():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        yield db
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+def test_hot_query_uses_index_on_sqlite(sqlite_db, name):
+    conn = sqlite_db.session.connection()
+    compiled = HOT_QUERIES[name]().compile(conn, compile_kwargs={'literal_binds': True})
+    assert sqlite_full_scans(conn, str(compiled)) == []
+
+
+def test_endpoint_queries_use_indexes_on_sqlite(sqlite_db):
+    family = Family(name='Smith')
+    alice = User(username='alice', password_hash=generate_password_hash('pw'), family=family)
+    db.session.add_all([family, alice])
+    db.session.flush()
+    bill = Bill(family_id=family.id, created_by=alice.id, published_at=datetime.utcnow())
+    db.session.add(bill)
+    db.session.flush()
+    item = BillItem(bill_id=bill.id, user_id=alice.id, description='cell', amount=10)
+    db.session.add(item)
+    db.session.commit()
+    bill_id, item_id = bill.id, item.id
+
+    client = flask_app.test_client()
+    client.post('/signin', data={'username': 'alice', 'password': 'pw'})
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        client.get('/dashboard')
+        client.get(f'/api/bills/{bill_id}')
+        client.post(f'/api/items/{item_id}/payments', json={'amount': 1})
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+    assert statements
+    conn = db.session.connection()
+    for statement, parameters in statements:
+        assert sqlite_full_scans(conn, statement, parameters) == [], statement
+
+
+def _seq_scans(plan):
+    nodes = [plan]
+    found = []
+    while nodes:
+        node = nodes.pop()
+        if node.get('Node Type') == 'Seq Scan':
+            found.append(node.get('Relation Name'))
+        nodes.extend(node.get('Plans', []))
+    return found
+
+
+@pytest.fixture(scope='module')
+def postgres_conn():
+    url = os.getenv('TEST_POSTGRES_URL')
+    if not url:
+        pytest.skip('TEST_POSTGRES_URL not set')
+    engine = create_engine(url)
+    schema = f'plan_test_{uuid.uuid4().hex[:8]}'
+    with engine.connect() as conn:
+        conn.execute(text(f'CREATE SCHEMA {schema}'))
+        conn.execute(text(f'SET search_path TO {schema}'))
+        db.metadata.create_all(conn)
+        conn.execute(text('ANALYZE'))
+        conn.execute(text('SET enable_seqscan = off'))
+        yield conn
+        conn.rollback()
+    with engine.begin() as conn:
+        conn.execute(text(f'DROP SCHEMA {schema} CASCADE'))
+    engine.dispose()
+
+
+@pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+def test_hot_query_uses_index_on_postgres(postgres_conn, name):
+    compiled = HOT_QUERIES[name]().compile(postgres_conn, compile_kwargs={'literal_binds': True})
+    plan = postgres_conn.execute(text(f'EXPLAIN (FORMAT JSON) {compiled}')).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    assert _seq_scans(plan[0]['Plan']) == []
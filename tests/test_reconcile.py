@@ -0,0 +1,105 @@
+import os
+import pytest
+from werkzeug.security import generate_password_hash
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+import app  # noqa: F401
+from app import app as flask_app
+from balances import verify
+from models import db, User, Family, Bill, BillItem, Payment
+
+
+@pytest.fixture
+def client():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        family = Family(name='Smith')
+        manager = User(
+            username='manager',
+            password_hash=generate_password_hash('pass'),
+            role='manager',
+            family=family,
+        )
+        alice = User(username='alice', email='alice@example.com', password_hash='x', family=family)
+        bob = User(username='bob', password_hash='x', family=family)
+        db.session.add_all([family, manager, alice, bob])
+        db.session.flush()
+        bill = Bill(family_id=family.id, created_by=manager.id)
+        db.session.add(bill)
+        db.session.flush()
+        db.session.add_all([
+            BillItem(bill_id=bill.id, user_id=alice.id, description='line', amount=30),
+            BillItem(bill_id=bill.id, user_id=alice.id, description='device', amount=15),
+            BillItem(bill_id=bill.id, user_id=bob.id, description='line', amount=30),
+        ])
+        db.session.commit()
+        yield flask_app.test_client()
+        db.session.remove()
+        db.drop_all()
+
+
+def items():
+    return {
+        (i.user.username, i.description): i
+        for i in BillItem.query.order_by(BillItem.id)
+    }
+
+
+def test_reconcile_matches_by_reference_and_amount(client):
+    with flask_app.app_context():
+        it = items()
+        bob_id = it[('bob', 'line')].user_id
+        device_id = it[('alice', 'device')].id
+
+    csv_body = '\n'.join([
+        'user_id,email,amount,reference,paid_at',
+        ',alice@example.com,30.00,bank transfer,2026-10-01',
+        f',,10,FPP-{device_id},',
+        f',,5,FPP-{device_id},',
+        f'{bob_id},,29.99,,',
+        ',nobody@example.com,5,,',
+        f'{bob_id},,abc,,',
+    ])
+    client.post('/signin', data={'username': 'manager', 'password': 'pass'})
+    rv = client.post('/api/payments/reconcile', data=csv_body, content_type='text/csv')
+    assert rv.status_code == 200
+    report = rv.get_json()
+    assert report['rows'] == 6
+    assert report['matched'] == 3
+    assert report['items_paid'] == 2
+    assert [(r['line'], r['reason']) for r in report['unmatched_rows']] == [
+        (5, 'no open item matches'),
+        (6, 'unknown email'),
+        (7, 'amount must be a number'),
+    ]
+    assert report['payments_per_second'] > 0
+
+    with flask_app.app_context():
+        it = items()
+        assert it[('alice', 'line')].paid_at is not None
+        assert it[('alice', 'device')].paid_at is not None
+        assert it[('bob', 'line')].paid_at is None
+        assert Payment.query.count() == 3
+        assert verify(db.session.connection()) == []
+
+
+def test_reconcile_dry_run_writes_nothing(client):
+    client.post('/signin', data={'username': 'manager', 'password': 'pass'})
+    rv = client.post(
+        '/api/payments/reconcile?dry_run=1',
+        data='email,amount\nalice@example.com,30\n',
+        content_type='text/csv',
+    )
+    assert rv.get_json()['matched'] == 1
+    with flask_app.app_context():
+        assert Payment.query.count() == 0
+
+
+def test_reconcile_command(client, tmp_path):
+    path = tmp_path / 'payments.csv'
+    path.write_text('email,amount\nalice@example.com,15\n')
+    result = flask_app.test_cli_runner().invoke(args=['payments', 'reconcile', str(path)])
+    assert result.exit_code == 0, result.output
+    assert '1 of 1 payments matched, 1 items paid' in result.output
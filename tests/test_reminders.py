@@ -0,0 +1,92 @@
+import os
+from datetime import date, datetime, timedelta
+
+import pytest
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+from app import app as flask_app
+from mailer import DeliveryResult
+from models import db, User, Family, Bill, BillItem, NotificationLog, Payment
+import reminders
+
+TODAY = date(2025, 3, 10)
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    calls = []
+
+    def fake_send(emails, subject, body, substitutions=None):
+        calls.append((list(emails), substitutions))
+        return {e: DeliveryResult(e, e != 'bounce@example.com', 202) for e in emails}
+
+    monkeypatch.setattr(reminders, 'send_bulk', fake_send)
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        yield calls
+        db.session.remove()
+        db.drop_all()
+
+
+def family_bill(name, due_date, amounts, published=True):
+    """A family whose members owe ``amounts`` on one bill due ``due_date``."""
+    family = Family(name=name)
+    bill = Bill(family=family, due_date=due_date, published_at=datetime.utcnow() if published else None)
+    members = []
+    for i, amount in enumerate(amounts):
+        email = 'bounce@example.com' if amount == 13 else f'{name}{i}@example.com'
+        member = User(username=f'{name}{i}', name=f'{name.title()} {i}', email=email, family=family)
+        db.session.add(BillItem(bill=bill, user=member, description='Plan', amount=amount))
+        members.append(member)
+    db.session.add(bill)
+    db.session.commit()
+    return bill, members
+
+
+def test_reminds_unpaid_members_once_per_family_and_window(sent):
+    _, (_, bob, carol) = family_bill('smith', TODAY + timedelta(days=2), [40, 30, 25])
+    db.session.add(Payment(bill_item_id=bob.bill_items[0].id, user_id=bob.id, amount=30))
+    db.session.add(Payment(bill_item_id=carol.bill_items[0].id, user_id=carol.id, amount=10))
+    family_bill('jones', TODAY + timedelta(days=1), [20])
+    family_bill('later', TODAY + timedelta(days=10), [20])
+    family_bill('draft', TODAY, [20], published=False)
+    db.session.commit()
+
+    report = reminders.send_reminders(days=3, chunk_size=1, today=TODAY)
+    assert (report['bills'], report['families'], report['reminders'], report['delivered']) == (2, 2, 3, 3)
+    # one batch per family, personalised per member
+    by_family = {tuple(sorted(emails)): subs for emails, subs in sent}
+    assert set(by_family) == {('smith0@example.com', 'smith2@example.com'), ('jones0@example.com',)}
+    smith = by_family[('smith0@example.com', 'smith2@example.com')]
+    assert smith['smith2@example.com'] == {
+        '-name-': 'Smith 2', '-amount-': '$15.00', '-due_date-': (TODAY + timedelta(days=2)).isoformat(),
+    }
+    assert NotificationLog.query.filter_by(message=reminders.MESSAGE).count() == 3
+
+    sent.clear()
+    assert reminders.send_reminders(days=3, today=TODAY)['reminders'] == 0
+    assert sent == []
+
+
+def test_failed_deliveries_are_retried(sent):
+    family_bill('smith', TODAY, [40, 13])
+    report = reminders.send_reminders(days=3, today=TODAY)
+    assert (report['reminders'], report['delivered']) == (2, 1)
+    assert reminders.send_reminders(days=3, today=TODAY)['reminders'] == 1
+
+
+def test_same_day_window_still_dedupes(sent):
+    family_bill('smith', TODAY, [40])
+    assert reminders.send_reminders(days=0, today=TODAY)['delivered'] == 1
+    assert reminders.send_reminders(days=0, today=TODAY)['reminders'] == 0
+    # the window follows ``today``, not the clock
+    assert reminders.send_reminders(days=3, today=TODAY - timedelta(days=2))['reminders'] == 0
+
+
+def test_reminders_command(sent):
+    family_bill('smith', date.today() + timedelta(days=1), [40])
+    result = flask_app.test_cli_runner().invoke(args=['reminders', 'send', '--days', '2'])
+    assert result.exit_code == 0, result.output
+    assert '1 of 1 reminders delivered to 1 families for 1 due bills' in result.output
@@ -0,0 +1,106 @@
+import os
+import shutil
+import time
+
+import pytest
+from flask import g, session
+from sqlalchemy import create_engine, func, select
+from werkzeug.security import generate_password_hash
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+from app import app as flask_app
+from models import db, User, Family, Bill, BillItem
+import replica
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """A primary and a replica SQLite file; the replica is a snapshot taken after setup."""
+    monkeypatch.setitem(flask_app.config, 'STATEMENT_RENDERING', 'off')
+    monkeypatch.setitem(flask_app.config, 'REPLICA_STICKY_SECONDS', 60)
+    flask_app.config['TESTING'] = True
+    primary_path, replica_path = tmp_path / 'primary.db', tmp_path / 'replica.db'
+    with flask_app.app_context():
+        engines = db.engines
+        saved = dict(engines)
+        engines[None] = create_engine(f'sqlite:///{primary_path}')
+        engines[replica.BIND_KEY] = create_engine(f'sqlite:///{replica_path}')
+        try:
+            db.create_all()
+            family = Family(name='Smith')
+            manager = User(username='manager', password_hash=generate_password_hash('pass'), role='manager', family=family)
+            bill = Bill(family=family, creator=manager, total_amount=100)
+            db.session.add_all([family, manager, bill])
+            db.session.commit()
+            client = flask_app.test_client()
+            client.bill_id = bill.id
+            client.post('/signin', data={'username': 'manager', 'password': 'pass'})
+            db.session.remove()
+            shutil.copy(primary_path, replica_path)
+            unpin(client)
+            yield client
+        finally:
+            db.session.remove()
+            for key, engine in list(engines.items()):
+                if key is None or key == replica.BIND_KEY:
+                    engine.dispose()
+            engines.clear()
+            engines.update(saved)
+
+
+def unpin(client):
+    with client.session_transaction() as session:
+        session.pop(replica.STICKY_KEY, None)
+
+
+def cold_get(client, path):
+    # drop what earlier requests left in the shared app context
+    db.session.remove()
+    g.pop('_login_user', None)
+    return client.get(path)
+
+
+def item_count(engine):
+    with engine.connect() as conn:
+        return conn.execute(select(func.count(BillItem.id))).scalar()
+
+
+def test_read_only_views_read_from_the_replica(client):
+    with db.engines[None].begin() as conn:
+        conn.execute(Bill.__table__.update().values(total_amount=250))
+
+    assert cold_get(client, f'/api/bills/{client.bill_id}').get_json()['total_amount'] == 100
+    # views that are not marked read-only keep using the primary
+    assert cold_get(client, '/manage').status_code == 200
+
+
+def test_writes_go_to_the_primary_and_pin_the_user(client):
+    rv = client.post(f'/api/bills/{client.bill_id}/items', json={'description': 'Fee', 'amount': 5})
+    assert rv.status_code == 201
+    assert item_count(db.engines[None]) == 1
+    assert item_count(db.engines[replica.BIND_KEY]) == 0
+
+    # read-your-writes: the sticky window sends the next reads to the primary
+    assert len(cold_get(client, f'/api/bills/{client.bill_id}').get_json()['items']) == 1
+
+    unpin(client)
+    assert cold_get(client, f'/api/bills/{client.bill_id}').get_json()['items'] == []
+
+
+def test_core_writes_pin_whatever_the_method(client):
+    with flask_app.test_request_context(method='GET'):
+        flask_app.preprocess_request()
+        db.session.connection().execute(Bill.__table__.update().values(total_amount=250))
+        db.session.commit()
+        assert g.db_wrote
+        response = flask_app.process_response(flask_app.response_class())
+        assert response.status_code == 200
+        assert session[replica.STICKY_KEY] > time.time()
+
+
+def test_failed_writes_do_not_pin(client):
+    rv = client.post(f'/api/bills/{client.bill_id}/items', json={'description': 'Fee'})
+    assert rv.status_code == 400
+    with client.session_transaction() as session:
+        assert replica.STICKY_KEY not in session
@@ -0,0 +1,124 @@
+import os
+
+import pytest
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+from app import app as flask_app
+from balances import verify
+from metrics import BILLS_PUBLISHED
+from models import db, User, Family, Bill, BillItem, MemberBalance
+
+
+@pytest.fixture
+def client():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        family = Family(name='Smith')
+        manager = User(username='manager', password_hash=generate_password_hash('pass'), role='manager', family=family)
+        alice = User(username='alice', password_hash=generate_password_hash('pw'), family=family)
+        bob = User(username='bob', family=family)
+        db.session.add_all([family, manager, alice, bob])
+        db.session.flush()
+        bill = Bill(family_id=family.id, created_by=manager.id, cycle_month=12, total_amount=107)
+        db.session.add_all([
+            bill,
+            BillItem(bill=bill, user_id=alice.id, description='Plan', amount=40, is_recurring=True),
+            BillItem(bill=bill, user_id=alice.id, description='Overage', amount=7, is_recurring=False),
+            BillItem(bill=bill, user_id=bob.id, description='Plan', amount=30, is_recurring=True),
+            BillItem(bill=bill, description='Shared fee', amount=30, is_recurring=True),
+        ])
+        # bob leaves the family before the rollover
+        bob.family = Family(name='Jones')
+        db.session.commit()
+        client = flask_app.test_client()
+        client.family_id = family.id
+        client.alice_id = alice.id
+        client.post('/signin', data={'username': 'manager', 'password': 'pass'})
+        yield client
+        db.session.remove()
+        db.drop_all()
+
+
+def test_rollover_copies_recurring_items(client):
+    rv = client.post('/api/bills/rollover', json={'cycle_month': 1, 'due_date': '2025-01-20'})
+    assert rv.status_code == 200
+    report = rv.get_json()
+    assert (report['families'], report['bills'], report['items'], report['skipped']) == (2, 1, 2, 1)
+    assert report['rows_per_second'] is not None
+
+    bill = Bill.query.filter_by(cycle_month=1).one()
+    assert bill.family_id == client.family_id
+    assert bill.published_at is not None
+    assert bill.due_date.isoformat() == '2025-01-20'
+    assert float(bill.total_amount) == 70
+    assert sorted((i.description, i.user_id, float(i.amount), i.is_recurring) for i in bill.items) == [
+        ('Plan', client.alice_id, 40, True),
+        ('Shared fee', None, 30, True),
+    ]
+    assert float(db.session.get(MemberBalance, (bill.id, client.alice_id)).amount_owed) == 40
+    assert verify(db.session.connection()) == []
+
+
+def test_rollover_is_idempotent_per_family_and_cycle(client):
+    assert client.post('/api/bills/rollover', json={'cycle_month': 1}).get_json()['bills'] == 1
+    assert client.post('/api/bills/rollover', json={'cycle_month': 1}).get_json()['bills'] == 0
+    assert Bill.query.filter_by(cycle_month=1).count() == 1
+    # the next cycle rolls over from the new bill
+    report = client.post('/api/bills/rollover', json={'cycle_month': 2, 'family_id': client.family_id}).get_json()
+    assert (report['families'], report['bills'], report['items']) == (1, 1, 2)
+
+
+def test_rollover_leaves_bills_published_meanwhile_alone(client):
+    # a manager publishes a bill for the same family and cycle while the
+    # rollover is between its bill and item inserts
+    published = []
+
+    def publish_meanwhile(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('INSERT INTO bill ') and 'SELECT' in statement and not published:
+            published.append(cursor.execute(
+                'INSERT INTO bill (family_id, cycle_month) VALUES (?, 1)', (client.family_id,)
+            ))
+
+    event.listen(db.engine, 'before_cursor_execute', publish_meanwhile)
+    try:
+        assert client.post('/api/bills/rollover', json={'cycle_month': 1}).get_json()['items'] == 2
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', publish_meanwhile)
+    assert published
+    bills = Bill.query.filter_by(cycle_month=1).order_by(Bill.id).all()
+    assert [len(b.items) for b in bills] == [0, 2]
+    assert verify(db.session.connection()) == []
+
+
+def test_rolled_over_bills_are_announced(client, monkeypatch):
+    sent = []
+    monkeypatch.setattr('publishing.send_event', lambda data, family_id: sent.append((family_id, data)))
+    published = sum(BILLS_PUBLISHED.values.values())
+    assert client.post('/api/bills/rollover', json={'cycle_month': 1}).get_json()['bills'] == 1
+    bill = Bill.query.filter_by(cycle_month=1).one()
+    assert bill.pdf_url is not None
+    assert sent == [(client.family_id, '{"amount": 70.0}')]
+    assert sum(BILLS_PUBLISHED.values.values()) == published + 1
+
+
+def test_rollover_validation(client):
+    assert client.post('/api/bills/rollover', json={'cycle_month': 13}).status_code == 400
+    assert client.post('/api/bills/rollover', json={'cycle_month': 1, 'due_date': 'soon'}).status_code == 400
+    assert client.post('/api/bills/rollover', json={'cycle_month': 1, 'due_date': 20250120}).status_code == 400
+    assert client.post('/api/bills/rollover', json={'cycle_month': [1]}).status_code == 400
+    assert client.post('/api/bills/rollover', json={'cycle_month': '1'}).status_code == 400
+    assert client.post('/api/bills/rollover', json={'cycle_month': 1, 'family_id': 'all'}).status_code == 400
+    assert client.post('/api/bills/rollover', json={'cycle_month': 1, 'family_id': True}).status_code == 400
+    client.get('/signout')
+    client.post('/signin', data={'username': 'alice', 'password': 'pw'})
+    assert client.post('/api/bills/rollover', json={'cycle_month': 1}).status_code == 403
+
+
+def test_rollover_command(client):
+    result = flask_app.test_cli_runner().invoke(args=['bills', 'rollover', '--cycle-month', '1', '--chunk-size', '1'])
+    assert result.exit_code == 0, result.output
+    assert '1 bills and 2 items created for 2 families (1 skipped)' in result.output
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine, event, func, select
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+from app import app as flask_app
+from balances import verify
+from models import db, Bill, BillItem, Family, Payment, User
+from passwords import verify_password
+from seed import seed
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'seed.db'}")
+
+    @event.listens_for(engine, 'connect')
+    def _foreign_keys(dbapi_conn, record):
+        dbapi_conn.execute('PRAGMA foreign_keys=ON')
+
+    db.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+def snapshot(conn):
+    return conn.execute(
+        select(BillItem.bill_id, BillItem.user_id, BillItem.amount, BillItem.paid_at).order_by(BillItem.id)
+    ).all()
+
+
+def test_seed_is_reproducible_and_consistent(engine, tmp_path):
+    # small chunks make child tables flush before their parents' buffers fill
+    with engine.begin() as conn:
+        counts = seed(conn, 20, months=3, chunk_size=7, password='pw')
+        first = snapshot(conn)
+        assert counts['family'] == 20
+        assert counts['bill'] == 60
+        assert counts['user'] == conn.execute(select(func.count(User.id))).scalar()
+        assert counts['bill_item'] == len(first)
+        assert verify(conn) == []
+        assert conn.execute(select(func.count(Payment.id))).scalar() == counts['payment']
+        user_hash = conn.execute(select(User.password_hash).limit(1)).scalar()
+        assert verify_password(user_hash, 'pw')
+
+    other = create_engine(f"sqlite:///{tmp_path / 'other.db'}")
+    db.metadata.create_all(other)
+    with other.begin() as conn:
+        seed(conn, 20, months=3, chunk_size=1000, password='pw')
+        assert snapshot(conn) == first
+    other.dispose()
+
+
+def test_seed_appends_to_existing_data(engine):
+    with engine.begin() as conn:
+        seed(conn, 5, months=2, members=3)
+        seed(conn, 5, months=2, members=3, seed_value=2)
+        assert conn.execute(select(func.count(Family.id))).scalar() == 10
+        assert conn.execute(select(func.count(User.id))).scalar() == 30
+        assert conn.execute(select(func.count(Bill.id))).scalar() == 20
+        assert verify(conn) == []
+
+
+def test_seed_command():
+    with flask_app.app_context():
+        db.create_all()
+        try:
+            result = flask_app.test_cli_runner().invoke(args=['seed', '--families', '3', '--months', '2'])
+            assert result.exit_code == 0, result.output
+            assert 'rows/s' in result.output
+            assert db.session.query(Family).count() == 3
+        finally:
+            db.session.remove()
+            db.drop_all()
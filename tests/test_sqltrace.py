@@ -0,0 +1,89 @@
+import logging
+import os
+
+import pytest
+from flask import g
+from werkzeug.security import generate_password_hash
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+from app import app as flask_app
+from models import db, User, Family, Bill, BillItem
+import sqltrace
+
+
+@pytest.fixture
+def client():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        family = Family(name='Smith')
+        manager = User(username='manager', password_hash=generate_password_hash('pass'), role='manager', family=family)
+        db.session.add_all([family, manager] + [User(username=f'm{i}', family=family) for i in range(6)])
+        db.session.flush()
+        bill = Bill(family_id=family.id, created_by=manager.id)
+        db.session.add(bill)
+        db.session.flush()
+        db.session.add_all([BillItem(bill_id=bill.id, user_id=u.id, description='line', amount=5)
+                            for u in family.members])
+        db.session.commit()
+        client = flask_app.test_client()
+        client.family_id, client.bill_id = family.id, bill.id
+        client.post('/signin', data={'username': 'manager', 'password': 'pass'})
+        yield client
+        db.session.remove()
+        db.drop_all()
+
+
+def test_lazy_loop_is_reported_as_n_plus_one(client):
+    db.session.expunge_all()
+    family = db.session.get(Family, client.family_id)
+    with sqltrace.trace() as log:
+        for member in family.members:
+            member.bill_items
+    (sql, count, sites), = log.repeated()
+    assert count == 7
+    assert 'FROM bill_item' in sql
+    assert sites == [f'tests/test_sqltrace.py:{test_lazy_loop_is_reported_as_n_plus_one.__code__.co_firstlineno + 5} '
+                     'in test_lazy_loop_is_reported_as_n_plus_one']
+    assert 'possible N+1: 7x' in log.summary()
+
+
+def test_shape_collapses_literals_and_in_lists():
+    assert sqltrace.shape('SELECT * FROM t WHERE id IN (?, ?, ?) AND n = 3') == \
+        sqltrace.shape("SELECT * FROM t WHERE id IN (?)  AND n = 'x'")
+
+
+def cold_request(client, path):
+    # requests share the fixture's app context and session; start each one
+    # without the user Flask-Login cached in g or objects in the identity map
+    g.pop('_login_user', None)
+    db.session.expunge_all()
+    return client.get(path)
+
+
+def test_endpoints_within_query_budget(client, query_budget):
+    with query_budget(2):
+        assert cold_request(client, '/dashboard').status_code == 200
+    with query_budget(3):
+        assert cold_request(client, f'/api/bills/{client.bill_id}').status_code == 200
+
+
+def test_query_budget_fails_when_exceeded(client, query_budget):
+    with pytest.raises(pytest.fail.Exception) as failure:
+        with query_budget(1):
+            cold_request(client, f'/api/bills/{client.bill_id}')
+    assert 'budget was 1' in str(failure.value)
+    assert 'api.py' in str(failure.value)
+
+
+def test_request_summary_logged_when_enabled(client, caplog):
+    flask_app.config['SQLTRACE'] = True
+    try:
+        with caplog.at_level(logging.INFO, logger=flask_app.logger.name):
+            rv = client.get('/dashboard')
+    finally:
+        flask_app.config['SQLTRACE'] = False
+    assert int(rv.headers['X-Query-Count']) >= 1
+    assert any('GET /dashboard' in r.getMessage() and 'queries in' in r.getMessage() for r in caplog.records)
+    assert client.get('/dashboard').headers.get('X-Query-Count') is None
@@ -0,0 +1,118 @@
+import os
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+from app import app as flask_app
+from models import db, User, Family, Bill, touch_bills
+import statements
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr('publishing.send_bulk', lambda emails, subject, body: {})
+    flask_app.config['TESTING'] = True
+    flask_app.config['STATEMENT_CACHE_DIR'] = str(tmp_path)
+    with flask_app.app_context():
+        db.create_all()
+        family = Family(name='Smith')
+        db.session.add_all([
+            family,
+            User(username='manager', password_hash=generate_password_hash('pass'), role='manager', family=family),
+            User(username='alice', password_hash=generate_password_hash('pw'), role='user', family=family),
+            User(username='bob', password_hash=generate_password_hash('pw'), role='user'),
+        ])
+        db.session.commit()
+        client = flask_app.test_client()
+        client.family_id = family.id
+        client.post('/signin', data={'username': 'manager', 'password': 'pass'})
+        yield client
+        db.session.remove()
+        db.drop_all()
+
+
+def cached_files(path):
+    return sorted(name for _, _, names in os.walk(path) for name in names)
+
+
+def test_publish_renders_statement_and_sets_pdf_url(client, tmp_path):
+    bill_id = client.post('/api/bills', json={'family_id': client.family_id, 'total_amount': 20}).get_json()['id']
+    pdf_url = db.session.get(Bill, bill_id).pdf_url
+    assert pdf_url.startswith(f'/api/bills/{bill_id}/statement/')
+    assert len(cached_files(tmp_path)) == 1
+
+    rv = client.get(pdf_url)
+    assert rv.status_code == 200
+    assert rv.mimetype == 'application/pdf'
+    assert rv.data.startswith(b'%PDF-1.4') and rv.data.rstrip().endswith(b'%%EOF')
+    assert rv.headers['ETag']
+
+    assert client.get(pdf_url, headers={'If-None-Match': rv.headers['ETag']}).status_code == 304
+    partial = client.get(pdf_url, headers={'Range': 'bytes=0-7'})
+    assert partial.status_code == 206
+    assert partial.data == b'%PDF-1.4'
+
+
+def test_unchanged_bill_is_not_rendered_again(client, tmp_path):
+    bill_id = client.post('/api/bills', json={'family_id': client.family_id}).get_json()['id']
+    first = db.session.get(Bill, bill_id).pdf_url
+    statements.render(bill_id)
+    assert db.session.get(Bill, bill_id).pdf_url == first
+    assert len(cached_files(tmp_path)) == 1
+
+    client.post(f'/api/bills/{bill_id}/items', json={'description': 'fee', 'amount': 3})
+    assert db.session.get(Bill, bill_id).pdf_url != first
+    assert len(cached_files(tmp_path)) == 2
+    # the old statement stays addressable until it is evicted
+    assert client.get(first).status_code == 200
+
+
+def test_render_of_an_older_version_keeps_the_newer_url(client, monkeypatch):
+    bill_id = client.post('/api/bills', json={'family_id': client.family_id}).get_json()['id']
+    current = db.session.get(Bill, bill_id).pdf_url
+    statement_data = statements.statement_data
+
+    def changed_meanwhile(conn, bill_id):
+        data = statement_data(conn, bill_id)
+        touch_bills(conn, [bill_id])
+        data['total_amount'] = '99.00'
+        return data
+
+    monkeypatch.setattr(statements, 'statement_data', changed_meanwhile)
+    statements.render(bill_id)
+    db.session.expire_all()
+    assert db.session.get(Bill, bill_id).pdf_url == current
+
+
+def test_render_leaves_the_callers_session_alone(client):
+    bill_id = client.post('/api/bills', json={'family_id': client.family_id}).get_json()['id']
+    db.session.add(Family(name='Pending'))
+    statements.render(bill_id)
+    db.session.rollback()
+    assert Family.query.filter_by(name='Pending').count() == 0
+
+
+def test_cache_is_evicted_by_size(client, tmp_path):
+    bill_id = client.post('/api/bills', json={'family_id': client.family_id}).get_json()['id']
+    pdf_url = db.session.get(Bill, bill_id).pdf_url
+    statements.evict(str(tmp_path), 1)
+    assert cached_files(tmp_path) == []
+    rv = client.get(pdf_url)
+    assert rv.status_code == 503
+    assert rv.headers['Retry-After']
+    # under TESTING the re-render scheduled by the 503 ran inline
+    assert client.get(pdf_url).status_code == 200
+
+
+def test_statement_requires_family_membership(client):
+    bill_id = client.post('/api/bills', json={'family_id': client.family_id}).get_json()['id']
+    pdf_url = db.session.get(Bill, bill_id).pdf_url
+    client.get('/signout')
+    client.post('/signin', data={'username': 'bob', 'password': 'pw'})
+    assert client.get(pdf_url).status_code == 403
+    client.get('/signout')
+    client.post('/signin', data={'username': 'alice', 'password': 'pw'})
+    assert client.get(pdf_url).status_code == 200
+    assert client.get(f'/api/bills/{bill_id}/statement/{"0" * 64}.pdf').status_code == 404